@@ -7,29 +7,39 @@
 #############################
 
 # Imports
-import glob
+import os, sys
+
+# Helper modules live alongside these scripts; set ATA_POL_SCRIPTS when running
+# from a data directory
+script_dir = os.path.dirname(os.path.abspath(__file__)) if '__file__' in globals() else os.getcwd()
+sys.path.insert(0, os.environ.get('ATA_POL_SCRIPTS', script_dir))
+from flagging import apply_flags, flag_command
+from ingest import ingest, scan_groups
+from preview import calibrated_preview
+from calibrator_models import set_model
+
+# Stage checks write time/channel-averaged previews with the tables applied on
+# the fly; set to False for full calibrated copies
+preview_checks = True
+# Calibrator models evaluated on the fly instead of written to MODEL_DATA
+virtual_models = True
 
 lo = 'b'
-# Concatenate sample
-vis_to_concat = glob.glob(f'*/*{lo}_averaged.ms')
-concat(vis=vis_to_concat, concatvis=f'3C286_{lo}.ms')
-
-# Fix scan numbers
-execfile('fix_scans.py')
+# Concatenate sample, one scan per folder, linking rather than copying the visibilities
+ingest(scan_groups(f'*/*{lo}_averaged.ms'), f'3C286_{lo}.ms')
 
 # Flagging for RFI and bandpass
 # NOTE: FLAG SCAN 18! CHECK IF 3C286 WENT DOWN THEN
 # NOTE: FLAG ANTENNA 4e
 vis = f'3C286_{lo}.ms'
-flagdata(vis=vis, field='0', mode='tfcrop', datacolumn='DATA')
-flagdata(vis=vis, field='0', mode='rflag', datacolumn='DATA')
-flagdata(vis=vis, field='1', mode='tfcrop', datacolumn='DATA')
-flagdata(vis=vis, field='1', mode='rflag', datacolumn='DATA')
-flagdata(vis=vis, antenna='31')
-flagdata(vis=vis, scan='18')
+# All six flagging steps run in one pass over the MS
+flag_list = [flag_command(mode, field=field, datacolumn='DATA') for field in ['0', '1'] for mode in ['tfcrop', 'rflag']]
+flag_list += [flag_command('manual', antenna='31'), flag_command('manual', scan='18')]
+apply_flags(vis, flag_list, flagbackup=True)
 
 # Set flux model for flux calibrator (in this case, field 0 is 3C286)
-setjy(vis=vis, field='0', standard='Perley-Butler 2017', usescratch=True)
+# The model is kept virtual rather than written to a MODEL_DATA column unless virtual_models is off
+set_model(vis, '0', virtual=virtual_models, standard='Perley-Butler 2017')
 
 listobs(vis=vis)
 
@@ -44,8 +54,11 @@ gaincal(vis=vis, caltable=f'3c286_{lo}.K0', field='0', refant='40', solint='inf'
 
 # Write out a new measurement set here to check if everything looks alright
 # before moving on to secondary gain cal
-split(vis = f'3C286_{lo}.ms', outputvis = f'3C286_{lo}2.ms', datacolumn = 'data')
-applycal(vis=f'3C286_{lo}2.ms', gaintable=[f'3c286_{lo}.G0', f'3c286_{lo}.G1', f'3c286_{lo}.K0'])
+if preview_checks:
+    calibrated_preview(f'3C286_{lo}.ms', [f'3c286_{lo}.G0', f'3c286_{lo}.G1', f'3c286_{lo}.K0'], f'3C286_{lo}2.ms')
+else:
+    split(vis = f'3C286_{lo}.ms', outputvis = f'3C286_{lo}2.ms', datacolumn = 'data')
+    applycal(vis=f'3C286_{lo}2.ms', gaintable=[f'3c286_{lo}.G0', f'3c286_{lo}.G1', f'3c286_{lo}.K0'])
 # Check as you go (weird bandpass response)
 # check cross hand amps before and after kcross
 # Phase/amp are the focus here
@@ -56,8 +69,11 @@ bandpass(vis=vis, caltable=f'3c286_{lo}.B0', field='0', refant='40', solint='inf
 
 # Write out a new measurement set here to check if everything looks alright
 # before moving on to secondary gain cal
-split(vis = f'3C286_{lo}.ms', outputvis = f'3C286_{lo}3.ms', datacolumn = 'data')
-applycal(vis=f'3C286_{lo}3.ms', gaintable=[f'3c286_{lo}.G0', f'3c286_{lo}.G1', f'3c286_{lo}.K0', f'3c286_{lo}.B0'])
+if preview_checks:
+    calibrated_preview(f'3C286_{lo}.ms', [f'3c286_{lo}.G0', f'3c286_{lo}.G1', f'3c286_{lo}.K0', f'3c286_{lo}.B0'], f'3C286_{lo}3.ms')
+else:
+    split(vis = f'3C286_{lo}.ms', outputvis = f'3C286_{lo}3.ms', datacolumn = 'data')
+    applycal(vis=f'3C286_{lo}3.ms', gaintable=[f'3c286_{lo}.G0', f'3c286_{lo}.G1', f'3c286_{lo}.K0', f'3c286_{lo}.B0'])
 # Check as you go (weird bandpass response)
 # check cross hand amps before and after kcross
 # Phase/amp are the focus here
@@ -71,8 +87,11 @@ applycal(vis=f'3C286_{lo}3.ms', gaintable=[f'3c286_{lo}.G0', f'3c286_{lo}.G1', f
 gaincal(vis=vis, caltable=f'3c286_{lo}.G2', field='0', refant='40', calmode='p', solint='10', preavg=1, minblperant=1, minsnr=0, gaintype='G', gaintable=[f'3c286_{lo}.K0', f'3c286_{lo}.B0'])
 gaincal(vis=vis, caltable=f'3c286_{lo}.G3', field='0', refant='40', calmode='a', solint='inf', combine='scan', preavg=1, minblperant=1, minsnr=0, gaintype='G', gaintable=[f'3c286_{lo}.K0', f'3c286_{lo}.B0', f'3c286_{lo}.G2'])
 
-split(vis = f'3C286_{lo}.ms', outputvis = f'3C286_{lo}4.ms', datacolumn = 'data')
-applycal(vis=f'3C286_{lo}4.ms', gaintable=[f'3c286_{lo}.G2', f'3c286_{lo}.G3', f'3c286_{lo}.K0', f'3c286_{lo}.B0'])
+if preview_checks:
+    calibrated_preview(f'3C286_{lo}.ms', [f'3c286_{lo}.G2', f'3c286_{lo}.G3', f'3c286_{lo}.K0', f'3c286_{lo}.B0'], f'3C286_{lo}4.ms')
+else:
+    split(vis = f'3C286_{lo}.ms', outputvis = f'3C286_{lo}4.ms', datacolumn = 'data')
+    applycal(vis=f'3C286_{lo}4.ms', gaintable=[f'3c286_{lo}.G2', f'3c286_{lo}.G3', f'3c286_{lo}.K0', f'3c286_{lo}.B0'])
 
 # Polarization-independent solve gets one solution for both polarizations
 # Catches tropospheric gain error
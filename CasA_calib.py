@@ -8,6 +8,20 @@
 
 # Imports
 import glob
+import os, sys
+
+# Helper modules live alongside these scripts; set ATA_POL_SCRIPTS when running
+# from a data directory
+script_dir = os.path.dirname(os.path.abspath(__file__)) if '__file__' in globals() else os.getcwd()
+sys.path.insert(0, os.environ.get('ATA_POL_SCRIPTS', script_dir))
+from preview import calibrated_preview
+from calibrator_models import set_model
+
+# Stage checks write time/channel-averaged previews with the tables applied on
+# the fly; set to False for full calibrated copies
+preview_checks = True
+# Calibrator models evaluated on the fly instead of written to MODEL_DATA
+virtual_models = True
 
 # lo = 'b'
 # # Concatenate sample
@@ -31,7 +45,8 @@ vis = 'CasA_polcal.ms'
 flagdata(vis=vis, mode='manual', scan='28', flagbackup=False)
 
 # Set flux model for flux calibrator (in this case, field 0 is 3C286)
-setjy(vis=vis, field='', standard='Perley-Butler 2017', usescratch=True)
+# The models are kept virtual rather than written to a MODEL_DATA column unless virtual_models is off
+set_model(vis, '', virtual=virtual_models, standard='Perley-Butler 2017')
 
 listobs(vis=vis)
 
@@ -48,8 +63,11 @@ gaincal(vis=vis, caltable='CasA_polcal.K0', field=bcal, spw=spw, refant='40', so
 
 # Write out a new measurement set here to check if everything looks alright
 # before moving on to secondary gain cal
-split(vis = f'CasA_polcal.ms', outputvis = 'CasA_polcal2.ms', datacolumn = 'data')
-applycal(vis=f'CasA_polcal2.ms', gaintable=['CasA_polcal.G0', 'CasA_polcal.G1', 'CasA_polcal.K0'])
+if preview_checks:
+    calibrated_preview(f'CasA_polcal.ms', ['CasA_polcal.G0', 'CasA_polcal.G1', 'CasA_polcal.K0'], 'CasA_polcal2.ms')
+else:
+    split(vis = f'CasA_polcal.ms', outputvis = 'CasA_polcal2.ms', datacolumn = 'data')
+    applycal(vis=f'CasA_polcal2.ms', gaintable=['CasA_polcal.G0', 'CasA_polcal.G1', 'CasA_polcal.K0'])
 # Check as you go (weird bandpass response)
 # check cross hand amps before and after kcross
 # Phase/amp are the focus here
@@ -60,8 +78,11 @@ bandpass(vis=vis, caltable=f'CasA_polcal.B0', field=bcal, spw=spw, refant='40',
 
 # Write out a new measurement set here to check if everything looks alright
 # before moving on to secondary gain cal
-split(vis = 'CasA_polcal.ms', outputvis = 'CasA_polcal3.ms', datacolumn = 'data')
-applycal(vis='CasA_polcal3.ms', gaintable=['CasA_polcal.G0', 'CasA_polcal.G1', 'CasA_polcal.K0', 'CasA_polcal.B0'])
+if preview_checks:
+    calibrated_preview('CasA_polcal.ms', ['CasA_polcal.G0', 'CasA_polcal.G1', 'CasA_polcal.K0', 'CasA_polcal.B0'], 'CasA_polcal3.ms')
+else:
+    split(vis = 'CasA_polcal.ms', outputvis = 'CasA_polcal3.ms', datacolumn = 'data')
+    applycal(vis='CasA_polcal3.ms', gaintable=['CasA_polcal.G0', 'CasA_polcal.G1', 'CasA_polcal.K0', 'CasA_polcal.B0'])
 # Check as you go (weird bandpass response)
 # check cross hand amps before and after kcross
 # Phase/amp are the focus here
@@ -75,8 +96,11 @@ applycal(vis='CasA_polcal3.ms', gaintable=['CasA_polcal.G0', 'CasA_polcal.G1', '
 gaincal(vis=vis, caltable=f'CasA_polcal.G2', field=bcal, spw=spw, refant='40', calmode='ap', solint='10', gaintable=[f'CasA_polcal.K0', f'CasA_polcal.B0'])
 gaincal(vis=vis, caltable=f'CasA_polcal.G3', field=pcal, spw=spw, refant='40', calmode='ap', solint='inf', gaintable=[f'CasA_polcal.K0', f'CasA_polcal.B0', f'CasA_polcal.G2'], append=True)
 
-split(vis = 'CasA_polcal.ms', outputvis = 'CasA_polcal4.ms', datacolumn = 'data')
-applycal(vis='CasA_polcal4.ms', gaintable=['CasA_polcal.G2', 'CasA_polcal.G3', f'CasA_polcal.K0', f'CasA_polcal.B0'])
+if preview_checks:
+    calibrated_preview('CasA_polcal.ms', ['CasA_polcal.G2', 'CasA_polcal.G3', f'CasA_polcal.K0', f'CasA_polcal.B0'], 'CasA_polcal4.ms')
+else:
+    split(vis = 'CasA_polcal.ms', outputvis = 'CasA_polcal4.ms', datacolumn = 'data')
+    applycal(vis='CasA_polcal4.ms', gaintable=['CasA_polcal.G2', 'CasA_polcal.G3', f'CasA_polcal.K0', f'CasA_polcal.B0'])
 
 # # Kcross normalization
 # gaincal(vis=f'CasA_polcal_cal.ms', caltable=f'CasA_polcal_cal_norm.Kcross0', spw=spw, refant='40', solint='inf', gaintype='KCROSS', combine='scan', calmode='ap', minblperant=1, parang=True)
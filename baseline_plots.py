@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+#############################################################################
+# Per-baseline phase vs frequency plots
+#############################################################################
+
+# Replaces a plotms call per antenna pair (iteraxis='scan', avgtime large),
+# which rereads the whole MS for every baseline. The visibilities of one
+# field and SPW are read once, in chunks, and vector-averaged per scan,
+# baseline, correlation and channel. The averaged phases go to a .npy file
+# that worker processes memory-map to draw one page of scan panels per
+# baseline.
+#
+# Usage inside a calibration script:
+#
+#   plot_baseline_phases(vis, field='0', spw=1, antenna=antennas, datacolumn='data')
+
+import os
+
+import numpy as np
+
+from workers import load_job, run_modules
+
+# Rows read per chunk; a 168-channel, 4-correlation row is ~3 kB of DATA and FLAG
+CHUNK_ROWS = 100_000
+
+CORR_COLOURS = ['tab:blue', 'tab:orange', 'tab:green', 'tab:red']
+
+
+def average_by_scan(vis: str, field: str = '0', spw: int = 0, datacolumn: str = 'data') -> dict:
+    '''
+    Vector-average the unflagged visibilities of one field and SPW per scan,
+    baseline, correlation and channel in a single chunked pass.
+    Returns phases in degrees with shape (nscan, nbaseline, npol, nchan), NaN where fully flagged.
+    '''
+    from casatools import table
+    column = 'CORRECTED_DATA' if datacolumn.lower() == 'corrected' else datacolumn.upper()
+    tb = table()
+
+    tb.open(os.path.join(vis, 'ANTENNA'))
+    antenna_names = list(tb.getcol('NAME'))
+    tb.close()
+    nant = len(antenna_names)
+
+    tb.open(os.path.join(vis, 'FIELD'))
+    field_names = list(tb.getcol('NAME'))
+    tb.close()
+    field_id = field_names.index(field) if field in field_names else int(field)
+
+    tb.open(os.path.join(vis, 'DATA_DESCRIPTION'))
+    ddids = [i for i, s in enumerate(tb.getcol('SPECTRAL_WINDOW_ID')) if s == spw]
+    tb.close()
+
+    tb.open(os.path.join(vis, 'SPECTRAL_WINDOW'))
+    freq = tb.getcell('CHAN_FREQ', spw) / 1e9
+    tb.close()
+
+    tb.open(vis)
+    sub = tb.query(f'FIELD_ID=={field_id} && DATA_DESC_ID IN {ddids} && ANTENNA1 != ANTENNA2',
+                   columns=f'ANTENNA1,ANTENNA2,SCAN_NUMBER,FLAG,{column}')
+    nrows = sub.nrows()
+    scans = np.unique(sub.getcol('SCAN_NUMBER')) if nrows else np.array([], dtype=int)
+
+    # Baselines are indexed by the upper triangle of the antenna matrix
+    a1_grid, a2_grid = np.triu_indices(nant, k=1)
+    baseline_index = -np.ones((nant, nant), dtype=int)
+    baseline_index[a1_grid, a2_grid] = np.arange(len(a1_grid))
+    nbl = len(a1_grid)
+
+    sums = None
+    counts = None
+    for start in range(0, nrows, CHUNK_ROWS):
+        n = min(CHUNK_ROWS, nrows - start)
+        a1 = sub.getcol('ANTENNA1', startrow=start, nrow=n)
+        a2 = sub.getcol('ANTENNA2', startrow=start, nrow=n)
+        scan = sub.getcol('SCAN_NUMBER', startrow=start, nrow=n)
+        data = sub.getcol(column, startrow=start, nrow=n).transpose(2, 0, 1)
+        good = ~sub.getcol('FLAG', startrow=start, nrow=n).transpose(2, 0, 1)
+        if sums is None:
+            sums = np.zeros((len(scans) * nbl,) + data.shape[1:], dtype=np.complex128)
+            counts = np.zeros(sums.shape, dtype=np.int64)
+
+        lo, hi = np.minimum(a1, a2), np.maximum(a1, a2)
+        idx = np.searchsorted(scans, scan) * nbl + baseline_index[lo, hi]
+        order = np.argsort(idx, kind='stable')
+        uniq, starts = np.unique(idx[order], return_index=True)
+        sums[uniq] += np.add.reduceat(np.where(good, data, 0)[order], starts, axis=0)
+        counts[uniq] += np.add.reduceat(good[order].astype(np.int64), starts, axis=0)
+    sub.close()
+    tb.close()
+
+    if sums is None:
+        raise ValueError(f"No unflagged cross-correlations for field {field} in spw {spw} of {vis}")
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        phase = np.rad2deg(np.angle(sums / counts)).astype(np.float32)
+    phase[counts == 0] = np.nan
+    return {
+        'phase': phase.reshape((len(scans), nbl) + phase.shape[1:]),
+        'scans': [int(s) for s in scans],
+        'freq': freq.tolist(),
+        'antenna_names': antenna_names,
+        'baselines': [[int(a), int(b)] for a, b in zip(a1_grid, a2_grid)],
+    }
+
+
+def render_baselines(phase_file: str, meta: dict, baselines: list, prefix: str, gridrows: int, gridcols: int):
+    '''Draw one page of scan panels (phase vs frequency, coloured by correlation) per baseline'''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    phase = np.load(phase_file, mmap_mode='r')
+    freq = np.array(meta['freq'])
+    names = meta['antenna_names']
+    per_page = gridrows * gridcols
+    for b in baselines:
+        a1, a2 = meta['baselines'][b]
+        for page, start in enumerate(range(0, len(meta['scans']), per_page)):
+            page_scans = meta['scans'][start:start + per_page]
+            fig, axes = plt.subplots(gridrows, gridcols, sharex=True, sharey=True,
+                                     figsize=(3 * gridcols, 2.4 * gridrows), squeeze=False)
+            for i, (ax, scan) in enumerate(zip(axes.flat, page_scans)):
+                panel = phase[start + i, b]
+                for corr in range(panel.shape[0]):
+                    ax.plot(freq, panel[corr], '.', ms=2, color=CORR_COLOURS[corr % 4])
+                ax.set_title(f'Scan {scan}', fontsize=9)
+                if i + gridcols >= len(page_scans):
+                    ax.tick_params(labelbottom=True)
+            for ax in axes.flat[len(page_scans):]:
+                ax.set_visible(False)
+            axes[0, 0].set_ylim(-180, 180)
+            fig.supxlabel('Frequency (GHz)')
+            fig.supylabel('Phase (deg)')
+            fig.suptitle(f'{names[a1]} & {names[a2]}')
+            fig.tight_layout()
+            suffix = '' if page == 0 else f'_{page + 1}'
+            fig.savefig(f'{prefix}_{names[a1]}_{names[a2]}{suffix}.png', dpi=100)
+            plt.close(fig)
+
+
+def plot_baseline_phases(vis: str, field: str = '0', spw: int = 0, antenna: list = None, datacolumn: str = 'data',
+                         prefix: str = 'phase_vs_freq', gridrows: int = 4, gridcols: int = 4, nproc: int = 0) -> list:
+    '''
+    Phase vs frequency for every baseline between the given antennas (all if
+    None), one panel per scan, written as <prefix>_<ant1>_<ant2>.png.
+    Returns the baselines whose plots failed.
+    '''
+    meta = average_by_scan(vis, field=field, spw=spw, datacolumn=datacolumn)
+    names = meta['antenna_names']
+    selected = set(names if not antenna else [str(a).strip('"') for a in antenna])
+    baselines = [b for b, (a1, a2) in enumerate(meta['baselines']) if names[a1] in selected and names[a2] in selected]
+
+    work = f"{vis.rstrip('/')}.{prefix}"
+    phase_file = f'{work}.npy'
+    np.save(phase_file, meta.pop('phase'))
+
+    nproc = min(len(baselines), nproc or os.cpu_count() or 1)
+    jobs = {f'{work}.{n}': {'phase_file': phase_file, 'meta': meta, 'baselines': baselines[n::nproc],
+                            'prefix': prefix, 'gridrows': gridrows, 'gridcols': gridcols}
+            for n in range(nproc)}
+    finished = run_modules('baseline_plots', jobs, nproc=nproc)
+    os.remove(phase_file)
+    return [meta['baselines'][b] for name, job in jobs.items() if name not in finished for b in job['baselines']]
+
+
+if __name__ == '__main__':
+    # Worker process started by run_module
+    job = load_job()
+    render_baselines(**job)
@@ -1,33 +1,39 @@
 #!/usr/bin/env python3
 
-from distutils.dir_util import copy_tree, remove_tree
+import os, sys
 import pathlib
 
+# Helper modules live alongside these scripts; set ATA_POL_SCRIPTS when running
+# from a data directory
+script_dir = os.path.dirname(os.path.abspath(__file__)) if '__file__' in globals() else os.getcwd()
+sys.path.insert(0, os.environ.get('ATA_POL_SCRIPTS', script_dir))
+from spw_calibration import calibrate_by_spw, merge_stokes_models
+from caltable_plots import caltable_plot, render_caltable_plots
+from baseline_plots import plot_baseline_phases
+from ingest import ingest, scan_groups
+
 WORK_DIR = pathlib.Path('.').absolute()
 print(WORK_DIR)
 DATA_DIR = pathlib.Path('.').absolute()
 print(DATA_DIR)
 NSPW = 2  # number of spectral windows
 REFANT = '40' # 5e
+PARALLEL_SPW = False  # Calibrate each spectral window in its own process and merge the tables
+SPW_WORKERS = 0  # worker processes for PARALLEL_SPW; 0 uses one per core
+BASELINE_PLOTS = True  # Phase vs frequency plots per baseline and scan (phase_vs_freq_<ant1>_<ant2>.png)
+INGEST = False  # Build vis from the per-scan uvh5*_measure_sets folders in DATA_DIR
+
+# Caltables written by the calibration chain, as suffixes of 'uvh5_60247'
+FIELD_POL_TABLES = ['.G0', '.B0'] + [f'_1256_057{t}' for t in ['.G0', '.field1.G1', '.field1.G2', '.Kcross0',
+                                                               '.Xfparang', '.D0', '.Xfparang1']]
 
-# # Copy ms files to a scratch directory to update the scan numbers
-# scratch = WORK_DIR / 'scratch'
-# scratch.mkdir()
-# for scan, folder in enumerate(sorted(DATA_DIR.glob('uvh5*_measure_sets'))):
-#     dest = scratch / folder.name
-#     copy_tree(str(folder), str(dest))
-#     for ms in dest.glob('*.ms'):
-#         tb.open(str(ms), nomodify=False)
-#         a = tb.getcol('SCAN_NUMBER')
-#         a[:] = scan + 1  # CASA numbers the first scan as 1
-#         tb.putcol('SCAN_NUMBER', a)
-#         tb.close()
-
-# # Concatenate everything
-# ms_files = sorted([str(p) for p in scratch.glob('uvh5*_measure_sets/*.ms')])
 vis = '3c286_obs.ms'
-# concat(vis=ms_files, concatvis=vis)
-# remove_tree(str(scratch))
+
+if INGEST:
+    # Link the measurement sets of each uvh5*_measure_sets folder into one
+    # multi-MS, numbering the folders as scans 1, 2, ... (CASA numbers the
+    # first scan as 1); the visibilities are not copied
+    ingest(scan_groups(str(DATA_DIR / 'uvh5*_measure_sets')), vis, scratch=str(WORK_DIR / 'scratch'))
 
 # Flagging
 
@@ -54,146 +60,152 @@ antennas = ['1b', '1c', '1e', '1g', '1h', '1k',
             '3d', '3l', '4e', '4j', '5e']
 antenna_list = ','.join([f'"{a}"' for a in antennas])
 
-# These plots take a very long time to generate
-# for a0 in antennas:
-#     for a1 in antennas:
-#         plotms(vis=vis, ydatacolumn='data',
-#                xaxis='freq', yaxis='phase',
-#                avgtime='10000', coloraxis='corr', iteraxis='scan',
-#                antenna=f'"{a0}"&"{a1}"', field='0',
-#                gridcols=4, gridrows=4, spw='1',
-#                plotfile=f'phase_vs_freq_{a0}_{a1}.png')
-
-# Bandpass
-#
-# Simply use a scan of 3C286, which has more flux than the other source.
-# In scan 2, the amplitudes in spw1 decrease in a strange way mid-scan, so
-# we use scan 3 instead.
-
-# The phase has already been calibrated by the delay engine and is stable enough
-# over a 20 minute interval, so we don't need to calibrate it. Amplitudes are
-# somewhat dissimilar over all the antennas, so we perform an amplitude
-# calibration before the bandpass.
-
-rmtables('uvh5_60247.G0')
-gaincal(vis=vis, caltable='uvh5_60247.G0',
-        refant=REFANT, refantmode='strict',
-        scan='2', solint='inf', calmode='a')
-
-# Get a gain calibration for the other source, for gain cal with Stokes later
-gaincal(vis=vis, caltable='uvh5_60247_1256_057.G0',
-        refant=REFANT, refantmode='strict',
-        scan='3', solint='inf', calmode='a')
-
-# This may fail--get bandpass solution with bright calibrator, pol with other
-rmtables('uvh5_60247.B0')
-bandpass(vis=vis, caltable='uvh5_60247.B0',
-         refant=REFANT,
-         scan='2', solint='inf',
-         bandtype='B', gaintable=['uvh5_60247.G0'])
-
-# Complex gain calibration for 1256_057
-#
-# This absorbs the polarization signature on the parallel-hands
-
-rmtables('uvh5_60247_1256_057.field0.G1')
-gaincal(vis=vis, caltable='uvh5_60247_1256_057.field1.G1',
-        refant=REFANT, refantmode='strict', solint='300',
-        calmode='ap', field='1',
-        gaintable=['uvh5_60247.B0', 'uvh5_60247_1256_057.G0'])
-
-# Estimate of QU from parallel-hands amplitude (contained in the cal table)
-
-qu_field1 = polfromgain(vis=vis, tablein='uvh5_60247_1256_057.field1.G1')
-
-# New complex gain calibration for 1256-057 using Stokes parameters estimated from
-# gain amplitudes. This does not absorb the polarization signature.
-
-rmtables('uvh5_60247_1256_057.field1.G2')
-gaincal(vis=vis, caltable='uvh5_60247_1256_057.field1.G2',
-        refant=REFANT, refantmode='strict', solint='300',
-        calmode='ap', field='1', smodel=qu_field1['1256-057']['Spw1'],
-        parang=True,
-        gaintable=['uvh5_60247.B0', 'uvh5_60247_1256_057.G0'])
-
-# By looking at the XX and YY amplitudes once B0, G0, G2 are applied, we see
-# that in scan 11 the XX and YY amplitudes cross, which means that at that point
-# the polarized signal in the cross-hands is maximum. That is the best scan
-# to examine the cross-hands and calibrate Kcross.
-
-# Spectral window 0 is too tricky to calibrate because there is a lot of RFI
-
-# Spectral window 1 also has some problems. If we do
-#
-# applycal(vis=vis, gaintable=['uvh5_60247.B0', 'uvh5_60247.G0', 'uvh5_60247.field0.G2'],
-#          field='0')
-# plotms(vis=vis, ydatacolumn='corrected', xdatacolumn='corrected',
-#        xaxis='channel', yaxis='phase', avgtime='10000', coloraxis='corr',
-#        iteraxis='scan', avgbaseline=True, field='0', gridcols=4, gridrows=3, spw='1')
-#
-# we see that the lower channels' cross-hands phase is all over the place.
-# For some unknown reason. We ignore the channels below 50 in polarization
-# calibration.
-
-polcal_spw = '1:50~167'
-
-# Cross-hand delay calibration
-#
-# It turns out that the cross-hand delay is on the order of 10 ns, so it needs
-# to be calibrated. (Why is it so large?)
-rmtables('uvh5_60247.Kcross0')
-gaincal(vis=vis, caltable='uvh5_60247_1256_057.Kcross0',
-        scan='10', spw=polcal_spw,
-        gaintype='KCROSS', solint='inf',
-        refant=REFANT, refantmode='strict',
-        smodel=[1,0,1,0],
-        gaintable=['uvh5_60247.B0', 'uvh5_60247_1256_057.G0', 'uvh5_60247_1256_057.field1.G2'],
-        interp=['nearest','nearest', 'nearest'])
-
-# Determination of XY phase offset and source QU
-#
-# Use Stokes parameters from spw1 because it has much less RFI than Spw0
-# (although the two Stokes parameters are very close)
-#
-# Note: the Stokes parameters returned by this are not very good, but
-# the Xparang table looks somewhat reasonable.
-
-rmtables('uvh5_60247.Xfparang')
-S_field1 = polcal(vis=vis, caltable='uvh5_60247_1256_057.Xfparang',
-                  field='1', spw=polcal_spw,
-                  solint='inf', combine='scan', preavg=300,
-                  smodel=qu_field1['1256-057']['Spw1'], poltype='Xfparang+QU',
-                  gaintable=['uvh5_60247.B0', 'uvh5_60247_1256_057.G0', 'uvh5_60247_1256_057.field1.G2',
-                             'uvh5_60247_1256_057.Kcross0'])
-
-# Determination of leakage terms
-#
-# Note: The Stokes parameters coming from polcal() are not good enough to do this.
-# If we use them, the leakage solution gets heavily contaminated by the polarization
-# signature. Instead we use the Stokes parameters from polfromgain().
-
-rmtables('uvh5_60247.D0')
-polcal(vis=vis, caltable='uvh5_60247_1256_057.D0',
-       field='1', spw=polcal_spw,
-       solint='inf', combine='scan', preavg=300,
-       smodel=qu_field1['1256-057']['Spw1'], poltype='Dflls',
-       refant='',
-       gaintable=['uvh5_60247.B0', 'uvh5_60247_1256_057.G0', 'uvh5_60247_1256_057.field1.G2',
-                  'uvh5_60247_1256_057.Kcross0', 'uvh5_60247_1256_057.Xfparang'])
-
-# Try to obtain Stokes parameters from cross-hands again,
-# now with D-terms removed.
-#
-# Note: the results look quite similar to the previous attempt. The
-# returned Stokes parameters are still bad.
-
-rmtables('uvh5_60247.Xfparang1')
-S_field1 = polcal(vis=vis, caltable='uvh5_60247_1256_057.Xfparang1',
-                  field='1', spw=polcal_spw,
-                  solint='inf', combine='scan', preavg=300,
-                  smodel=qu_field1['1256-057']['Spw1'], poltype='Xfparang+QU',
-                  gaintable=['uvh5_60247.B0', 'uvh5_60247_1256_057.G0', 'uvh5_60247_1256_057.field1.G2',
-                             'uvh5_60247_1256_057.Kcross0', 'uvh5_60247_1256_057.D0'])
+if BASELINE_PLOTS:
+    # Phase vs frequency of field 0 in SPW 1 for every baseline, one panel per
+    # scan, from a single averaged read of the DATA column
+    plot_baseline_phases(vis, field='0', spw=1, antenna=antennas, datacolumn='data',
+                         prefix='phase_vs_freq', gridrows=4, gridcols=4)
+
+if PARALLEL_SPW:
+    # The chain below, run for every spectral window in its own process. The
+    # polarization solves use the same channel range in each SPW
+    spw_results = calibrate_by_spw(vis, 'field_pol', 'uvh5_60247', FIELD_POL_TABLES,
+                                   spws=range(NSPW), nproc=SPW_WORKERS,
+                                   source='1256-057', source_tag='1256_057', field='1', refant=REFANT,
+                                   bandpass_scan='2', gain_scan='3', kcross_scan='10', pol_channels='50~167')
+    qu_field1 = merge_stokes_models([r['qu_model'] for r in spw_results.values()])
+    polcal_spw = ','.join(f'{spw}:50~167' for spw in spw_results)
+else:
+    # Bandpass
+    #
+    # Simply use a scan of 3C286, which has more flux than the other source.
+    # In scan 2, the amplitudes in spw1 decrease in a strange way mid-scan, so
+    # we use scan 3 instead.
+
+    # The phase has already been calibrated by the delay engine and is stable enough
+    # over a 20 minute interval, so we don't need to calibrate it. Amplitudes are
+    # somewhat dissimilar over all the antennas, so we perform an amplitude
+    # calibration before the bandpass.
+
+    rmtables('uvh5_60247.G0')
+    gaincal(vis=vis, caltable='uvh5_60247.G0',
+            refant=REFANT, refantmode='strict',
+            scan='2', solint='inf', calmode='a')
+
+    # Get a gain calibration for the other source, for gain cal with Stokes later
+    gaincal(vis=vis, caltable='uvh5_60247_1256_057.G0',
+            refant=REFANT, refantmode='strict',
+            scan='3', solint='inf', calmode='a')
+
+    # This may fail--get bandpass solution with bright calibrator, pol with other
+    rmtables('uvh5_60247.B0')
+    bandpass(vis=vis, caltable='uvh5_60247.B0',
+             refant=REFANT,
+             scan='2', solint='inf',
+             bandtype='B', gaintable=['uvh5_60247.G0'])
+
+    # Complex gain calibration for 1256_057
+    #
+    # This absorbs the polarization signature on the parallel-hands
+
+    rmtables('uvh5_60247_1256_057.field0.G1')
+    gaincal(vis=vis, caltable='uvh5_60247_1256_057.field1.G1',
+            refant=REFANT, refantmode='strict', solint='300',
+            calmode='ap', field='1',
+            gaintable=['uvh5_60247.B0', 'uvh5_60247_1256_057.G0'])
+
+    # Estimate of QU from parallel-hands amplitude (contained in the cal table)
+
+    qu_field1 = polfromgain(vis=vis, tablein='uvh5_60247_1256_057.field1.G1')
+
+    # New complex gain calibration for 1256-057 using Stokes parameters estimated from
+    # gain amplitudes. This does not absorb the polarization signature.
+
+    rmtables('uvh5_60247_1256_057.field1.G2')
+    gaincal(vis=vis, caltable='uvh5_60247_1256_057.field1.G2',
+            refant=REFANT, refantmode='strict', solint='300',
+            calmode='ap', field='1', smodel=qu_field1['1256-057']['Spw1'],
+            parang=True,
+            gaintable=['uvh5_60247.B0', 'uvh5_60247_1256_057.G0'])
+
+    # By looking at the XX and YY amplitudes once B0, G0, G2 are applied, we see
+    # that in scan 11 the XX and YY amplitudes cross, which means that at that point
+    # the polarized signal in the cross-hands is maximum. That is the best scan
+    # to examine the cross-hands and calibrate Kcross.
+
+    # Spectral window 0 is too tricky to calibrate because there is a lot of RFI
+
+    # Spectral window 1 also has some problems. If we do
+    #
+    # applycal(vis=vis, gaintable=['uvh5_60247.B0', 'uvh5_60247.G0', 'uvh5_60247.field0.G2'],
+    #          field='0')
+    # plotms(vis=vis, ydatacolumn='corrected', xdatacolumn='corrected',
+    #        xaxis='channel', yaxis='phase', avgtime='10000', coloraxis='corr',
+    #        iteraxis='scan', avgbaseline=True, field='0', gridcols=4, gridrows=3, spw='1')
+    #
+    # we see that the lower channels' cross-hands phase is all over the place.
+    # For some unknown reason. We ignore the channels below 50 in polarization
+    # calibration.
+
+    polcal_spw = '1:50~167'
+
+    # Cross-hand delay calibration
+    #
+    # It turns out that the cross-hand delay is on the order of 10 ns, so it needs
+    # to be calibrated. (Why is it so large?)
+    rmtables('uvh5_60247.Kcross0')
+    gaincal(vis=vis, caltable='uvh5_60247_1256_057.Kcross0',
+            scan='10', spw=polcal_spw,
+            gaintype='KCROSS', solint='inf',
+            refant=REFANT, refantmode='strict',
+            smodel=[1,0,1,0],
+            gaintable=['uvh5_60247.B0', 'uvh5_60247_1256_057.G0', 'uvh5_60247_1256_057.field1.G2'],
+            interp=['nearest','nearest', 'nearest'])
+
+    # Determination of XY phase offset and source QU
+    #
+    # Use Stokes parameters from spw1 because it has much less RFI than Spw0
+    # (although the two Stokes parameters are very close)
+    #
+    # Note: the Stokes parameters returned by this are not very good, but
+    # the Xparang table looks somewhat reasonable.
+
+    rmtables('uvh5_60247.Xfparang')
+    S_field1 = polcal(vis=vis, caltable='uvh5_60247_1256_057.Xfparang',
+                      field='1', spw=polcal_spw,
+                      solint='inf', combine='scan', preavg=300,
+                      smodel=qu_field1['1256-057']['Spw1'], poltype='Xfparang+QU',
+                      gaintable=['uvh5_60247.B0', 'uvh5_60247_1256_057.G0', 'uvh5_60247_1256_057.field1.G2',
+                                 'uvh5_60247_1256_057.Kcross0'])
+
+    # Determination of leakage terms
+    #
+    # Note: The Stokes parameters coming from polcal() are not good enough to do this.
+    # If we use them, the leakage solution gets heavily contaminated by the polarization
+    # signature. Instead we use the Stokes parameters from polfromgain().
+
+    rmtables('uvh5_60247.D0')
+    polcal(vis=vis, caltable='uvh5_60247_1256_057.D0',
+           field='1', spw=polcal_spw,
+           solint='inf', combine='scan', preavg=300,
+           smodel=qu_field1['1256-057']['Spw1'], poltype='Dflls',
+           refant='',
+           gaintable=['uvh5_60247.B0', 'uvh5_60247_1256_057.G0', 'uvh5_60247_1256_057.field1.G2',
+                      'uvh5_60247_1256_057.Kcross0', 'uvh5_60247_1256_057.Xfparang'])
+
+    # Try to obtain Stokes parameters from cross-hands again,
+    # now with D-terms removed.
+    #
+    # Note: the results look quite similar to the previous attempt. The
+    # returned Stokes parameters are still bad.
+
+    rmtables('uvh5_60247.Xfparang1')
+    S_field1 = polcal(vis=vis, caltable='uvh5_60247_1256_057.Xfparang1',
+                      field='1', spw=polcal_spw,
+                      solint='inf', combine='scan', preavg=300,
+                      smodel=qu_field1['1256-057']['Spw1'], poltype='Xfparang+QU',
+                      gaintable=['uvh5_60247.B0', 'uvh5_60247_1256_057.G0', 'uvh5_60247_1256_057.field1.G2',
+                                 'uvh5_60247_1256_057.Kcross0', 'uvh5_60247_1256_057.D0'])
 
 # Apply calibrations for evaluation
 
@@ -218,35 +230,26 @@ plotms(vis=vis, xdatacolumn='corrected', ydatacolumn='corrected',
        avgtime='100000', avgscan=True, avgchannel='168', spw=polcal_spw,
        plotfile='1256-057_parang_corrected_reim.png')
 
-# Calibration table plots
+# Calibration table plots, read once per table and drawn with matplotlib in parallel
 
+plots = []
 for ax in ['amp', 'phase']:
-    plotms(vis=f'uvh5_60247_1256_057.B0', xaxis='freq', yaxis=f'gain{ax}',
-           coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
-           yselfscale=True, antenna=antenna_list, spw='1',
-           plotfile=f'B0_{ax}.png', overwrite=True)
+    plots.append(caltable_plot(f'uvh5_60247_1256_057.B0', 'freq', f'gain{ax}', f'B0_{ax}.png',
+                               iteraxis='antenna', antenna=antennas, spw='1'))
 
-plotms(vis='uvh5_60247_1256_057.G0', xaxis='antenna1', yaxis='gainamp',
-       coloraxis='corr', antenna=antenna_list, spw='1',
-       plotfile='G0_amp.png', overwrite=True)
+plots.append(caltable_plot('uvh5_60247_1256_057.G0', 'antenna1', 'gainamp', 'G0_amp.png', antenna=antennas, spw='1'))
 
 for j in [1, 2]:
     for ax in ['amp', 'phase']:
-        plotms(vis=f'uvh5_60247_1256_057.field1.G{j}', xaxis='time', yaxis=f'gain{ax}',
-               coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
-               yselfscale=True, antenna=antenna_list, spw='1',
-               plotfile=f'G{j}_field1_{ax}.png', overwrite=True)
+        plots.append(caltable_plot(f'uvh5_60247_1256_057.field1.G{j}', 'time', f'gain{ax}', f'G{j}_field1_{ax}.png',
+                                   iteraxis='antenna', antenna=antennas, spw='1'))
 
-plotms(vis='uvh5_60247_1256_057.Kcross0', yaxis='delay', spw='1',
-       antenna=REFANT, coloraxis='corr',
-       plotfile=f'Kcross0.png', overwrite=True)
+plots.append(caltable_plot('uvh5_60247_1256_057.Kcross0', 'time', 'delay', f'Kcross0.png', antenna=[REFANT], spw='1'))
 
 for xf in ['Xfparang', 'Xfparang1']:
-    plotms(vis=f'uvh5_60247_1256_057.{xf}', xaxis='freq', yaxis='gainphase',
-           plotfile=f'{xf}.png', overwrite=True)
+    plots.append(caltable_plot(f'uvh5_60247_1256_057.{xf}', 'freq', 'gainphase', f'{xf}.png'))
 
 for ax in ['real', 'imag']:
-    plotms(vis='uvh5_60247_1256_057.D0', xaxis='freq', yaxis=ax,
-           coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
-           yselfscale=True, antenna=antenna_list,
-           plotfile=f'D0_{ax}.png', overwrite=True)
+    plots.append(caltable_plot('uvh5_60247_1256_057.D0', 'freq', ax, f'D0_{ax}.png', iteraxis='antenna', antenna=antennas))
+
+render_caltable_plots(plots)
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+#############################################################################
+# Local calibrator catalog with a spatial index
+#############################################################################
+
+# The planners resolved every calibrator through ATATools.ata_sources, a
+# remote lookup on each interaction. This catalog is a CSV file on disk
+# (calibrators.csv next to this file, or $ATA_CALIBRATOR_CATALOG) holding
+# name, J2000 position and aliases. Names and aliases are looked up in a
+# dict. Positions are stored as unit vectors in a KD-tree (scipy's cKDTree,
+# or a brute-force NumPy search without scipy), so nearest-N and
+# within-radius queries take microseconds.
+#
+# The shipped file holds the flux and polarization standards and the ATA's
+# usual phase calibrators. Extend it from the VLA calibrator list, or by
+# resolving names through ATATools once:
+#
+#   python calibrator_catalog.py --import-vla vlacals.txt
+#   python calibrator_catalog.py --resolve 2343+538 2355+498
+#   python calibrator_catalog.py --near 23.39 58.8 -n 5
+#
+# Usage inside a planner:
+#
+#   catalog = CalibratorCatalog.load()
+#   cal = catalog.lookup('3c286')                      # {'name', 'ra', 'dec', 'aliases'}
+#   for cal, sep in catalog.nearest(ra_hours, dec_deg, n=5): ...
+
+import argparse
+import csv
+import os
+import re
+
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+DEFAULT_CATALOG = os.environ.get('ATA_CALIBRATOR_CATALOG',
+                                 os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calibrators.csv'))
+
+FIELDS = ['name', 'ra_hours', 'dec_deg', 'aliases']
+
+# Position line of the VLA calibrator list: name, equinox, position code, RA, Dec, reference, alias
+VLA_LINE = re.compile(r"^(\S+)\s+(J2000|B1950)\s+\S\s+(\d+)h(\d+)m([\d.]+)s\s+([+-]?)(\d+)d(\d+)'([\d.]+)\S*\s*(.*)$")
+
+
+def unit_vectors(ra_hours, dec_deg) -> np.ndarray:
+    '''Unit vectors of J2000 positions, shape (n, 3)'''
+    ra = np.deg2rad(np.asarray(ra_hours, dtype=float) * 15.)
+    dec = np.deg2rad(np.asarray(dec_deg, dtype=float))
+    return np.stack([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)], axis=-1)
+
+
+def _chord(radius_deg: float) -> float:
+    return 2*np.sin(np.deg2rad(radius_deg)/2)
+
+
+def _separation(chord) -> np.ndarray:
+    return np.rad2deg(2*np.arcsin(np.clip(np.asarray(chord)/2, 0., 1.)))
+
+
+class CalibratorCatalog:
+    '''Calibrators by name and alias, with nearest and within-radius position queries'''
+
+    def __init__(self, entries: list):
+        self.entries = entries
+        self._names = {}
+        for index, entry in enumerate(entries):
+            for name in [entry['name']] + entry['aliases']:
+                self._names.setdefault(name.lower(), index)
+        self._vectors = unit_vectors([e['ra'] for e in entries], [e['dec'] for e in entries]).reshape(-1, 3)
+        self._tree = cKDTree(self._vectors) if cKDTree is not None and entries else None
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_CATALOG) -> 'CalibratorCatalog':
+        entries = []
+        with open(path, newline='') as f:
+            for row in csv.DictReader(row for row in f if not row.startswith('#')):
+                entries.append({'name': row['name'], 'ra': float(row['ra_hours']), 'dec': float(row['dec_deg']),
+                                'aliases': [a for a in row['aliases'].split(';') if a]})
+        return cls(entries)
+
+    def save(self, path: str = DEFAULT_CATALOG):
+        with open(path, 'w', newline='') as f:
+            f.write('# J2000 positions; aliases are separated by semicolons\n')
+            writer = csv.DictWriter(f, FIELDS)
+            writer.writeheader()
+            for e in self.entries:
+                writer.writerow({'name': e['name'], 'ra_hours': f"{e['ra']:.7f}", 'dec_deg': f"{e['dec']:.6f}",
+                                 'aliases': ';'.join(e['aliases'])})
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, name: str) -> bool:
+        return isinstance(name, str) and name.lower() in self._names
+
+    def names(self) -> list:
+        return [e['name'] for e in self.entries]
+
+    def lookup(self, name: str) -> dict:
+        '''Entry for a name or alias (case-insensitive); raises KeyError if unknown'''
+        try:
+            return self.entries[self._names[name.lower()]]
+        except KeyError:
+            raise KeyError(f"{name} is not in the calibrator catalog") from None
+
+    def nearest(self, ra_hours: float, dec_deg: float, n: int = 1) -> list:
+        '''The n calibrators closest to a position, as [(entry, separation in degrees), ...]'''
+        n = min(n, len(self.entries))
+        if n == 0:
+            return []
+        point = unit_vectors(ra_hours, dec_deg)
+        if self._tree is not None:
+            chord, index = self._tree.query(point, k=n)
+            chord, index = np.atleast_1d(chord), np.atleast_1d(index)
+        else:
+            chord = np.linalg.norm(self._vectors - point, axis=1)
+            index = np.argpartition(chord, n - 1)[:n]
+            index = index[np.argsort(chord[index])]
+            chord = chord[index]
+        return [(self.entries[i], float(s)) for i, s in zip(index, _separation(chord))]
+
+    def within(self, ra_hours: float, dec_deg: float, radius_deg: float) -> list:
+        '''Calibrators within radius_deg of a position, nearest first, as [(entry, separation), ...]'''
+        point = unit_vectors(ra_hours, dec_deg)
+        if self._tree is not None:
+            index = np.array(self._tree.query_ball_point(point, _chord(radius_deg)), dtype=int)
+        else:
+            index = np.flatnonzero(np.linalg.norm(self._vectors - point, axis=1) <= _chord(radius_deg))
+        separation = _separation(np.linalg.norm(self._vectors[index] - point, axis=1))
+        order = np.argsort(separation)
+        return [(self.entries[index[i]], float(separation[i])) for i in order]
+
+    def merge(self, entries: list) -> 'CalibratorCatalog':
+        '''New catalog with entries added; an entry with a name already known replaces it'''
+        replaced = {e['name'].lower() for e in entries}
+        return CalibratorCatalog([e for e in self.entries if e['name'].lower() not in replaced] + list(entries))
+
+
+def read_vla_list(path: str) -> list:
+    '''
+    Entries from the VLA calibrator list. Each J2000 position line starts an
+    entry; the B1950 name and any alias after the position reference
+    (e.g. 3C286) become aliases.
+    '''
+    entries = []
+    with open(path) as f:
+        for line in f:
+            match = VLA_LINE.match(line.strip())
+            if not match:
+                continue
+            name, equinox, rh, rm, rs, sign, dd, dm, ds, rest = match.groups()
+            extra = rest.split()[1:]
+            if equinox == 'J2000':
+                dec = (int(dd) + int(dm)/60 + float(ds)/3600) * (-1 if sign == '-' else 1)
+                entries.append({'name': name, 'ra': int(rh) + int(rm)/60 + float(rs)/3600, 'dec': dec,
+                                'aliases': extra})
+            elif entries:
+                entries[-1]['aliases'] += [name] + extra
+    return entries
+
+
+def resolve_ata(names: list) -> list:
+    '''Entries for names resolved once through ATATools (needs the ATA source service)'''
+    import ATATools.ata_sources as check
+    entries = []
+    for name in names:
+        source = check.check_source(name)
+        entries.append({'name': name, 'ra': float(source['ra']), 'dec': float(source['dec']), 'aliases': []})
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query or extend the local calibrator catalog')
+    parser.add_argument('--catalog', default=DEFAULT_CATALOG, help="Catalog CSV file")
+    parser.add_argument('--import-vla', dest='vla', help="Add every source in a VLA calibrator list file")
+    parser.add_argument('--resolve', nargs='+', default=[], help="Add sources resolved through ATATools")
+    parser.add_argument('--near', nargs=2, type=float, metavar=('RA_HOURS', 'DEC_DEG'),
+                        help="List the calibrators nearest a position")
+    parser.add_argument('-n', type=int, default=5, help="Number of calibrators listed with --near")
+    args = parser.parse_args()
+
+    catalog = CalibratorCatalog.load(args.catalog) if os.path.exists(args.catalog) else CalibratorCatalog([])
+    new = (read_vla_list(args.vla) if args.vla else []) + resolve_ata(args.resolve)
+    if new:
+        catalog = catalog.merge(new)
+        catalog.save(args.catalog)
+        print(f"Added {len(new)} sources; {len(catalog)} in {args.catalog}")
+
+    if args.near:
+        for entry, sep in catalog.nearest(*args.near, n=args.n):
+            print(f"{entry['name']:<12} {entry['ra']:10.5f}h {entry['dec']:+10.5f}d  {sep:7.3f} deg")
+
+
+if __name__ == '__main__':
+    main()
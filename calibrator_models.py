@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+#############################################################################
+# Flux density and polarization models of the standard calibrators
+#############################################################################
+
+# Stokes I uses the Perley & Butler (2017) polynomials in log10(S [Jy])
+# against log10(f [GHz]). Fractional polarization and position angle come
+# from the tables that the MeerKAT pipeline also uses, with all frequencies in
+# GHz. Each table is fitted with a quadratic once, when the module is loaded.
+# Models are evaluated for a whole channel frequency array at once and cached
+# per source and frequency grid, so calling them again for the same SPW costs
+# nothing. J1130-1449 has no flux density model, so its Stokes I is 1 Jy and
+# Q and U are fractional.
+#
+# Usage inside a calibration script:
+#
+#   freqs = channel_frequencies(ms_summary(obs_vis)['spws']['0'])
+#   i, q, u, v = stokes_model('3c286', freqs)          # per channel, Jy
+#   setjy(vis=obs_vis, field='3c286', standard='manual', scalebychan=True,
+#         **setjy_manual_model('3c286', freqs.mean()))
+#   smodel = band_smodel('3c286', freqs)               # [I, Q, U, V] for gaincal/polcal
+#
+# set_model wraps setjy so calibrator models stay virtual: setjy stores the
+# model description in the MS and the solvers evaluate it on the fly, instead
+# of filling a MODEL_DATA column as large as DATA for the whole observation.
+#
+#   set_model(obs_vis, '3c286', standard='Perley-Butler 2017')
+
+import math
+
+import numpy as np
+
+# Canonical name for every alias used in the scripts and catalogues
+ALIASES = {
+    '3c286': ['3c286', '1328+307', '1331+305', 'J1331+3030'],
+    '3c138': ['3c138', '0518+165', '0521+166', 'J0521+1638'],
+    '3c48': ['3c48', '0134+329', '0137+331', 'J0137+3309'],
+    'J1130-1449': ['J1130-1449'],
+}
+_CANONICAL = {alias.lower(): name for name, aliases in ALIASES.items() for alias in aliases}
+
+# Perley & Butler (2017): log10(S) = a0 + a1 x + a2 x^2 + ..., x = log10(f / GHz)
+FLUX_COEFFICIENTS = {
+    '3c286': [1.2481, -0.4507, -0.1798, 0.0357],
+    '3c138': [1.0088, -0.4981, -0.155, -0.010, 0.022],
+    '3c48': [1.3253, -0.7553, -0.1914, 0.0498],
+    'J1130-1449': None,
+}
+
+# Frequency (GHz), fractional linear polarization and position angle (deg)
+POLARIZATION_TABLES = {
+    '3c286': ([1.02, 1.47, 1.87, 2.57, 3.57, 4.89, 6.68, 8.43, 11.3],
+              [0.086, 0.098, 0.101, 0.106, 0.112, 0.115, 0.119, 0.121, 0.123],
+              [33.0]*8 + [34.0]),
+    '3c138': ([1.05, 1.45, 1.64, 1.95, 2.45, 2.95, 3.25],
+              [0.056, 0.075, 0.084, 0.09, 0.104, 0.107, 0.10],
+              [-14.0, -11.0, -10.0, -10.0, -10.0, -10.0, -10.0]),
+    '3c48': ([1.05, 1.45, 1.64], [0.003, 0.005, 0.007], [25, 140, -5]),
+    # Manual model from Russ Taylor, taken from the MeerKAT polarisation calibrator project
+    'J1130-1449': ([1.05, 1.45, 1.64], [0.038, 0.050, 0.056], [145, 66, 45]),
+}
+
+# Quadratic fits against frequency in GHz, highest power first (np.polyval order)
+POLARIZATION_COEFFICIENTS = {
+    name: (np.polyfit(f, frac, deg=2), np.polyfit(f, pa, deg=2))
+    for name, (f, frac, pa) in POLARIZATION_TABLES.items()
+}
+
+_model_cache = {}
+
+
+def set_model(vis: str, field: str, virtual: bool = True, **setjy_args):
+    '''
+    setjy for field, with the model kept virtual unless virtual is False.
+    A MODEL_DATA column left by an earlier usescratch=True run takes
+    precedence over virtual models, so it is removed first.
+    '''
+    from casatasks import setjy
+    from casatools import table
+    if virtual:
+        tb = table()
+        tb.open(vis, nomodify=False)
+        if 'MODEL_DATA' in tb.colnames():
+            print(f"Removing MODEL_DATA from {vis} in favour of virtual models")
+            tb.removecols(['MODEL_DATA'])
+        tb.close()
+    return setjy(vis=vis, field=field, usescratch=not virtual, **setjy_args)
+
+
+def canonical_name(source: str) -> str:
+    try:
+        return _CANONICAL[source.lower()]
+    except KeyError:
+        raise ValueError(f"No calibrator model for {source}; known sources are {sorted(ALIASES)}") from None
+
+
+def channel_frequencies(spw: dict) -> np.ndarray:
+    '''Channel frequencies (GHz, ascending) of an ms_summary spectral window entry'''
+    return np.linspace(spw['min_freq'], spw['max_freq'], spw['nchan']) / 1e9
+
+
+def stokes_model(source: str, freq) -> np.ndarray:
+    '''
+    Stokes I, Q, U and V (Jy) of source at each frequency in freq (GHz), as
+    an array of shape (4, nchan). Results are cached per frequency grid.
+    '''
+    name = canonical_name(source)
+    freq = np.ascontiguousarray(freq, dtype=float)
+    key = (name, freq.shape, freq.tobytes())
+    if key not in _model_cache:
+        flux = FLUX_COEFFICIENTS[name]
+        if flux is None:
+            i = np.ones_like(freq)
+        else:
+            i = 10**np.polynomial.polynomial.polyval(np.log10(freq), flux)
+        frac_coeffs, pa_coeffs = POLARIZATION_COEFFICIENTS[name]
+        p = np.polyval(frac_coeffs, freq) * i
+        chi = 2*np.deg2rad(np.polyval(pa_coeffs, freq))
+        model = np.stack([i, p*np.cos(chi), p*np.sin(chi), np.zeros_like(freq)])
+        model.setflags(write=False)
+        _model_cache[key] = model
+    return _model_cache[key]
+
+
+def fractional_qu(source: str, freq) -> tuple:
+    '''Fractional Q and U of source at freq (GHz, scalar or array)'''
+    i, q, u, _ = stokes_model(source, np.atleast_1d(freq))
+    q, u = q / i, u / i
+    return (q[0], u[0]) if np.ndim(freq) == 0 else (q, u)
+
+
+def band_smodel(source: str, freq) -> list:
+    '''Band-averaged [I, Q, U, V] of source over freq (GHz), for the smodel of gaincal and polcal'''
+    return [float(s) for s in stokes_model(source, freq).mean(axis=1)]
+
+
+def setjy_manual_model(source: str, reffreq: float) -> dict:
+    '''
+    setjy arguments for standard='manual' reproducing the model around
+    reffreq (GHz): the Stokes I polynomial re-expanded as spix terms in
+    ln(f / reffreq), and the fractional polarization and angle (radians)
+    as polynomials in (f - reffreq) / reffreq.
+    '''
+    name = canonical_name(source)
+    flux = FLUX_COEFFICIENTS[name]
+    x0 = np.log10(reffreq)
+    if flux is None:
+        fluxdensity, spix = 1., [0.]
+    else:
+        # Taylor coefficients of log10(S) around x0; S/S0 = (f/f0)^(spix0 + spix1 ln(f/f0) + ...)
+        poly = np.polynomial.Polynomial(flux)
+        taylor = [poly.deriv(k)(x0) / math.factorial(k) for k in range(1, len(flux))]
+        fluxdensity = float(10**poly(x0))
+        spix = [float(c / np.log(10)**k) for k, c in enumerate(taylor)]
+
+    # Substitute f = reffreq * (1 + t) into the frequency polynomials
+    frac_coeffs, pa_coeffs = POLARIZATION_COEFFICIENTS[name]
+    t = np.poly1d([reffreq, reffreq])
+    polindex = np.poly1d(frac_coeffs)(t).coeffs[::-1]
+    polangle = np.deg2rad(np.poly1d(pa_coeffs)(t).coeffs[::-1])
+    return {'fluxdensity': [fluxdensity, 0., 0., 0.], 'spix': spix, 'reffreq': f'{reffreq}GHz',
+            'polindex': [float(c) for c in polindex], 'polangle': [float(c) for c in polangle], 'rotmeas': 0}
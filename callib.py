@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+#############################################################################
+# Calibration library (callib) files
+#############################################################################
+
+# Applying calibration field by field means one applycal, and one pass over
+# the MS, per group of fields, each with its own gaintable/gainfield/interp
+# lists. A cal library holds the whole per-field mapping in one text file, so
+# a single applycal(docallib=True) calibrates every field. Without parallactic
+# angle correction, mstransform can also apply it on the fly while writing
+# the calibrated MS, so no CORRECTED_DATA column is written at all.
+#
+# Usage inside a calibration script:
+#
+#   field_tables = {bandpass_calibrator: [(f'{tab_name}.K0', bandpass_calibrator, 'nearest'), ...],
+#                   target: [...]}
+#   write_callib(f'{tab_name}.callib.txt', field_tables)
+#   apply_callib(obs_vis, f'{tab_name}.callib.txt', f'{tab_name}_calibrated.ms', field=','.join(field_tables))
+
+import shutil
+
+
+def callib_line(caltable: str, field: str = '', gainfield: str = '', interp: str = '', calwt: bool = False) -> str:
+    '''
+    One cal library entry. gainfield and interp take the same values as in
+    applycal ('linear,linearflag' is time, then frequency interpolation).
+    '''
+    tinterp, _, finterp = interp.partition(',')
+    params = {'caltable': caltable, 'calwt': calwt, 'field': field, 'fldmap': gainfield,
+              'tinterp': tinterp, 'finterp': finterp}
+    return ' '.join(f'{key}={value!r}' for key, value in params.items() if value != '')
+
+
+def write_callib(path: str, field_tables: dict) -> str:
+    '''
+    Write a cal library from {field: [(caltable, gainfield, interp), ...]};
+    each field gets exactly the tables listed for it. Returns path.
+    '''
+    lines = [callib_line(caltable, field=field, gainfield=gainfield, interp=interp)
+             for field, tables in field_tables.items() for caltable, gainfield, interp in tables]
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return path
+
+
+def apply_callib(vis: str, callib: str, outputvis: str, field: str = '', parang: bool = True,
+                 on_the_fly: bool = False):
+    '''
+    Calibrate vis with a cal library and write the calibrated data to outputvis.
+    By default this is one applycal pass followed by split (skipped if
+    outputvis is empty, leaving the result in CORRECTED_DATA); with on_the_fly
+    the calibration is applied by mstransform as it writes outputvis.
+    '''
+    from casatasks import applycal, mstransform, split
+    if outputvis:
+        shutil.rmtree(outputvis, ignore_errors=True)
+    if on_the_fly:
+        if parang:
+            raise ValueError("On-the-fly calibration cannot apply the parallactic angle correction; "
+                             "use on_the_fly=False when parang=True")
+        mstransform(vis=vis, outputvis=outputvis, field=field, docallib=True, callib=callib,
+                    datacolumn='corrected')
+        return
+
+    applycal(vis=vis, field=field, docallib=True, callib=callib, parang=parang)
+    if outputvis:
+        split(vis=vis, outputvis=outputvis, field=field, datacolumn='corrected')
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+#############################################################################
+# Caltable plots with matplotlib
+#############################################################################
+
+# Replaces the plotms calls on G/B/K/Kcross/Xfparang/D tables. Each caltable
+# is read once into NumPy arrays and every plot requested from it is drawn
+# with matplotlib (Agg); tables are handled in parallel worker processes.
+# Axis names follow plotms: xaxis 'time', 'freq' or 'antenna1'; yaxis
+# 'gainamp', 'gainphase', 'real', 'imag' or 'delay'; iteraxis 'antenna'
+# gives one panel per antenna on a gridrows x gridcols page. yrange fixes the
+# y limits of every panel, like the y half of plotms' plotrange.
+#
+# Usage inside a calibration script:
+#
+#   plots = [caltable_plot(f'{tab_name}.B0', 'freq', f'gain{ax}', f'B0_{tab_name}_{ax}.png',
+#                          iteraxis='antenna', antenna=antennas, spw='0') for ax in ['amp', 'phase']]
+#   render_caltable_plots(plots)
+
+import os
+from collections import defaultdict
+
+import numpy as np
+
+from workers import load_job, run_modules
+
+CORR_COLOURS = ['tab:blue', 'tab:orange', 'tab:green', 'tab:red']
+
+
+def caltable_plot(table: str, xaxis: str, yaxis: str, plotfile: str, iteraxis: str = '', antenna: list = None,
+                  spw: str = '', gridrows: int = 4, gridcols: int = 5, yselfscale: bool = True,
+                  yrange: list = None) -> dict:
+    '''Description of one plot of a caltable, in plotms terms; yrange is [ymin, ymax]'''
+    return {'table': table, 'xaxis': xaxis, 'yaxis': yaxis, 'plotfile': plotfile, 'iteraxis': iteraxis,
+            'antenna': list(antenna or []), 'spw': spw, 'gridrows': gridrows, 'gridcols': gridcols,
+            'yselfscale': yselfscale, 'yrange': list(yrange) if yrange else None}
+
+
+def read_caltable(path: str) -> dict:
+    '''Read a caltable into per-SPW arrays: time, antenna, solutions (npol, nchan, nrow), flags, frequencies'''
+    from casatools import table
+    tb = table()
+
+    tb.open(os.path.join(path, 'ANTENNA'))
+    antenna_names = list(tb.getcol('NAME'))
+    tb.close()
+
+    tb.open(os.path.join(path, 'SPECTRAL_WINDOW'))
+    chan_freq = [tb.getcell('CHAN_FREQ', spw) for spw in range(tb.nrows())]
+    tb.close()
+
+    tb.open(path)
+    param = 'CPARAM' if 'CPARAM' in tb.colnames() else 'FPARAM'
+    spws = {}
+    # Channel counts can differ between SPWs, so read each one separately
+    for spw in np.unique(tb.getcol('SPECTRAL_WINDOW_ID')):
+        sub = tb.query(f'SPECTRAL_WINDOW_ID=={spw}')
+        spws[int(spw)] = {
+            'time': sub.getcol('TIME'),
+            'antenna': sub.getcol('ANTENNA1'),
+            'param': sub.getcol(param),
+            'flag': sub.getcol('FLAG'),
+            'freq': chan_freq[spw] / 1e9,
+        }
+        sub.close()
+    tb.close()
+    return {'antenna_names': antenna_names, 'complex': param == 'CPARAM', 'spws': spws}
+
+
+def _antenna_ids(names: list, selection: list) -> list:
+    '''Antenna ids for a list of names (or ids given as strings); everything if the list is empty'''
+    if not selection:
+        return list(range(len(names)))
+    ids = []
+    for a in selection:
+        a = str(a).strip('"')
+        if a in names:
+            ids.append(names.index(a))
+        elif a.isdigit():
+            ids.append(int(a))
+    return ids
+
+
+def _y_values(values, yaxis: str, is_complex: bool):
+    kind = yaxis.replace('gain', '')
+    if not is_complex:
+        return values.real
+    if kind == 'amp':
+        return np.abs(values)
+    if kind == 'phase':
+        return np.rad2deg(np.angle(values))
+    if kind == 'real':
+        return values.real
+    if kind == 'imag':
+        return values.imag
+    raise ValueError(f"Unsupported yaxis {yaxis} for a complex caltable")
+
+
+def _draw(ax, data: dict, spws: list, antennas: list, plot: dict, t0: float):
+    '''Scatter every correlation of the selected SPWs and antennas into ax'''
+    for spw in spws:
+        d = data['spws'][spw]
+        rows = np.isin(d['antenna'], antennas)
+        if not rows.any():
+            continue
+        values = _y_values(d['param'][:, :, rows], plot['yaxis'], data['complex'])
+        flags = d['flag'][:, :, rows]
+        npol, nchan, nrow = values.shape
+        if plot['xaxis'] == 'freq':
+            x = np.broadcast_to(d['freq'][:nchan, None], (nchan, nrow))
+        elif plot['xaxis'] == 'time':
+            x = np.broadcast_to((d['time'][rows] - t0) / 3600., (nchan, nrow))
+        else:
+            x = np.broadcast_to(d['antenna'][rows].astype(float), (nchan, nrow))
+        for corr in range(npol):
+            good = ~flags[corr]
+            ax.plot(x[good], values[corr][good], '.', ms=2, color=CORR_COLOURS[corr % 4],
+                    label=f'corr {corr}' if spw == spws[0] else None)
+
+
+def render_plot(data: dict, plot: dict):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    spws = sorted(data['spws']) if plot['spw'] == '' else [int(s) for s in str(plot['spw']).split(',')]
+    spws = [s for s in spws if s in data['spws']]
+    antennas = _antenna_ids(data['antenna_names'], plot['antenna'])
+    t0 = min(data['spws'][s]['time'].min() for s in spws) if spws else 0.
+    xlabel = {'time': 'Time since start (h)', 'freq': 'Frequency (GHz)', 'antenna1': 'Antenna'}[plot['xaxis']]
+    ylabel = plot['yaxis'] + (' (ns)' if plot['yaxis'] == 'delay' else ' (deg)' if 'phase' in plot['yaxis'] else '')
+
+    if plot['iteraxis'] != 'antenna':
+        fig, ax = plt.subplots(figsize=(8, 6))
+        _draw(ax, data, spws, antennas, plot, t0)
+        if plot['yrange']:
+            ax.set_ylim(*plot['yrange'])
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel(ylabel)
+        ax.set_title(os.path.basename(plot['table']))
+        ax.legend(loc='best', markerscale=4)
+        fig.savefig(plot['plotfile'], dpi=100)
+        plt.close(fig)
+        return
+
+    per_page = plot['gridrows'] * plot['gridcols']
+    for page, start in enumerate(range(0, len(antennas), per_page)):
+        fig, axes = plt.subplots(plot['gridrows'], plot['gridcols'], sharex=True, sharey=not plot['yselfscale'],
+                                 figsize=(3 * plot['gridcols'], 2.4 * plot['gridrows']), squeeze=False)
+        page_antennas = antennas[start:start + per_page]
+        for i, (ax, ant) in enumerate(zip(axes.flat, page_antennas)):
+            _draw(ax, data, spws, [ant], plot, t0)
+            if plot['yrange']:
+                ax.set_ylim(*plot['yrange'])
+            ax.set_title(data['antenna_names'][ant], fontsize=9)
+            # Lowest panel in each column keeps its tick labels when the last row is partly empty
+            if i + plot['gridcols'] >= len(page_antennas):
+                ax.tick_params(labelbottom=True)
+        for ax in axes.flat[len(page_antennas):]:
+            ax.set_visible(False)
+        fig.supxlabel(xlabel)
+        fig.supylabel(ylabel)
+        fig.suptitle(os.path.basename(plot['table']))
+        fig.tight_layout()
+        # Extra pages are numbered like plotms does
+        root, ext = os.path.splitext(plot['plotfile'])
+        fig.savefig(plot['plotfile'] if page == 0 else f'{root}_{page + 1}{ext}', dpi=100)
+        plt.close(fig)
+
+
+def render_table_plots(table: str, plots: list):
+    '''Read one caltable and draw all of its plots'''
+    data = read_caltable(table)
+    for plot in plots:
+        render_plot(data, plot)
+
+
+def render_caltable_plots(plots: list, nproc: int = 0) -> list:
+    '''Draw plots, one worker per caltable; returns the plot files of tables that failed'''
+    by_table = defaultdict(list)
+    for plot in plots:
+        if os.path.isdir(plot['table']):
+            by_table[plot['table']].append(plot)
+        else:
+            print(f"Skipping plots of missing caltable {plot['table']}")
+
+    jobs = {f"{os.path.basename(table.rstrip('/'))}.plots": {'table': table, 'plots': table_plots}
+            for table, table_plots in by_table.items()}
+    finished = run_modules('caltable_plots', jobs, nproc=nproc)
+    return [plot['plotfile'] for name, job in jobs.items() if name not in finished for plot in job['plots']]
+
+
+if __name__ == '__main__':
+    # Worker process started by run_module
+    job = load_job()
+    render_table_plots(job['table'], job['plots'])
@@ -12,6 +12,12 @@ import os, sys
 import glob
 import subprocess
 
+# Helper modules live alongside these scripts; set ATA_POL_SCRIPTS when running
+# from a data directory
+script_dir = os.path.dirname(os.path.abspath(__file__)) if '__file__' in globals() else os.getcwd()
+sys.path.insert(0, os.environ.get('ATA_POL_SCRIPTS', script_dir))
+from calibrator_models import set_model
+
 # Fields for user to edit per-observation
 bcal = '3c147'
 pcal = '2343+538'
@@ -24,6 +30,7 @@ obs_vis = 'CasA_polcal.ms'
 use_3c286 = True
 generate_plots = True
 iterate_calibration = False
+virtual_models = True      # Calibrator models evaluated on the fly instead of written to MODEL_DATA
 
 tab_name = obs_vis.split('.')[0]
 
@@ -45,7 +52,7 @@ antenna_list = ','.join([f'"{a}"' for a in antennas])
 # flagdata(vis=vis, mode='manual', scan='28', flagbackup=False)
 
 # Set flux model for flux calibrator 
-setjy(vis=obs_vis, field=bcal, standard='Perley-Butler 2017', usescratch=True)
+set_model(obs_vis, bcal, virtual=virtual_models, standard='Perley-Butler 2017')
 
 # Listobs
 listobs(vis=obs_vis)
@@ -205,7 +212,7 @@ if use_3c286:
 
 else:
         # Set flux model for phase calibrator
-        setjy(vis=obs_vis, field=pcal, standard='Perley-Butler 2017', usescratch=True)
+        set_model(obs_vis, pcal, virtual=virtual_models, standard='Perley-Butler 2017')
         
         # Kcross
         gaincal(vis=obs_vis, caltable=f'{tab_name}_pol.Kcross0', spw=spw, refant=ref_ant, solint='inf', 
@@ -20,6 +20,18 @@ import glob
 import subprocess
 import numpy as np
 
+# Helper modules live alongside these scripts; set ATA_POL_SCRIPTS when running
+# from a data directory
+script_dir = os.path.dirname(os.path.abspath(__file__)) if '__file__' in globals() else os.getcwd()
+sys.path.insert(0, os.environ.get('ATA_POL_SCRIPTS', script_dir))
+from run_manifest import RunManifest
+from ms_metadata import cached_listobs, cell_size, ms_summary
+from imaging import calibrator_job, run_imaging_jobs, target_job
+from flagging import apply_flags, flag_commands
+from field_split import split_fields
+from polcal_iteration import iterate_polarization_calibration
+from calibrator_models import set_model
+
 # Fields for user to edit per-observation
 # bcal = '3c147'
 # pcal = '2343+538'
@@ -37,6 +49,12 @@ obs_vis = '3c391_obs.ms'
 use_3c286 = False
 generate_plots = True
 iterate_calibration = False
+max_iterations = 5                # Polarization calibration passes at most when iterating
+iteration_tolerances = {}         # Overrides of polcal_iteration.TOLERANCES (dterm, xy_phase, qu)
+resume_run = True                 # Skip stages already recorded as complete in the run manifest
+bad_antennas = ['1b', '1e']       # Flagged outright
+autoflag_fields = [target]        # Fields flagged with tfcrop and rflag
+virtual_models = True             # Calibrator models evaluated on the fly instead of written to MODEL_DATA
 
 tab_name = obs_vis.split('.')[0]
 
@@ -47,127 +65,140 @@ antennas = ['1b', '1c', '1e', '1g', '1h', '1k',
             '3d', '3l', '4e', '4j', '5e']
 antenna_list = ','.join([f'"{a}"' for a in antennas])
 
+# Completed stages are recorded so a crashed run restarts at the first incomplete one
+manifest = RunManifest(f'{tab_name}.manifest.json', resume=resume_run)
+
 #############################################
 
 # Begin standard calibration
 
 #############################################
 
-# Flagging: script assumes pre-flagging using aoflagger.
-## If manual flagging desired, uncomment the below and edit to suit
-flagdata(vis=obs_vis, mode='manual', antenna="'1b'", flagbackup=False)
-flagdata(vis=obs_vis, mode='manual', antenna="'1e'", flagbackup=False)
-flagdata(vis=obs_vis, field=target, mode='tfcrop', datacolumn='DATA')
-flagdata(vis=obs_vis, field=target, mode='rflag', datacolumn='DATA')
-
-# Set flux model for flux calibrator 
-setjy(vis=obs_vis, field=bcal, standard='Perley-Butler 2017', usescratch=True)
-
-# Listobs
-listobs(vis=obs_vis)
-
-# Preliminary gaincal
-# This will be thrown away after solving for delay and bandpass
-gaincal(vis=obs_vis, caltable=f'{tab_name}.G0', field=bcal, spw='0', refant=ref_ant, refantmode='strict', calmode='p', 
-        solint='inf', parang=True)
-gaincal(vis=obs_vis, caltable=f'{tab_name}.G1', field=bcal, spw='0', refant=ref_ant, refantmode='strict', calmode='a', 
-        solint='100', preavg=1, minblperant=1, minsnr=0, gaintype='G', gaintable=[f'{tab_name}.G0'], parang=True)
-
-if generate_plots:
-        # Plot preliminary gain amplitudes
-        plotms(vis=f'{tab_name}.G0', xaxis='antenna1', yaxis='gainphase',
-        coloraxis='corr', antenna=antenna_list, spw='0',
-        plotfile=f'G1_{tab_name}_phase.png', overwrite=True)
-        # Plot preliminary gain phases
-        plotms(vis=f'{tab_name}.G1', xaxis='antenna1', yaxis='gainamp',
-        coloraxis='corr', antenna=antenna_list, spw='0',
-        plotfile=f'G0_{tab_name}_amp.png', overwrite=True)
-
-# Delay calibration
-gaincal(vis=obs_vis, caltable=f'{tab_name}.K0', field=bcal, spw='0', refant=ref_ant, solint='inf', combine='scan', 
-        preavg=1, minblperant=1, gaintype='K', gaintable=[f'{tab_name}.G0', f'{tab_name}.G1'], parang=True)
-
-# Bandpass
-# NOTE: low freq spectral windows so we'll use a small averaging window, may be appropriate to allow edit
-bandpass(vis=obs_vis, caltable=f'{tab_name}.B0', field=bcal, spw='0', refant=ref_ant,
-         bandtype='B', gaintable=[f'{tab_name}.G0', f'{tab_name}.G1', f'{tab_name}.K0'], parang=True)
-
-if generate_plots:
-        # Bandpass solutions, frequency vs amplitude and phase
-        for ax in ['amp', 'phase']:
-                plotms(vis=f'{tab_name}.B0', xaxis='freq', yaxis=f'gain{ax}',
-                coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
-                yselfscale=True, antenna=antenna_list, spw='0',
-                plotfile=f'B0_{tab_name}_{ax}.png', overwrite=True)
-
-# Secondary gaincal after solving for delay and bandpass
-# Use both flux calibrator and phase/linear pol calibraton
-gaincal(vis=obs_vis, caltable=f'{tab_name}.G2', field=bcal, spw='0', refant=ref_ant, calmode='ap', solint='300', 
-        gaintable=[f'{tab_name}.K0', f'{tab_name}.B0'], parang=True)
-if use_3c286:
-        gaincal(vis=obs_vis, caltable=f'{tab_name}.G3', field=pcal, spw='0', refant=ref_ant, calmode='ap', solint='300', 
-                gaintable=[f'{tab_name}.K0', f'{tab_name}.B0', f'{tab_name}.G2'], parang=True)
+if manifest.pending('flagging_and_models'):
+        # Flagging: script assumes pre-flagging using aoflagger.
+        ## Manual and automatic flags are set by bad_antennas and autoflag_fields,
+        ## and run in a single flagdata pass
+        apply_flags(obs_vis, flag_commands(bad_antennas=bad_antennas, autoflag_fields=autoflag_fields))
+
+        # Set flux model for flux calibrator 
+        set_model(obs_vis, bcal, virtual=virtual_models, standard='Perley-Butler 2017')
+
+        # Listobs
+        cached_listobs(obs_vis)
+        manifest.complete('flagging_and_models')
+
+qu_model = {}
+standard_products = [f'{tab_name}.{name}' for name in ['G0', 'G1', 'K0', 'B0', 'G2', 'G3']]
+if not use_3c286:
+        standard_products.append(f'{tab_name}_pol.G3')
+if manifest.pending('standard_calibration', products=standard_products):
+        # Preliminary gaincal
+        # This will be thrown away after solving for delay and bandpass
+        gaincal(vis=obs_vis, caltable=f'{tab_name}.G0', field=bcal, spw='0', refant=ref_ant, refantmode='strict', calmode='p', 
+                solint='inf', parang=True)
+        gaincal(vis=obs_vis, caltable=f'{tab_name}.G1', field=bcal, spw='0', refant=ref_ant, refantmode='strict', calmode='a', 
+                solint='100', preavg=1, minblperant=1, minsnr=0, gaintype='G', gaintable=[f'{tab_name}.G0'], parang=True)
 
         if generate_plots:
-                # For bandpass calibrator, gain amplitude and phase
-                plotms(vis=f'{tab_name}.G2', xaxis='time', yaxis=f'gainamp',
-                        coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
-                        yselfscale=True, antenna=antenna_list, spw='0',
-                        plotfile=f'G2_{bcal}_{tab_name}_amp.png', overwrite=True)
-                plotms(vis=f'{tab_name}.G2', xaxis='time', yaxis=f'gainphase',
-                        coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
-                        yselfscale=True, antenna=antenna_list, spw='0',
-                        plotfile=f'G2_{bcal}_{tab_name}_phase.png', overwrite=True)
+                # Plot preliminary gain amplitudes
+                plotms(vis=f'{tab_name}.G0', xaxis='antenna1', yaxis='gainphase',
+                coloraxis='corr', antenna=antenna_list, spw='0',
+                plotfile=f'G1_{tab_name}_phase.png', overwrite=True)
+                # Plot preliminary gain phases
+                plotms(vis=f'{tab_name}.G1', xaxis='antenna1', yaxis='gainamp',
+                coloraxis='corr', antenna=antenna_list, spw='0',
+                plotfile=f'G0_{tab_name}_amp.png', overwrite=True)
+
+        # Delay calibration
+        gaincal(vis=obs_vis, caltable=f'{tab_name}.K0', field=bcal, spw='0', refant=ref_ant, solint='inf', combine='scan', 
+                preavg=1, minblperant=1, gaintype='K', gaintable=[f'{tab_name}.G0', f'{tab_name}.G1'], parang=True)
+
+        # Bandpass
+        # NOTE: low freq spectral windows so we'll use a small averaging window, may be appropriate to allow edit
+        bandpass(vis=obs_vis, caltable=f'{tab_name}.B0', field=bcal, spw='0', refant=ref_ant,
+                 bandtype='B', gaintable=[f'{tab_name}.G0', f'{tab_name}.G1', f'{tab_name}.K0'], parang=True)
 
-                # For phase calibrator, gain amplitude and phase
-                plotms(vis=f'{tab_name}.G3', xaxis='time', yaxis=f'gainamp',
-                        coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
-                        yselfscale=True, antenna=antenna_list, spw='0',
-                        plotfile=f'G3_{pcal}_{tab_name}_amp.png', overwrite=True)
-                plotms(vis=f'{tab_name}.G3', xaxis='time', yaxis=f'gainphase',
+        if generate_plots:
+                # Bandpass solutions, frequency vs amplitude and phase
+                for ax in ['amp', 'phase']:
+                        plotms(vis=f'{tab_name}.B0', xaxis='freq', yaxis=f'gain{ax}',
                         coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
                         yselfscale=True, antenna=antenna_list, spw='0',
-                        plotfile=f'G3_{pcal}_{tab_name}_phase.png', overwrite=True)
+                        plotfile=f'B0_{tab_name}_{ax}.png', overwrite=True)
+
+        # Secondary gaincal after solving for delay and bandpass
+        # Use both flux calibrator and phase/linear pol calibraton
+        gaincal(vis=obs_vis, caltable=f'{tab_name}.G2', field=bcal, spw='0', refant=ref_ant, calmode='ap', solint='300', 
+                gaintable=[f'{tab_name}.K0', f'{tab_name}.B0'], parang=True)
+        if use_3c286:
+                gaincal(vis=obs_vis, caltable=f'{tab_name}.G3', field=pcal, spw='0', refant=ref_ant, calmode='ap', solint='300', 
+                        gaintable=[f'{tab_name}.K0', f'{tab_name}.B0', f'{tab_name}.G2'], parang=True)
+
+                if generate_plots:
+                        # For bandpass calibrator, gain amplitude and phase
+                        plotms(vis=f'{tab_name}.G2', xaxis='time', yaxis=f'gainamp',
+                                coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
+                                yselfscale=True, antenna=antenna_list, spw='0',
+                                plotfile=f'G2_{bcal}_{tab_name}_amp.png', overwrite=True)
+                        plotms(vis=f'{tab_name}.G2', xaxis='time', yaxis=f'gainphase',
+                                coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
+                                yselfscale=True, antenna=antenna_list, spw='0',
+                                plotfile=f'G2_{bcal}_{tab_name}_phase.png', overwrite=True)
+
+                        # For phase calibrator, gain amplitude and phase
+                        plotms(vis=f'{tab_name}.G3', xaxis='time', yaxis=f'gainamp',
+                                coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
+                                yselfscale=True, antenna=antenna_list, spw='0',
+                                plotfile=f'G3_{pcal}_{tab_name}_amp.png', overwrite=True)
+                        plotms(vis=f'{tab_name}.G3', xaxis='time', yaxis=f'gainphase',
+                                coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
+                                yselfscale=True, antenna=antenna_list, spw='0',
+                                plotfile=f'G3_{pcal}_{tab_name}_phase.png', overwrite=True)
 
                 
 
-else:
-        # If using phase calibrator for polarization calibration, we allow the gains to absorb the parallactic angle 
-        # variation so that we can use it to calculate the pcal Stokes model
-        gaincal(vis=obs_vis, caltable=f'{tab_name}.G3', field=pol_cal, spw='0', refant=ref_ant, calmode='ap', solint='300', 
-                gaintable=[f'{tab_name}.K0', f'{tab_name}.B0', f'{tab_name}.G2'])
+        else:
+                # If using phase calibrator for polarization calibration, we allow the gains to absorb the parallactic angle 
+                # variation so that we can use it to calculate the pcal Stokes model
+                gaincal(vis=obs_vis, caltable=f'{tab_name}.G3', field=pol_cal, spw='0', refant=ref_ant, calmode='ap', solint='300', 
+                        gaintable=[f'{tab_name}.K0', f'{tab_name}.B0', f'{tab_name}.G2'])
         
-        # Calculate Stokes model from gains
-        qu_model = polfromgain(vis=obs_vis, tablein=f'{tab_name}.G3')
-        print(f"Stokes model calculated from gains: {qu_model}")
+                # Calculate Stokes model from gains
+                qu_model = polfromgain(vis=obs_vis, tablein=f'{tab_name}.G3')
+                print(f"Stokes model calculated from gains: {qu_model}")
 
-        # Redo gaincal with Stokes model; this does not absorb polarization signal
-        gaincal(vis=obs_vis, caltable=f'{tab_name}_pol.G3', refant=ref_ant, refantmode='strict', solint='300', calmode='ap', 
-                field=pol_cal, smodel=qu_model[pol_cal]['Spw0'], parang=True, gaintable=[f'{tab_name}.K0', f'{tab_name}.B0', f'{tab_name}.G2'])
+                # Redo gaincal with Stokes model; this does not absorb polarization signal
+                gaincal(vis=obs_vis, caltable=f'{tab_name}_pol.G3', refant=ref_ant, refantmode='strict', solint='300', calmode='ap', 
+                        field=pol_cal, smodel=qu_model[pol_cal]['Spw0'], parang=True, gaintable=[f'{tab_name}.K0', f'{tab_name}.B0', f'{tab_name}.G2'])
         
-        # Redo Stokes model to check for residual gains; should be close to zero
-        qu_model_calibrated = polfromgain(vis=obs_vis, tablein=f'{tab_name}_pol.G3')
+                # Redo Stokes model to check for residual gains; should be close to zero
+                qu_model_calibrated = polfromgain(vis=obs_vis, tablein=f'{tab_name}_pol.G3')
 
-        if generate_plots:
-                # For bandpass calibrator, gain amplitude and phase
-                plotms(vis=f'{tab_name}.G2', xaxis='time', yaxis=f'gainamp',
-                        coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
-                        yselfscale=True, antenna=antenna_list, spw='0',
-                        plotfile=f'G2_{bcal}_{tab_name}_amp.png', overwrite=True)
-                plotms(vis=f'{tab_name}.G2', xaxis='time', yaxis=f'gainphase',
-                        coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
-                        yselfscale=True, antenna=antenna_list, spw='0',
-                        plotfile=f'G2_{bcal}_{tab_name}_phase.png', overwrite=True)
+                if generate_plots:
+                        # For bandpass calibrator, gain amplitude and phase
+                        plotms(vis=f'{tab_name}.G2', xaxis='time', yaxis=f'gainamp',
+                                coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
+                                yselfscale=True, antenna=antenna_list, spw='0',
+                                plotfile=f'G2_{bcal}_{tab_name}_amp.png', overwrite=True)
+                        plotms(vis=f'{tab_name}.G2', xaxis='time', yaxis=f'gainphase',
+                                coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
+                                yselfscale=True, antenna=antenna_list, spw='0',
+                                plotfile=f'G2_{bcal}_{tab_name}_phase.png', overwrite=True)
+
+                        # For phase calibrator, gain amplitude and phase
+                        plotms(vis=f'{tab_name}_pol.G3', xaxis='time', yaxis=f'gainamp',
+                                coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
+                                yselfscale=True, antenna=antenna_list, spw='0',
+                                plotfile=f'G3_{tab_name}_pol_amp.png', overwrite=True)
+                        plotms(vis=f'{tab_name}_pol.G3', xaxis='time', yaxis=f'gainphase',
+                                coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
+                                yselfscale=True, antenna=antenna_list, spw='0',
+                                plotfile=f'G3_{pcal}_{tab_name}_pol_phase.png', overwrite=True)
+
+        manifest.complete('standard_calibration', values={'qu_model': qu_model})
+else:
+        qu_model = manifest.values('standard_calibration')['qu_model']
 
-                # For phase calibrator, gain amplitude and phase
-                plotms(vis=f'{tab_name}_pol.G3', xaxis='time', yaxis=f'gainamp',
-                        coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
-                        yselfscale=True, antenna=antenna_list, spw='0',
-                        plotfile=f'G3_{tab_name}_pol_amp.png', overwrite=True)
-                plotms(vis=f'{tab_name}_pol.G3', xaxis='time', yaxis=f'gainphase',
-                        coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
-                        yselfscale=True, antenna=antenna_list, spw='0',
-                        plotfile=f'G3_{pcal}_{tab_name}_pol_phase.png', overwrite=True)
 
 ###########################################
         
@@ -175,141 +206,157 @@ else:
 
 ###########################################
 
-## Use 3c286
 if use_3c286:
+        pol_products = [f'{tab_name}_pol_cal.ms']
+else:
+        pol_products = [f'{tab_name}_pol.Kcross0', f'{tab_name}_pol.Xfparang', f'{tab_name}_pol.D0',
+                        f'{tab_name}_pol_cal.ms']
 
-       # Fetch and move the tables to this directory
-        kcross_path = glob.glob(f'{polcal_table_dir}/*.Kcross0')[0]
-        Xfparang_path = glob.glob(f'{polcal_table_dir}/*.Xfparang')[0]
-        leakage_path = glob.glob(f'{polcal_table_dir}/*.D0')[0]
+if manifest.pending('polarization_calibration', products=pol_products):
+        ## Use 3c286
+        if use_3c286:
 
-        print(kcross_path)
-        print(Xfparang_path)
-        print(leakage_path)
+               # Fetch and move the tables to this directory
+                kcross_path = glob.glob(f'{polcal_table_dir}/*.Kcross0')[0]
+                Xfparang_path = glob.glob(f'{polcal_table_dir}/*.Xfparang')[0]
+                leakage_path = glob.glob(f'{polcal_table_dir}/*.D0')[0]
 
-        test = subprocess.Popen(["cp", '-r', kcross_path, '.'])
-        test2 = subprocess.Popen(["cp", '-r', Xfparang_path, '.'])
-        test3 = subprocess.Popen(["cp", '-r', leakage_path, '.'])
+                print(kcross_path)
+                print(Xfparang_path)
+                print(leakage_path)
 
-        # Apply the tables
-        kcross = kcross_path.split('/')[-1]
-        Xfparang = Xfparang_path.split('/')[-1]
-        leakage = leakage_path.split('/')[-1]
+                test = subprocess.Popen(["cp", '-r', kcross_path, '.'])
+                test2 = subprocess.Popen(["cp", '-r', Xfparang_path, '.'])
+                test3 = subprocess.Popen(["cp", '-r', leakage_path, '.'])
 
-        applycal(vis=obs_vis, gaintable=[f'{tab_name}.K0', f'{tab_name}.B0', f'{tab_name}.G2', f'{tab_name}.G3', kcross, Xfparang, leakage], parang=True)
-        # applycal(vis=obs_vis, gaintable=[kcross, Xfparang, leakage], parang=True)
+                # Apply the tables
+                kcross = kcross_path.split('/')[-1]
+                Xfparang = Xfparang_path.split('/')[-1]
+                leakage = leakage_path.split('/')[-1]
 
-        # Save out a calibrated measurement set
+                applycal(vis=obs_vis, gaintable=[f'{tab_name}.K0', f'{tab_name}.B0', f'{tab_name}.G2', f'{tab_name}.G3', kcross, Xfparang, leakage], parang=True)
+                # applycal(vis=obs_vis, gaintable=[kcross, Xfparang, leakage], parang=True)
 
-        split(obs_vis, outputvis=f'{tab_name}_pol_cal.ms', datacolumn='corrected')
+                # Save out a calibrated measurement set
 
-        if generate_plots:
-                for ax in ['real', 'imag']:
-                        # Real and imaginary components versus parallactic angle for polarization calibrator
-                        plotms(vis=f'{tab_name}_pol_cal.ms', ydatacolumn='corrected', xaxis='parang', yaxis=ax,
-                                coloraxis='corr', field=pcal, avgchannel='168', spw='0',
-                                plotfile=f'{tab_name}_parang_corrected_{ax}_vs_parang.png', overwrite=True)
-                        # Real and imaginary components versus frequency for polarization calibrator
-                        plotms(vis=f'{tab_name}_pol_cal.ms', ydatacolumn='corrected', xaxis='freq', yaxis=ax,
-                                coloraxis='corr', field=pcal, avgtime='100000', avgscan=True, spw='0',
-                                plotfile=f'{tab_name}_parang_corrected_{ax}_vs_freq.png', overwrite=True)
-                # Parallactic angle-corrected real vs imaginary components for polarization calibrator
-                plotms(vis=f'{tab_name}_pol_cal.ms', xdatacolumn='corrected', ydatacolumn='corrected',
-                        xaxis='real', yaxis='imag', coloraxis='corr', field=pcal,
-                        avgtime='100000', avgscan=True, avgchannel='168', spw='0',
-                        plotfile=f'{tab_name}_pol_cal_parang_corrected_reim.png')
-
-
-### Try on the fly with a strongly polarized calibrator
-else:
-        # Set flux model for phase calibrator
-        setjy(vis=obs_vis, field=pcal, standard='Perley-Butler 2017', usescratch=True)
-
-        ##################################################
-        # Best scan to calibrate cross-hands will be where the polarization signal is 
-        # minimum in XX and YY (i.e., maximum in XY and YX); find the scan using the
-        # gain calibration for the phase/polarization calibrator
-        # This code taken from ALMA pipeline
-        tb.open(f'{tab_name}.G3')
-        scans = tb.getcol('SCAN_NUMBER')
-        gains = np.squeeze(tb.getcol('CPARAM'))
-        tb.close()
-        scan_list = np.array(list(set(scans)))
-        ratios = np.zeros(len(scan_list))
-        for si, s in enumerate(scan_list):
-                filt = scans == s
-                ratio = np.sqrt(np.average(np.power(np.abs(gains[0,filt])/np.abs(gains[1,filt])-1.0,2.)))
-                ratios[si] = ratio
-
-        best_scan_index = np.argmin(ratios)
-        best_scan = scan_list[best_scan_index]
-        print(f"Scan with highest expected X-Y signal: {best_scan}")
-        #####################################################
+                rmtables(f'{tab_name}_pol_cal.ms')
+                split(obs_vis, outputvis=f'{tab_name}_pol_cal.ms', datacolumn='corrected')
+
+                if generate_plots:
+                        for ax in ['real', 'imag']:
+                                # Real and imaginary components versus parallactic angle for polarization calibrator
+                                plotms(vis=f'{tab_name}_pol_cal.ms', ydatacolumn='corrected', xaxis='parang', yaxis=ax,
+                                        coloraxis='corr', field=pcal, avgchannel='168', spw='0',
+                                        plotfile=f'{tab_name}_parang_corrected_{ax}_vs_parang.png', overwrite=True)
+                                # Real and imaginary components versus frequency for polarization calibrator
+                                plotms(vis=f'{tab_name}_pol_cal.ms', ydatacolumn='corrected', xaxis='freq', yaxis=ax,
+                                        coloraxis='corr', field=pcal, avgtime='100000', avgscan=True, spw='0',
+                                        plotfile=f'{tab_name}_parang_corrected_{ax}_vs_freq.png', overwrite=True)
+                        # Parallactic angle-corrected real vs imaginary components for polarization calibrator
+                        plotms(vis=f'{tab_name}_pol_cal.ms', xdatacolumn='corrected', ydatacolumn='corrected',
+                                xaxis='real', yaxis='imag', coloraxis='corr', field=pcal,
+                                avgtime='100000', avgscan=True, avgchannel='168', spw='0',
+                                plotfile=f'{tab_name}_pol_cal_parang_corrected_reim.png')
+
+
+        ### Try on the fly with a strongly polarized calibrator
+        else:
+                # Set flux model for phase calibrator
+                set_model(obs_vis, pcal, virtual=virtual_models, standard='Perley-Butler 2017')
+
+                ##################################################
+                # Best scan to calibrate cross-hands will be where the polarization signal is 
+                # minimum in XX and YY (i.e., maximum in XY and YX); find the scan using the
+                # gain calibration for the phase/polarization calibrator
+                # This code taken from ALMA pipeline
+                tb.open(f'{tab_name}.G3')
+                scans = tb.getcol('SCAN_NUMBER')
+                gains = np.squeeze(tb.getcol('CPARAM'))
+                tb.close()
+                scan_list = np.array(list(set(scans)))
+                ratios = np.zeros(len(scan_list))
+                for si, s in enumerate(scan_list):
+                        filt = scans == s
+                        ratio = np.sqrt(np.average(np.power(np.abs(gains[0,filt])/np.abs(gains[1,filt])-1.0,2.)))
+                        ratios[si] = ratio
+
+                best_scan_index = np.argmin(ratios)
+                best_scan = scan_list[best_scan_index]
+                print(f"Scan with highest expected X-Y signal: {best_scan}")
+                #####################################################
         
-        # Kcross
-        gaincal(vis=obs_vis, caltable=f'{tab_name}_pol.Kcross0', spw=pol_spw, refant=ref_ant, solint='inf', 
-               field=pol_cal, gaintype='KCROSS', scan=str(best_scan), smodel=[1, 0, 1, 0], calmode='ap', 
-               minblperant=1, refantmode='strict', parang=True)
-
-        if generate_plots:
-                # Plot of Kcross solutions
-                plotms(vis=f'{tab_name}_pol.Kcross0', yaxis='delay', spw='0',
-                        antenna=ref_ant, coloraxis='corr',
-                        plotfile=f'{tab_name}_Kcross0.png', overwrite=True)
+                # Kcross
+                gaincal(vis=obs_vis, caltable=f'{tab_name}_pol.Kcross0', spw=pol_spw, refant=ref_ant, solint='inf', 
+                       field=pol_cal, gaintype='KCROSS', scan=str(best_scan), smodel=[1, 0, 1, 0], calmode='ap', 
+                       minblperant=1, refantmode='strict', parang=True)
+
+                if generate_plots:
+                        # Plot of Kcross solutions
+                        plotms(vis=f'{tab_name}_pol.Kcross0', yaxis='delay', spw='0',
+                                antenna=ref_ant, coloraxis='corr',
+                                plotfile=f'{tab_name}_Kcross0.png', overwrite=True)
                
-        # Solve for the apparent cross-hand phase spectrum (channelized) fractional linear polarization, Q, U
-        # Note that CASA calculates a Stokes model for the source in this step as well, but it will be incorrect!
-        # The X-Y phase offset table generated here seems to be accurate
-        S_model = polcal(vis=obs_vis, caltable=f'{tab_name}_pol.Xfparang',
-                  field=pol_cal, spw=pol_spw,
-                  solint='inf', combine='scan', preavg=300,
-                  smodel=qu_model[pol_cal]['Spw0'], poltype='Xfparang+QU',
-                  gaintable=[f'{tab_name}.B0', f'{tab_name}.G0', f'{tab_name}.G1', f'{tab_name}.G2', f'{tab_name}_pol.G3',
-                             f'{tab_name}_pol.Kcross0'])
+                # Solve for the apparent cross-hand phase spectrum (channelized) fractional linear polarization, Q, U
+                # Note that CASA calculates a Stokes model for the source in this step as well, but it will be incorrect!
+                # The X-Y phase offset table generated here seems to be accurate
+                S_model = polcal(vis=obs_vis, caltable=f'{tab_name}_pol.Xfparang',
+                          field=pol_cal, spw=pol_spw,
+                          solint='inf', combine='scan', preavg=300,
+                          smodel=qu_model[pol_cal]['Spw0'], poltype='Xfparang+QU',
+                          gaintable=[f'{tab_name}.B0', f'{tab_name}.G0', f'{tab_name}.G1', f'{tab_name}.G2', f'{tab_name}_pol.G3',
+                                     f'{tab_name}_pol.Kcross0'])
                              
-        # Solve for leakage terms
-        polcal(vis=obs_vis, caltable=f'{tab_name}_pol.D0', field='0', spw=pol_spw, solint='inf', combine='scan', preavg=300,
-              smodel=qu_model[pol_cal]['Spw0'], poltype='Dflls', refant='', 
-              gaintable=[f'{tab_name}.B0', f'{tab_name}.G0', f'{tab_name}.G1', f'{tab_name}.G2', f'{tab_name}_pol.G3',f'{tab_name}_pol.Kcross0', 
-                         f'{tab_name}_pol.Xfparang'])
-
-        if generate_plots:
-                # Plots of phase-frequency and real/imaginary leakage terms by antenna
-                plotms(vis=f'{tab_name}_pol.Xfparang', xaxis='freq', yaxis='gainphase',
-                        plotfile=f'{tab_name}_freq_vs_gainphase.png', overwrite=True)
-
-                for ax in ['real', 'imag']:
-                        plotms(vis=f'{tab_name}_pol.D0', xaxis='freq', yaxis=ax,
-                                coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
-                                yselfscale=True, antenna=antenna_list,
-                                plotfile=f'D0_{tab_name}_pol_{ax}.png', overwrite=True)
+                # Solve for leakage terms
+                polcal(vis=obs_vis, caltable=f'{tab_name}_pol.D0', field='0', spw=pol_spw, solint='inf', combine='scan', preavg=300,
+                      smodel=qu_model[pol_cal]['Spw0'], poltype='Dflls', refant='', 
+                      gaintable=[f'{tab_name}.B0', f'{tab_name}.G0', f'{tab_name}.G1', f'{tab_name}.G2', f'{tab_name}_pol.G3',f'{tab_name}_pol.Kcross0', 
+                                 f'{tab_name}_pol.Xfparang'])
+
+                if generate_plots:
+                        # Plots of phase-frequency and real/imaginary leakage terms by antenna
+                        plotms(vis=f'{tab_name}_pol.Xfparang', xaxis='freq', yaxis='gainphase',
+                                plotfile=f'{tab_name}_freq_vs_gainphase.png', overwrite=True)
+
+                        for ax in ['real', 'imag']:
+                                plotms(vis=f'{tab_name}_pol.D0', xaxis='freq', yaxis=ax,
+                                        coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
+                                        yselfscale=True, antenna=antenna_list,
+                                        plotfile=f'D0_{tab_name}_pol_{ax}.png', overwrite=True)
         
-        # Apply the tables
-        kcross = f'{tab_name}_pol.Kcross0'
-        Xfparang = f'{tab_name}_pol.Xfparang'
-        leakage = f'{tab_name}_pol.D0'
+                # Apply the tables
+                kcross = f'{tab_name}_pol.Kcross0'
+                Xfparang = f'{tab_name}_pol.Xfparang'
+                leakage = f'{tab_name}_pol.D0'
 
-        applycal(vis=obs_vis, gaintable=[f'{tab_name}.K0', f'{tab_name}.B0', f'{tab_name}.G2', f'{tab_name}_pol.G3', 
-                kcross, Xfparang, leakage], parang=True)
+                applycal(vis=obs_vis, gaintable=[f'{tab_name}.K0', f'{tab_name}.B0', f'{tab_name}.G2', f'{tab_name}_pol.G3', 
+                        kcross, Xfparang, leakage], parang=True)
 
-        # Save out a calibrated measurement set
-        split(vis=obs_vis, outputvis=f'{tab_name}_pol_cal.ms', datacolumn='corrected')
+                # Save out a calibrated measurement set
+                rmtables(f'{tab_name}_pol_cal.ms')
+                split(vis=obs_vis, outputvis=f'{tab_name}_pol_cal.ms', datacolumn='corrected')
+
+                if generate_plots:
+                        for ax in ['real', 'imag']:
+                                # Real and imaginary components versus parallactic angle for polarization calibrator
+                                plotms(vis=f'{tab_name}_pol_cal.ms', ydatacolumn='corrected', xaxis='parang', yaxis=ax,
+                                        coloraxis='corr', field=pcal, avgchannel='168', spw='0',
+                                        plotfile=f'{tab_name}_parang_corrected_{ax}_vs_parang.png', overwrite=True)
+                                # Real and imaginary components versus frequency for polarization calibrator
+                                plotms(vis=f'{tab_name}_pol_cal.ms', ydatacolumn='corrected', xaxis='freq', yaxis=ax,
+                                        coloraxis='corr', field=pcal, avgtime='100000', avgscan=True, spw='0',
+                                        plotfile=f'{tab_name}_parang_corrected_{ax}_vs_freq.png', overwrite=True)
+                        # Parallactic angle-corrected real vs imaginary components for polarization calibrator
+                        plotms(vis=f'{tab_name}_pol_cal.ms', xdatacolumn='corrected', ydatacolumn='corrected',
+                                xaxis='real', yaxis='imag', coloraxis='corr', field=pcal,
+                                avgtime='100000', avgscan=True, avgchannel='168', spw='0',
+                                plotfile=f'{tab_name}_pol_cal_parang_corrected_reim.png')
+
+        manifest.complete('polarization_calibration',
+                          values={'kcross': kcross, 'Xfparang': Xfparang, 'leakage': leakage})
+else:
+        pol_values = manifest.values('polarization_calibration')
+        kcross, Xfparang, leakage = pol_values['kcross'], pol_values['Xfparang'], pol_values['leakage']
 
-        if generate_plots:
-                for ax in ['real', 'imag']:
-                        # Real and imaginary components versus parallactic angle for polarization calibrator
-                        plotms(vis=f'{tab_name}_pol_cal.ms', ydatacolumn='corrected', xaxis='parang', yaxis=ax,
-                                coloraxis='corr', field=pcal, avgchannel='168', spw='0',
-                                plotfile=f'{tab_name}_parang_corrected_{ax}_vs_parang.png', overwrite=True)
-                        # Real and imaginary components versus frequency for polarization calibrator
-                        plotms(vis=f'{tab_name}_pol_cal.ms', ydatacolumn='corrected', xaxis='freq', yaxis=ax,
-                                coloraxis='corr', field=pcal, avgtime='100000', avgscan=True, spw='0',
-                                plotfile=f'{tab_name}_parang_corrected_{ax}_vs_freq.png', overwrite=True)
-                # Parallactic angle-corrected real vs imaginary components for polarization calibrator
-                plotms(vis=f'{tab_name}_pol_cal.ms', xdatacolumn='corrected', ydatacolumn='corrected',
-                        xaxis='real', yaxis='imag', coloraxis='corr', field=pcal,
-                        avgtime='100000', avgscan=True, avgchannel='168', spw='0',
-                        plotfile=f'{tab_name}_pol_cal_parang_corrected_reim.png')
 
 ### Try on the fly with unpolarized cal
 
@@ -322,188 +369,69 @@ else:
 
 # Iterate calibration with D-term solution and save out another calibrated ms
 
-if iterate_calibration:
+iterate_products = [] if use_3c286 else [f'{tab_name}_pol_cal_i.ms']
+if iterate_calibration and manifest.pending('iterate_calibration', products=iterate_products):
 
         if use_3c286:
-                pass
+                iteration = {}
         else:
-                # Begin gain calibration again on the uncorrected bandpass calibrator, using previous info
-                # Include best previous gain tables here?
-                gaincal(vis=obs_vis, caltable=f'{tab_name}.G0i', field=bcal, spw='0', refant=ref_ant, refantmode='strict', calmode='p', 
-                        solint='inf', gaintable=[leakage], parang=True)
-                gaincal(vis=obs_vis, caltable=f'{tab_name}.G1i', field=bcal, spw='0', refant=ref_ant, refantmode='strict', calmode='a', 
-                        solint='100', preavg=1, minblperant=1, minsnr=0, gaintype='G', gaintable=[f'{tab_name}.G0i', leakage], parang=True)
-
-                # Redo delays
-                gaincal(vis=obs_vis, caltable=f'{tab_name}.K0i', field=bcal, spw='0', refant=ref_ant, solint='inf', combine='scan', 
-                        preavg=1, minblperant=1, gaintype='K', gaintable=[f'{tab_name}.G0i', f'{tab_name}.G1i', kcross], parang=True)
-
-                # Redo bandpass with the new gain, delays, and leakage
-                bandpass(vis=obs_vis, caltable=f'{tab_name}.B0i', field=bcal, spw='0', refant=ref_ant,
-                        bandtype='B', gaintable=[f'{tab_name}.G0i', f'{tab_name}.G1i', f'{tab_name}.K0i', leakage], parang=True)
-
-                # Redo gain with new preliminary gain, bandpass, delays, leakage
-                gaincal(vis=obs_vis, caltable=f'{tab_name}.G2i', field=bcal, spw='0', refant=ref_ant, calmode='ap', solint='300', 
-                        gaintable=[f'{tab_name}.K0i', f'{tab_name}.B0i', leakage, f'{tab_name}.G0i', f'{tab_name}.G1i', ], parang=True)
-                
-                # Redo phase calibrator gain absorbing parallactic angle contribution
-                gaincal(vis=obs_vis, caltable=f'{tab_name}.G3i', field=pcal, spw='0', refant=ref_ant, calmode='ap', solint='300', 
-                        gaintable=[f'{tab_name}.K0i', f'{tab_name}.B0i', f'{tab_name}.G2i', leakage, f'{tab_name}.G0i', f'{tab_name}.G1i'])
-
-                # Redo Stokes model from gains
-                qu_model_i = polfromgain(vis=obs_vis, tablein=f'{tab_name}.G3i')
-
-                # Redo phase calibrator gain with new model and all previous tables
-                gaincal(vis=obs_vis, caltable=f'{tab_name}_pol.G3i', refant=ref_ant, refantmode='strict', solint='300', calmode='ap', 
-                        field=pcal, smodel=qu_model_i[pcal]['Spw0'], parang=True, gaintable=[f'{tab_name}.K0i', f'{tab_name}.B0i', f'{tab_name}.G2i', 
-                        leakage, f'{tab_name}.G0i', f'{tab_name}.G1i'])
-
-                # Redo X-Y phase offsets now that the full calibration has been repeated with an estimate of instrumental polarization
-
-                # Set flux model for phase calibrator
-                setjy(vis=obs_vis, field=pcal, standard='Perley-Butler 2017', usescratch=True)
-        
-                # Kcross
-                gaincal(vis=obs_vis, caltable=f'{tab_name}_pol.Kcross0i', spw='0', refant=ref_ant, solint='inf', 
-                        field=pcal, gaintype='KCROSS', combine='scan', smodel=[1, 0, 1, 0], calmode='ap', 
-                        minblperant=1, refantmode='strict', parang=True)
-
-                # X-Y phase offsets
-                S_model = polcal(vis=obs_vis, caltable=f'{tab_name}_pol.Xfparangi',
-                        field=pcal, spw='0',
-                        solint='inf', combine='scan', preavg=300,
-                        smodel=qu_model[pcal]['Spw0'], poltype='Xfparang+QU',
-                        gaintable=[f'{tab_name}.B0i', f'{tab_name}.G0i', f'{tab_name}.G1i', f'{tab_name}.G2i', f'{tab_name}_pol.G3i',
-                                f'{tab_name}_pol.Kcross0i', leakage])
-
-                # Redo leakage calibration with self-calibrated tables
-                polcal(vis=obs_vis, caltable=f'{tab_name}_pol.D0i', field='0', spw='0', solint='inf', combine='scan', preavg=300,
-                        smodel=qu_model[pcal]['Spw0'], poltype='Dflls', refant='', 
-                        gaintable=[f'{tab_name}.B0i', f'{tab_name}.G0i', f'{tab_name}.G1i' f'{tab_name}.G2i', f'{tab_name}_pol.G3i',f'{tab_name}_pol.Kcross0i', 
-                                f'{tab_name}_pol.Xfparangi'])
+                # Repeat the gain, delay, bandpass and polarization chain on the uncorrected data, starting
+                # each pass from the previous leakage, cross-hand delay and Stokes model, until the D-terms,
+                # X-Y phase and Q/U stop changing
+                start = {'kcross': kcross, 'Xfparang': Xfparang, 'leakage': leakage, 'qu_model': qu_model}
+                iteration = iterate_polarization_calibration(obs_vis, tab_name, start, max_iterations=max_iterations,
+                                                             tolerances=iteration_tolerances, bandpass_calibrator=bcal,
+                                                             polarization_calibrator=pol_cal, ref_ant=ref_ant,
+                                                             pol_spw=pol_spw)
 
                 # Apply new calculations
-                kcross = f'{tab_name}_pol.Kcross0i'
-                Xfparang = f'{tab_name}_pol.Xfparangi'
-                leakage = f'{tab_name}_pol.D0i'
+                kcross, Xfparang, leakage = iteration['kcross'], iteration['Xfparang'], iteration['leakage']
+                tables = iteration['tables']
 
-                applycal(vis=obs_vis, gaintable=[f'{tab_name}.K0', f'{tab_name}.B0', f'{tab_name}.G2', f'{tab_name}_pol.G3', 
+                applycal(vis=obs_vis, gaintable=[tables['K0'], tables['B0'], tables['G2'], tables['pol_G3'],
                         kcross, Xfparang, leakage], parang=True)
 
                 # Save out a calibrated measurement set
+                rmtables(f'{tab_name}_pol_cal_i.ms')
                 split(vis=obs_vis, outputvis=f'{tab_name}_pol_cal_i.ms', datacolumn='corrected')
 
+        manifest.complete('iterate_calibration',
+                          values={key: iteration[key] for key in ['kcross', 'Xfparang', 'leakage', 'qu_model',
+                                                                  'iterations', 'converged', 'history']
+                                  if key in iteration})
+
 
 ### Imaging
 do_image = False
-
-if do_image:
-        # Split out bcal, pcal, target
-        mstransform(vis=f'{tab_name}_pol_cal.ms', outputvis=f"{bcal}_calibrated.ms", antenna='!*&&&', field=bcal, datacolumn='DATA')
-        mstransform(vis=f'{tab_name}_pol_cal.ms', outputvis=f"{pcal}_calibrated.ms", antenna='!*&&&', field=pcal, datacolumn='DATA')
-        mstransform(vis=f'{tab_name}_pol_cal.ms', outputvis=f"{target}_calibrated.ms", antenna='!*&&&', field=target, datacolumn='DATA')
-
-        # Get maximum baseline
-        tb.open(obs_vis)
-        B_max = np.max(np.sqrt(tb.getcol('UVW')[0]**2 + tb.getcol('UVW')[1]**2 + tb.getcol('UVW')[2]**2))
-        tb.close()
-
-        # Get maximum frequency
-        tb.open(f"{obs_vis}/SPECTRAL_WINDOW/")
-        nu_max = np.max(tb.getcol('REF_FREQUENCY'))
-        tb.close()
-
-        # Calculate cell size
-        cell = ((3.e8 / nu_max) / B_max) * (180. / np.pi) * 3600. / 8.
-
-        # Image bandpass calibrator
-        obs_vis = f"{bcal}_calibrated.ms"
-        os.makedirs(f"./IMAGES/{bcal}/")
-
-        image_base = f'IMAGES/{bcal}/{bcal}_briggs0_{round(cell, 2)}arcsec'
-
-        tclean(vis=obs_vis, weighting='briggs', robust=0, imagename=f"{image_base}_dirty", 
-        cell=f"{cell}arcsec", imsize=[2048,2048], pblimit=-1, deconvolver='mtmfs')
-        dirty_rms = imstat(f"{image_base}_dirty.image.tt0")['rms'][0]
-        tclean(vis=obs_vis, weighting='briggs', robust=0, imagename=f"{image_base}_clean_iter1", cell=f"{cell}arcsec", 
-        imsize=[2048,2048], niter=1000, threshold = f"{dirty_rms*5.}Jy", pblimit=-1, deconvolver='mtmfs')
-        clean_rms = imstat(f"{image_base}_clean_iter1.residual.tt0")['rms'][0]
-        tclean(vis=obs_vis, weighting='briggs', robust=0, imagename=f"{image_base}_clean_iter2", 
-        cell=f"{cell}arcsec", imsize=[2048,2048], niter=1000, threshold = f"{clean_rms*5.}Jy", pblimit=-1,deconvolver='mtmfs')
-
-        ia.open(f'{image_base}_clean_iter2.image.tt0')
-        maj = ia.restoringbeam()['major']['value']
-        min = ia.restoringbeam()['minor']['value']
-        pos = ia.restoringbeam()['positionangle']['value']
-        ia.close()
-
-        fit_name = f'./IMAGES/{bcal}/fitting_region.crtf'
-        f = open(fit_name, 'w')
-        f.write('#CRTF\n')
-        f.write(f'circle[[1024pix, 1024pix],{cell * 8. * 5.}arcsec]')
-        f.close()
-
-        est_name = f'./IMAGES/{bcal}/estimates.txt'
-        f = open(est_name, 'w')
-        f.write(f'1,1024,1024,{maj}arcsec,{min}arcsec,{pos}deg,abp')
-        f.close()
-
-        fit_results = imfit(imagename=f'{image_base}_clean_iter2.image.tt0', region=fit_name, estimates=est_name)
-        flux_density = fit_results['deconvolved']['component0']['flux']['value'][0]
-        error = fit_results['deconvolved']['component0']['flux']['error'][0]
-
-        fname = './IMAGES/' + bpcal + '/' + 'fitting_results.txt'
-        f = open(fname, 'w')
-        f.write(str(flux_density) + ',' + str(error))
-        f.close()
-
-        # Image phase/polarization calibrator (SPLIT OUT PHASE CAL)
-        obs_vis = f"{pcal}_calibrated.ms"
-        os.makedirs(f"./IMAGES/{pcal}/")
-        image_base = f'IMAGES/{pcal}/{pcal}_briggs0_{round(cell, 2)}arcsec'
-
-        tclean(vis=obs_vis, weighting='briggs', robust=0, imagename=f"{image_base}_dirty", 
-        cell=f"{cell}arcsec", imsize=[2048,2048], pblimit=-1, deconvolver='mtmfs')
-        dirty_rms = imstat(f"{image_base}_dirty.image.tt0")['rms'][0]
-        tclean(vis=obs_vis, weighting='briggs', robust=0, imagename=f"{image_base}_clean_iter1", cell=f"{cell}arcsec", 
-        imsize=[2048,2048], niter=1000, threshold = f"{dirty_rms*5.}Jy", pblimit=-1, deconvolver='mtmfs')
-        clean_rms = imstat(f"{image_base}_clean_iter1.residual.tt0")['rms'][0]
-        tclean(vis=obs_vis, weighting='briggs', robust=0, imagename=f"{image_base}_clean_iter2", 
-        cell=f"{cell}arcsec", imsize=[2048,2048], niter=1000, threshold = f"{clean_rms*5.}Jy", pblimit=-1,deconvolver='mtmfs')
-
-        # Image target (SPLIT OUT ONLY TARGET DATA)
-        obs_vis = f"{target}_calibrated.ms"
-        os.makedirs(f"./IMAGES/{target}/")
-        image_base = f'IMAGES/{target}/{target}_briggs0_{round(cell, 2)}arcsec'
-
-        print("Stokes I Image")
-        tclean(vis=f'{target}_calibrated.ms', imagename=f"{image_base}_dirty", spw='0', specmode='mfs', deconvolver='mtmfs', 
-                gridder='standard', imsize=[2048,2048], cell=f"{cell}arcsec", weighting='briggs', niter=100)
-        tclean(vis=f'{target}_calibrated.ms', imagename=f'{image_base}_clean_iter_1000', spw='0', specmode='mfs', deconvolver='mtmfs', 
-        gridder='standard', imsize=[2048,2048], cell=f"{cell}arcsec", weighting='briggs', niter=1000)
-
-        print("Stokes Q Image")
-        tclean(vis=f'{target}_calibrated.ms', imagename=f"{image_base}_Q_dirty", spw='0', specmode='mfs', deconvolver='mtmfs', 
-                gridder='standard', imsize=[2048,2048], cell=f"{cell}arcsec", weighting='briggs', niter=100, stokes='Q')
-        tclean(vis=f'{target}_calibrated.ms', imagename=f'{image_base}_Q_clean_iter_1000', spw='0', specmode='mfs', deconvolver='mtmfs', 
-        gridder='standard', imsize=[2048,2048], cell=f"{cell}arcsec", weighting='briggs', niter=1000, stokes='Q')
-
-        print("Stokes U Image")
-        tclean(vis=f'{target}_calibrated.ms', imagename=f"{image_base}_U_dirty", spw='0', specmode='mfs', deconvolver='mtmfs', 
-                gridder='standard', imsize=[2048,2048], cell=f"{cell}arcsec", weighting='briggs', niter=100, stokes='U')
-        tclean(vis=f'{target}_calibrated.ms', imagename=f'{image_base}_U_clean_iter_1000', spw='0', specmode='mfs', deconvolver='mtmfs', 
-        gridder='standard', imsize=[2048,2048], cell=f"{cell}arcsec", weighting='briggs', niter=1000, stokes='U')
-
-        print("Stokes V Image")
-        tclean(vis=f'{target}_calibrated.ms', imagename=f"{image_base}_V_dirty", spw='0', specmode='mfs', deconvolver='mtmfs', 
-                gridder='standard', imsize=[2048,2048], cell=f"{cell}arcsec", weighting='briggs', niter=100, stokes='V')
-        tclean(vis=f'{target}_calibrated.ms', imagename=f'{image_base}_V_clean_iter_1000', spw='0', specmode='mfs', deconvolver='mtmfs', 
-        gridder='standard', imsize=[2048,2048], cell=f"{cell}arcsec", weighting='briggs', niter=1000, stokes='V')
-
-
-
-
+imaging_workers = 0             # Fields imaged at once; 0 lets memory and core count decide
+joint_stokes_imaging = True     # Grid target Stokes I, Q, U and V in one tclean instead of one per Stokes
+
+if do_image and manifest.pending('imaging', products=[f'{target}_calibrated.ms']):
+        # Split out bcal, pcal, target without autocorrelations, in one pass
+        calibrated_vis = f'{tab_name}_pol_cal_i.ms' if iterate_calibration and not use_3c286 else f'{tab_name}_pol_cal.ms'
+        split_fields(calibrated_vis, [bcal, pcal, target], datacolumn='data')
+
+        # Cell size from the maximum baseline and frequency in the cached MS summary
+        cell = cell_size(ms_summary(obs_vis))
+
+        # The bandpass calibrator, phase calibrator and target are imaged concurrently
+        imaging_jobs = {}
+        for field in [bcal, pcal, target]:
+                os.makedirs(f"./IMAGES/{field}/", exist_ok=True)
+                image_base = f'IMAGES/{field}/{field}_briggs0_{round(cell, 2)}arcsec'
+                if field == target:
+                        imaging_jobs[f'image_{field}'] = target_job(f"{field}_calibrated.ms", image_base, cell,
+                                                                    joint_stokes=joint_stokes_imaging)
+                else:
+                        imaging_jobs[f'image_{field}'] = calibrator_job(f"{field}_calibrated.ms", image_base, cell, field,
+                                                                        diagnostics=(field == bcal))
+
+        finished = run_imaging_jobs(imaging_jobs, nproc=imaging_workers)
+        if len(finished) < len(imaging_jobs):
+                raise RuntimeError(f"Imaging failed for {sorted(set(imaging_jobs) - set(finished))}")
 
         # Produce Stokes maps
 
-        ##############################################################################################################
\ No newline at end of file
+        ##############################################################################################################
+
+        manifest.complete('imaging')
\ No newline at end of file
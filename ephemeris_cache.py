@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+#############################################################################
+# LST-gridded altitude and parallactic angle cache for fixed sources
+#############################################################################
+
+# For a fixed source at a fixed site, altitude and parallactic angle depend
+# only on local sidereal time. The cache computes both once per source on a
+# grid of GRID_POINTS sidereal times: altitude from astropy (or spherical
+# trigonometry when astropy is missing), parallactic angle from the hour
+# angle as astroplan computes it. Grids are kept in memory and saved to
+# $ATA_EPHEMERIS_CACHE (default ~/.cache/ata_pol/ephemeris), so any UTC
+# window is one LST computation and a periodic interpolation. Parallactic
+# angle is interpolated through its cosine and sine so the jump through
+# +-180 deg near transit is kept. Grids older than MAX_AGE_DAYS are rebuilt,
+# as precession slowly moves the apparent position. astropy reads its IERS
+# tables from the local bundle (iers_bundle.py), never from the network.
+#
+# Usage inside a planner:
+#
+#   ephemeris = EphemerisCache()
+#   alt, pa = ephemeris.track('3c286', 13.519, 30.509, obs_times.mjd)     # degrees
+#   plot_track(ax, obs_times.mjd, alt, 'altitude', '3c286 Altitude')
+
+import os
+import re
+import time
+
+import numpy as np
+
+from ms_metadata import local_sidereal_time
+
+# ATA site, as in the planners
+ATA_LAT = 40.8178       # deg
+ATA_LON = -121.4733     # deg
+
+# One grid point per sidereal minute, 0.25 deg of hour angle
+GRID_POINTS = 1440
+MAX_AGE_DAYS = 30
+SIDEREAL_DAY = 0.99726958   # days
+CACHE_VERSION = 1
+
+CACHE_DIR = os.environ.get('ATA_EPHEMERIS_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'ata_pol', 'ephemeris'))
+
+
+def altitude_parallactic(lst, ra: float, dec: float, lat: float) -> tuple:
+    '''Altitude and parallactic angle (radians) from the hour angle, in mean J2000 coordinates'''
+    ha = lst - ra
+    alt = np.arcsin(np.sin(lat)*np.sin(dec) + np.cos(lat)*np.cos(dec)*np.cos(ha))
+    pa = np.arctan2(np.sin(ha), np.cos(dec)*np.tan(lat) - np.sin(dec)*np.cos(ha))
+    return alt, pa
+
+
+def _astropy_altitude(mjd, ra: float, dec: float, lat: float, lon: float) -> np.ndarray:
+    '''Altitude (radians) from astropy, including precession, nutation and aberration'''
+    from astropy import units
+    from astropy.coordinates import AltAz, EarthLocation, SkyCoord
+    from astropy.time import Time
+    from iers_bundle import use_bundle
+    use_bundle()
+    location = EarthLocation.from_geodetic(lat=lat*units.rad, lon=lon*units.rad)
+    frame = AltAz(obstime=Time(mjd, format='mjd', scale='utc'), location=location)
+    return SkyCoord(ra=ra*units.rad, dec=dec*units.rad).transform_to(frame).alt.rad
+
+
+class EphemerisCache:
+    '''Per-source altitude and parallactic angle on an LST grid, saved to disk'''
+
+    def __init__(self, lat: float = ATA_LAT, lon: float = ATA_LON, cache_dir: str = CACHE_DIR,
+                 max_age_days: float = MAX_AGE_DAYS):
+        self.lat = np.deg2rad(lat)
+        self.lon = np.deg2rad(lon)
+        self.cache_dir = cache_dir
+        self.max_age = max_age_days * 86400.
+        self._grids = {}
+
+    def _path(self, name: str, ra_hours: float, dec_deg: float) -> str:
+        slug = re.sub(r'[^\w+-]', '_', name or 'position')
+        return os.path.join(self.cache_dir, f'{slug}_{ra_hours:.5f}_{dec_deg:+.5f}.npz')
+
+    def _build(self, ra: float, dec: float) -> dict:
+        mjd = time.time() / 86400. + 40587. + SIDEREAL_DAY * np.arange(GRID_POINTS) / GRID_POINTS
+        lst = local_sidereal_time(mjd * 86400., self.lon)
+        # astroplan also takes the parallactic angle from the mean LST and J2000 position
+        alt, pa = altitude_parallactic(lst, ra, dec, self.lat)
+        try:
+            alt = _astropy_altitude(mjd, ra, dec, self.lat, self.lon)
+        except ImportError:
+            pass
+        order = np.argsort(lst)
+        return {'lst': lst[order], 'alt': alt[order], 'cos_pa': np.cos(pa[order]), 'sin_pa': np.sin(pa[order]),
+                'built': time.time()}
+
+    def grid(self, name: str, ra_hours: float, dec_deg: float) -> dict:
+        '''The LST grid of a source, from memory, disk or a fresh computation'''
+        path = self._path(name, ra_hours, dec_deg)
+        grid = self._grids.get(path)
+        if grid is None and os.path.exists(path):
+            with np.load(path) as saved:
+                if int(saved['version']) == CACHE_VERSION and np.isclose(saved['lat'], self.lat) \
+                        and np.isclose(saved['lon'], self.lon):
+                    grid = {key: saved[key] for key in ['lst', 'alt', 'cos_pa', 'sin_pa', 'built']}
+        if grid is None or time.time() - float(grid['built']) > self.max_age:
+            grid = self._build(np.deg2rad(ra_hours * 15.), np.deg2rad(dec_deg))
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = f'{path}.tmp.npz'
+            np.savez(tmp, version=CACHE_VERSION, lat=self.lat, lon=self.lon, **grid)
+            os.replace(tmp, path)
+        self._grids[path] = grid
+        return grid
+
+    def track(self, name: str, ra_hours: float, dec_deg: float, mjd) -> tuple:
+        '''Altitude and parallactic angle in degrees of a source at UTC MJD times (array or astropy Time)'''
+        grid = self.grid(name, ra_hours, dec_deg)
+        lst = local_sidereal_time(np.asarray(getattr(mjd, 'mjd', mjd), dtype=float) * 86400., self.lon)
+        period = 2*np.pi
+        alt = np.interp(lst, grid['lst'], grid['alt'], period=period)
+        pa = np.arctan2(np.interp(lst, grid['lst'], grid['sin_pa'], period=period),
+                        np.interp(lst, grid['lst'], grid['cos_pa'], period=period))
+        return np.rad2deg(alt), np.rad2deg(pa)
+
+
+def mjd_to_datetime64(mjd) -> np.ndarray:
+    return np.datetime64('1858-11-17T00:00:00') + np.round(np.asarray(mjd) * 86400e6).astype('timedelta64[us]')
+
+
+def plot_track(ax, mjd, values, quantity: str, title: str):
+    '''Draw an altitude or parallactic angle track against UTC on ax'''
+    import matplotlib.dates as mdates
+    ax.plot(mjd_to_datetime64(mjd), values, lw=1.5, marker='.', markersize=0.5)
+    ax.set_xlabel('Time (UTC)')
+    ax.set_ylabel('Altitude (deg)' if quantity == 'altitude' else 'Parallactic angle (deg)')
+    if quantity == 'altitude':
+        ax.set_ylim(0, 90)
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
+    ax.grid(True, linestyle='-.')
+    ax.set_title(title)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+#############################################################################
+# Per-field measurement sets in one pass
+#############################################################################
+
+# Imaging needs one MS per field without autocorrelations. The previous
+# approach was one mstransform per field, usually on an intermediate MS that
+# split had already copied out of CORRECTED_DATA. Each of those was a full
+# read of the data. Here the source MS is read once, in row chunks, and every
+# chunk is distributed to all the per-field outputs. Each output starts as an
+# empty deep copy of the MS, so it has the same columns, storage layout and
+# subtables. The chosen data column (normally CORRECTED_DATA) is written as
+# DATA, and CORRECTED_DATA and MODEL_DATA are not carried over. Optional
+# columns without values (e.g. an empty WEIGHT_SPECTRUM) are left unfilled, as
+# in the source. Field ids keep their values in the outputs. If the split fails
+# part way, the partial outputs are removed.
+#
+# Usage inside a calibration script:
+#
+#   split_fields(obs_vis, [bandpass_calibrator, phase_calibrator, target], datacolumn='corrected')
+
+import os
+import shutil
+
+import numpy as np
+
+# Rows read per chunk; a 168-channel, 4-correlation row of DATA and CORRECTED_DATA is ~11 kB
+CHUNK_ROWS = 20_000
+
+# Not copied to the outputs; FLAG_CATEGORY is normally present but has no cells
+DROPPED_COLUMNS = ['CORRECTED_DATA', 'MODEL_DATA', 'FLAG_CATEGORY']
+
+
+def split_fields(vis: str, fields: list, datacolumn: str = 'corrected', suffix: str = '_calibrated.ms',
+                 drop_autocorrelations: bool = True) -> dict:
+    '''
+    Write f'{field}{suffix}' for every field (names or ids) in a single pass
+    over vis, with datacolumn as DATA and, by default, no autocorrelations.
+    Returns {field: output path}.
+    '''
+    from casatools import table
+    column = 'CORRECTED_DATA' if datacolumn.lower() == 'corrected' else datacolumn.upper()
+    tb = table()
+    tb.open(os.path.join(vis, 'FIELD'))
+    field_names = list(tb.getcol('NAME'))
+    tb.close()
+    field_ids = {field: field_names.index(field) if field in field_names else int(field)
+                 for field in dict.fromkeys(map(str, fields))}
+
+    tb.open(vis)
+    nrows = tb.nrows()
+    # Only columns with values; reading one whose cells are undefined raises
+    copied = [c for c in tb.colnames() if c not in DROPPED_COLUMNS + ['DATA'] and nrows and tb.iscelldefined(c, 0)]
+    outputs = {}
+    paths = {}
+    try:
+        for field, fid in field_ids.items():
+            paths[field] = f'{field}{suffix}'
+            shutil.rmtree(paths[field], ignore_errors=True)
+            empty = tb.query(f'FIELD_ID=={fid}')
+            outputs[field] = empty.copy(paths[field], deep=True, valuecopy=True, norows=True, returnobject=True)
+            empty.close()
+            outputs[field].removecols([c for c in DROPPED_COLUMNS if c in outputs[field].colnames()])
+
+        for start in range(0, nrows, CHUNK_ROWS):
+            n = min(CHUNK_ROWS, nrows - start)
+            field_id = tb.getcol('FIELD_ID', startrow=start, nrow=n)
+            keep = tb.getcol('ANTENNA1', startrow=start, nrow=n) != tb.getcol('ANTENNA2', startrow=start, nrow=n) \
+                if drop_autocorrelations else np.ones(n, dtype=bool)
+            selections = {field: np.flatnonzero((field_id == fid) & keep) for field, fid in field_ids.items()}
+            if not any(len(rows) for rows in selections.values()):
+                continue
+
+            values = {c: tb.getcol(c, startrow=start, nrow=n) for c in copied}
+            values['DATA'] = tb.getcol(column, startrow=start, nrow=n)
+            for field, rows in selections.items():
+                if not len(rows):
+                    continue
+                out = outputs[field]
+                first = out.nrows()
+                out.addrows(len(rows))
+                for c, v in values.items():
+                    out.putcol(c, v[..., rows], startrow=first, nrow=len(rows))
+    except Exception:
+        for out in outputs.values():
+            out.close()
+        for path in paths.values():
+            shutil.rmtree(path, ignore_errors=True)
+        raise
+    finally:
+        tb.close()
+
+    for field, out in outputs.items():
+        print(f"{paths[field]}: {out.nrows()} rows")
+        out.close()
+    return paths
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+#############################################################################
+# Single-pass flagging
+#############################################################################
+
+# Every flagdata call is a full read (and write) of the FLAG column. The
+# manual antenna/scan flags and the tfcrop/rflag runs configured in a script
+# are instead gathered into one command list and run as a single
+# flagdata(mode='list') pass. Summary commands are placed after each command
+# so the fraction of the data each command flagged is still reported.
+#
+# Usage inside a calibration script:
+#
+#   commands = flag_commands(bad_antennas=['1b', '1e'], autoflag_fields=[target])
+#   fractions = apply_flags(obs_vis, commands)
+
+import os
+
+SUMMARY_PREFIX = 'after_'
+
+
+def flag_command(mode: str = 'manual', **selection) -> str:
+    '''One line of a flagdata command list, e.g. "mode='manual' antenna='1b'"'''
+    params = {'mode': mode, **{k: v for k, v in selection.items() if v not in ('', None)}}
+    return ' '.join(f'{key}={value!r}' for key, value in params.items())
+
+
+def flag_commands(bad_antennas: list = (), bad_scans: list = (), autoflag_fields: list = (),
+                  autoflag_modes: list = ('tfcrop', 'rflag'), datacolumn: str = 'DATA') -> list:
+    '''
+    Command list for the usual flagging of these scripts: manual flags of bad
+    antennas and scans, then each automatic flagger on each of the given fields.
+    '''
+    commands = [flag_command('manual', antenna=f'"{a}"') for a in bad_antennas]
+    commands += [flag_command('manual', scan=str(s)) for s in bad_scans]
+    commands += [flag_command(mode, field=str(field), datacolumn=datacolumn)
+                 for field in autoflag_fields for mode in autoflag_modes]
+    return commands
+
+
+def apply_flags(vis: str, commands: list, flagbackup: bool = False) -> dict:
+    '''
+    Run the flag commands in one flagdata pass over the MS. Returns the
+    fraction of all data newly flagged by each command, which is also printed.
+    '''
+    from casatasks import flagdata
+    if not commands:
+        return {}
+
+    # Summaries are evaluated in list order on each data chunk, so the difference
+    # between neighbouring reports is what the command between them flagged
+    chain = [flag_command('summary', name=f'{SUMMARY_PREFIX}start')]
+    for n, command in enumerate(commands):
+        chain += [command, flag_command('summary', name=f'{SUMMARY_PREFIX}{n}')]
+
+    reports = flagdata(vis=vis, mode='list', inpfile=chain, action='apply', flagbackup=flagbackup)
+    reports = {r['name']: r for r in reports.values() if isinstance(r, dict) and 'name' in r}
+
+    total = reports[f'{SUMMARY_PREFIX}start']['total']
+    flagged = reports[f'{SUMMARY_PREFIX}start']['flagged']
+    fractions = {'initial': flagged / total}
+    print(f"Flagging {os.path.basename(vis.rstrip('/'))}: {100 * fractions['initial']:.2f}% flagged beforehand")
+    for n, command in enumerate(commands):
+        now = reports[f'{SUMMARY_PREFIX}{n}']['flagged']
+        fractions[command] = (now - flagged) / total
+        print(f"  {100 * fractions[command]:6.2f}%  {command}")
+        flagged = now
+    fractions['final'] = flagged / total
+    print(f"  {100 * fractions['final']:.2f}% flagged in total")
+    return fractions
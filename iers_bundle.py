@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+#############################################################################
+# Offline IERS bundle for the planners
+#############################################################################
+
+# astropy downloads IERS-A Earth orientation and leap second tables on
+# demand the first time a Time or AltAz conversion needs them. On the
+# air-gapped observing machines those downloads stall until they time out.
+# use_bundle() switches astropy's downloads off and points it at local
+# copies in $ATA_IERS_BUNDLE (default ~/.cache/ata_pol/iers). The copies are
+# fetched explicitly with --refresh on a machine with network access. The
+# bundle manifest records each file's checksum and download time, and a
+# pinned bundle is never replaced unless forced, so planning runs are
+# reproducible. Without a bundle astropy falls back to the IERS-B table
+# and leap seconds shipped with it, with a warning rather than a download.
+#
+#   python iers_bundle.py --refresh [--pin]     # on a networked machine, then copy the directory
+#   python iers_bundle.py --status
+#
+# Usage inside a planner, before any astropy Time is built:
+#
+#   use_bundle()
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+
+BUNDLE_DIR = os.environ.get('ATA_IERS_BUNDLE', os.path.join(os.path.expanduser('~'), '.cache', 'ata_pol', 'iers'))
+MANIFEST = 'manifest.json'
+IERS_A_FILE = 'finals2000A.all'
+LEAP_SECOND_FILE = 'Leap_Second.dat'
+
+_loaded = None
+
+
+def _sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def read_manifest(bundle_dir: str = BUNDLE_DIR) -> dict:
+    path = os.path.join(bundle_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def refresh(bundle_dir: str = BUNDLE_DIR, pin: bool = False, force: bool = False) -> dict:
+    '''
+    Download the IERS-A and leap second tables into bundle_dir and write its
+    manifest. A pinned bundle is left alone unless force is set.
+    '''
+    from astropy.utils import iers
+    from astropy.utils.data import download_file
+
+    manifest = read_manifest(bundle_dir)
+    if manifest.get('pinned') and not force:
+        raise RuntimeError(f"The IERS bundle in {bundle_dir} is pinned; use force to replace it")
+
+    os.makedirs(bundle_dir, exist_ok=True)
+    files = {}
+    for name, url in [(IERS_A_FILE, iers.conf.iers_auto_url), (LEAP_SECOND_FILE, iers.conf.iers_leap_second_auto_url)]:
+        downloaded = download_file(url, cache=False, timeout=60)
+        target = os.path.join(bundle_dir, name)
+        shutil.move(downloaded, target)
+        files[name] = {'url': url, 'sha256': _sha256(target)}
+
+    manifest = {'files': files, 'downloaded': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'pinned': pin}
+    with open(os.path.join(bundle_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+
+def pin(bundle_dir: str = BUNDLE_DIR, pinned: bool = True) -> dict:
+    manifest = read_manifest(bundle_dir)
+    if not manifest:
+        raise FileNotFoundError(f"No IERS bundle in {bundle_dir}")
+    manifest['pinned'] = pinned
+    with open(os.path.join(bundle_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+
+def use_bundle(bundle_dir: str = BUNDLE_DIR) -> dict:
+    '''
+    Stop astropy from downloading IERS data and load the bundle's tables
+    when it has them. Returns the manifest in use ({} without a bundle).
+    Safe to call more than once; later calls are free.
+    '''
+    global _loaded
+    if _loaded is not None:
+        return _loaded
+
+    from astropy.utils import iers
+    iers.conf.auto_download = False
+    try:
+        # Times beyond the tables get IERS-B or extrapolated values with a warning instead of an error
+        iers.conf.iers_degraded_accuracy = 'warn'
+    except AttributeError:
+        pass
+
+    manifest = read_manifest(bundle_dir)
+    if not manifest:
+        print(f"No IERS bundle in {bundle_dir}; using the tables shipped with astropy")
+        _loaded = {}
+        return _loaded
+
+    for name, entry in manifest['files'].items():
+        path = os.path.join(bundle_dir, name)
+        if not os.path.exists(path) or _sha256(path) != entry['sha256']:
+            raise RuntimeError(f"{path} does not match the IERS bundle manifest; run iers_bundle.py --refresh")
+
+    from astropy.time import update_leap_seconds
+    iers.earth_orientation_table.set(iers.IERS_A.open(os.path.join(bundle_dir, IERS_A_FILE)))
+    iers.conf.system_leap_second_file = os.path.join(bundle_dir, LEAP_SECOND_FILE)
+    update_leap_seconds([os.path.join(bundle_dir, LEAP_SECOND_FILE)])
+    print(f"Using IERS bundle from {manifest['downloaded']}{' (pinned)' if manifest.get('pinned') else ''}")
+    _loaded = manifest
+    return _loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the local IERS bundle used by the planners')
+    parser.add_argument('--dir', default=BUNDLE_DIR, help="Bundle directory")
+    parser.add_argument('--refresh', action='store_true', help="Download fresh IERS-A and leap second tables")
+    parser.add_argument('--force', action='store_true', help="Replace a pinned bundle when refreshing")
+    parser.add_argument('--pin', action='store_true', help="Pin the bundle so it is not replaced")
+    parser.add_argument('--unpin', action='store_true', help="Allow the bundle to be replaced")
+    parser.add_argument('--status', action='store_true', help="Show the bundle manifest")
+    args = parser.parse_args()
+
+    if args.refresh:
+        refresh(args.dir, pin=args.pin, force=args.force)
+    elif args.pin or args.unpin:
+        pin(args.dir, pinned=args.pin)
+    if args.status or not (args.refresh or args.pin or args.unpin):
+        manifest = read_manifest(args.dir)
+        print(json.dumps(manifest, indent=1) if manifest else f"No IERS bundle in {args.dir}")
+
+
+if __name__ == '__main__':
+    main()
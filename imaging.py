@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+#############################################################################
+# Imaging of calibrated fields
+#############################################################################
+
+# The per-field imaging chains (dirty/clean tclean passes, calibrator flux
+# fitting) for the bandpass calibrator, phase calibrator and target are
+# independent, so run_imaging_jobs runs them side by side in worker processes.
+# The number of workers is capped by the memory each tclean needs and by the
+# number of cores; each worker gets an equal share of the OpenMP threads.
+#
+# Calibrators are imaged with incremental_clean: one PSF and dirty image, then
+# clean rounds continued in place with thresholds from the residual rms.
+#
+# The target is imaged in Stokes I, Q, U and V. By default the four planes are
+# gridded together (stokes='IQUV') and the clean continues from the dirty
+# products on disk, so the target costs two gridding runs instead of eight.
+# tclean counts niter over all planes of a joint run, so the joint iteration
+# limits are the per-Stokes ones (100 and 1000) times the number of planes.
+#
+# Usage inside a calibration script:
+#
+#   jobs = {'image_bandpass_calibrator': calibrator_job(f'{bcal}_calibrated.ms', image_base, cell, bcal),
+#           'image_target': target_job(f'{target}_calibrated.ms', target_base, cell)}
+#   finished = run_imaging_jobs(jobs, nproc=imaging_workers)
+#
+# Workers are started with workers.run_modules, so the calling script is never
+# re-executed.
+
+import glob
+import os
+import shutil
+import sys
+
+from workers import load_job, run_modules
+
+IMSIZE = 2048
+NTERMS = 2
+STOKES = ['I', 'Q', 'U', 'V']
+
+# Fixed cost of a CASA process on top of its image buffers
+PROCESS_OVERHEAD = 1 << 30
+
+
+def calibrator_diagnostics(calibrator: str = '', image_base: str = '', cell_size: float = 0):
+    '''Fit the calibrator in the final clean image and write its flux density and error'''
+    from casatasks import imfit
+    from casatools import image
+    ia = image()
+    ia.open(f'{image_base}_clean_iter2.image.tt0')
+    beam = ia.restoringbeam()
+    ia.close()
+    maj = beam['major']['value']
+    min = beam['minor']['value']
+    pos = beam['positionangle']['value']
+
+    fit_name = f'./IMAGES/{calibrator}/fitting_region.crtf'
+    with open(fit_name, 'w') as f:
+        f.write('#CRTF\n')
+        f.write(f'circle[[{IMSIZE // 2}pix, {IMSIZE // 2}pix],{cell_size * 8. * 5.}arcsec]')
+
+    est_name = f'./IMAGES/{calibrator}/estimates.txt'
+    with open(est_name, 'w') as f:
+        f.write(f'1,{IMSIZE // 2},{IMSIZE // 2},{maj}arcsec,{min}arcsec,{pos}deg,abp')
+
+    fit_results = imfit(imagename=f'{image_base}_clean_iter2.image.tt0', region=fit_name, estimates=est_name)
+    flux_density = fit_results['deconvolved']['component0']['flux']['value'][0]
+    error = fit_results['deconvolved']['component0']['flux']['error'][0]
+
+    fit_result_name = f'./IMAGES/{calibrator}/fitting_results.txt'
+    with open(fit_result_name, 'w') as f:
+        f.write(str(flux_density) + ',' + str(error))
+
+
+def incremental_clean(vis: str, image_base: str, rounds: int = 2, niter: int = 1000, nsigma: float = 5.,
+                      **tclean_args) -> list:
+    '''
+    Compute the PSF and dirty image once, then continue deconvolution in place
+    for the given number of rounds. Each round cleans to nsigma times the rms of
+    the previous round (dirty image, then residuals). After every step the
+    products are copied to f'{image_base}_dirty' and f'{image_base}_clean_iter{n}'
+    so the usual diagnostics are still there. Returns the threshold used in each round.
+    '''
+    from casatasks import imstat, tclean
+    work = f'{image_base}_clean'
+    for product in glob.glob(f'{glob.escape(work)}.*'):
+        shutil.rmtree(product)
+
+    tclean(vis=vis, imagename=work, niter=0, **tclean_args)
+    copy_image_products(work, f'{image_base}_dirty')
+    rms = imstat(f"{work}.image.tt0")['rms'][0]
+
+    thresholds = []
+    for n in range(1, rounds + 1):
+        thresholds.append(rms * nsigma)
+        print(f"Clean round {n}: threshold {thresholds[-1]} Jy")
+        tclean(vis=vis, imagename=work, niter=niter, threshold=f"{thresholds[-1]}Jy",
+               calcpsf=False, calcres=False, **tclean_args)
+        copy_image_products(work, f'{image_base}_clean_iter{n}')
+        rms = imstat(f"{work}.residual.tt0")['rms'][0]
+    return thresholds
+
+
+def image_calibrator(vis: str, image_base: str, cell: float, calibrator: str, diagnostics: bool = True):
+    '''Dirty image, then two rounds of clean with thresholds of 5x the previous rms'''
+    incremental_clean(vis, image_base, rounds=2, niter=1000, nsigma=5., weighting='briggs', robust=0,
+                      cell=f"{cell}arcsec", imsize=[IMSIZE, IMSIZE], pblimit=-1, deconvolver='mtmfs')
+
+    if diagnostics:
+        calibrator_diagnostics(image_base=image_base, cell_size=cell, calibrator=calibrator)
+
+
+def copy_image_products(imagename: str, newname: str):
+    '''Copy every tclean product of imagename (.image.tt0, .residual.tt0, .psf.tt0, ...) to newname'''
+    for product in glob.glob(f'{glob.escape(imagename)}.*'):
+        suffix = product[len(imagename):]
+        shutil.rmtree(f'{newname}{suffix}', ignore_errors=True)
+        shutil.copytree(product, f'{newname}{suffix}')
+
+
+def image_target(vis: str, image_base: str, cell: float, joint_stokes: bool = True):
+    '''
+    Dirty (100 iterations) and 1000-iteration clean images in Stokes I, Q, U
+    and V. With joint_stokes the visibilities are gridded once for all four
+    planes, and the clean continues from the dirty products instead of
+    starting again, with the iteration limits scaled by the number of planes;
+    every product of each Stokes plane is then written out under the same
+    names as the separate runs.
+    '''
+    from casatasks import tclean
+    imaging_args = dict(vis=vis, spw='0', specmode='mfs', deconvolver='mtmfs', gridder='standard',
+                        imsize=[IMSIZE, IMSIZE], cell=f"{cell}arcsec", weighting='briggs')
+
+    if not joint_stokes:
+        for stokes in STOKES:
+            print(f"Stokes {stokes} Image")
+            prefix = image_base if stokes == 'I' else f'{image_base}_{stokes}'
+            tclean(imagename=f"{prefix}_dirty", niter=100, stokes=stokes, **imaging_args)
+            tclean(imagename=f'{prefix}_clean_iter_1000', niter=1000, stokes=stokes, **imaging_args)
+        return
+
+    print("Stokes IQUV Image")
+    nplanes = len(STOKES)
+    clean_name = f'{image_base}_IQUV_clean_iter_1000'
+    for product in glob.glob(f'{glob.escape(clean_name)}.*'):
+        shutil.rmtree(product)
+    tclean(imagename=clean_name, niter=100*nplanes, stokes='IQUV', **imaging_args)
+    copy_image_products(clean_name, f'{image_base}_IQUV_dirty')
+
+    # Reuse the PSF and residual on disk; the remaining iterations bring each plane's share to 1000
+    tclean(imagename=clean_name, niter=900*nplanes, stokes='IQUV', calcpsf=False, calcres=False, **imaging_args)
+
+    for stage in ['dirty', 'clean_iter_1000']:
+        split_stokes_planes(f'{image_base}_IQUV_{stage}', image_base, stage)
+
+
+def split_stokes_planes(imagename: str, image_base: str, stage: str):
+    '''
+    Write every product of a joint IQUV run (image, residual, model, psf, pb,
+    sumwt, ... for each Taylor term) plane by plane under the per-Stokes names
+    '''
+    from casatasks import imsubimage
+    products = [product[len(imagename):] for product in glob.glob(f'{glob.escape(imagename)}.*')]
+    for stokes in STOKES:
+        prefix = image_base if stokes == 'I' else f'{image_base}_{stokes}'
+        for suffix in products:
+            outfile = f'{prefix}_{stage}{suffix}'
+            shutil.rmtree(outfile, ignore_errors=True)
+            imsubimage(imagename=f'{imagename}{suffix}', outfile=outfile, stokes=stokes)
+
+
+IMAGING_TASKS = {
+    'calibrator': image_calibrator,
+    'target': image_target,
+}
+
+
+def calibrator_job(vis: str, image_base: str, cell: float, calibrator: str, diagnostics: bool = True) -> dict:
+    return {'task': 'calibrator', 'nstokes': 1, 'passes': 3,
+            'kwargs': {'vis': vis, 'image_base': image_base, 'cell': cell, 'calibrator': calibrator,
+                       'diagnostics': diagnostics}}
+
+
+def target_job(vis: str, image_base: str, cell: float, joint_stokes: bool = True) -> dict:
+    if joint_stokes:
+        return {'task': 'target', 'nstokes': 4, 'passes': 2,
+                'kwargs': {'vis': vis, 'image_base': image_base, 'cell': cell, 'joint_stokes': True}}
+    return {'task': 'target', 'nstokes': 1, 'passes': 8,
+            'kwargs': {'vis': vis, 'image_base': image_base, 'cell': cell, 'joint_stokes': False}}
+
+
+def job_memory(imsize: int = IMSIZE, nterms: int = NTERMS, nstokes: int = 1) -> int:
+    '''
+    Rough peak memory of an mtmfs tclean in bytes: float32 image planes (psf has
+    2*nterms-1 terms; residual, model and image nterms each; weight and sumwt)
+    plus a complex64 grid padded by 1.2 for every psf term.
+    '''
+    pixels = imsize * imsize * nstokes
+    planes = (2*nterms - 1) + 3*nterms + 2
+    grids = (2*nterms - 1) * 1.2**2
+    return int(pixels * (4*planes + 8*grids)) + PROCESS_OVERHEAD
+
+
+def available_memory() -> int:
+    '''Memory that can be used without swapping, in bytes'''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def run_imaging_jobs(jobs: dict, nproc: int = 0) -> list:
+    '''
+    Run {name: job} concurrently, as many at a time as memory and cores allow,
+    starting with the job with the most gridding work. Returns the names of
+    the jobs that finished.
+    '''
+    if not jobs:
+        return []
+
+    cores = os.cpu_count() or 1
+    largest = max(job_memory(nstokes=job['nstokes']) for job in jobs.values())
+    workers = min(len(jobs), nproc or cores, max(1, available_memory() // largest))
+    threads = max(1, cores // workers)
+    print(f"Running {len(jobs)} imaging jobs with {workers} workers of {threads} threads")
+
+    order = sorted(jobs, key=lambda name: jobs[name]['passes'] * jobs[name]['nstokes'], reverse=True)
+    return run_modules('imaging', {name: jobs[name] for name in order}, nproc=workers,
+                       env={'OMP_NUM_THREADS': str(threads)})
+
+
+if __name__ == '__main__':
+    # Worker process started by run_module
+    job = load_job()
+
+    from casatasks import casalog
+    casalog.setlogfile(sys.argv[1].replace('.job.json', '.casa.log'))
+    IMAGING_TASKS[job['task']](**job['kwargs'])
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+#############################################################################
+# Ingest of per-scan data products into one measurement set
+#############################################################################
+
+# Each scan of an observation arrives as its own folder of measurement sets
+# (or UVH5 files). Rather than copying every folder to scratch, rewriting
+# SCAN_NUMBER and concatenating, each input is turned into a linked MS in a
+# worker process: the table and subtables are copied, but the storage files
+# of the visibility columns (DATA by default) are symlinks to the original.
+# Only the small columns, SCAN_NUMBER among them, are duplicated, and the
+# scan number is written into the copy. UVH5 files are converted with
+# pyuvdata instead. The linked MSs are then joined with virtualconcat into a
+# multi-MS, which moves them rather than copying the data again.
+#
+# The linked columns are shared with the original data, so they must not be
+# written to; CASA only reads DATA (flags, models and corrected data are
+# stored in other columns). A column that shares a storage manager with
+# columns that are written is copied instead.
+#
+# Usage inside a calibration script:
+#
+#   ingest(scan_groups('uvh5*_measure_sets'), '3c286_obs.ms', scratch='scratch')
+
+import glob
+import os
+import shutil
+
+import numpy as np
+
+from workers import load_job, run_modules
+
+# Rows written per putcol of SCAN_NUMBER
+CHUNK_ROWS = 1_000_000
+
+
+def _is_dataset(path: str) -> bool:
+    return path.endswith('.uvh5') or os.path.isfile(os.path.join(path, 'table.dat'))
+
+
+def scan_groups(pattern: str) -> list:
+    '''
+    Input datasets per scan, in scan order. Measurement sets or UVH5 files
+    matching the pattern are grouped by their folder; matching folders give
+    the datasets inside them.
+    '''
+    groups = {}
+    for path in sorted(glob.glob(pattern)):
+        path = path.rstrip('/')
+        if _is_dataset(path):
+            groups.setdefault(os.path.dirname(path), []).append(path)
+        else:
+            groups[path] = sorted(p for p in glob.glob(os.path.join(glob.escape(path), '*')) if _is_dataset(p))
+    return [groups[folder] for folder in sorted(groups) if groups[folder]]
+
+
+def _linked_files(ms: str, link_columns: list) -> set:
+    '''Storage files of the main table that hold only the given columns'''
+    from casatools import table
+    tb = table()
+    tb.open(ms)
+    dminfo = tb.getdminfo()
+    tb.close()
+    prefixes = [f"table.f{dm['SEQNR']}" for dm in dminfo.values()
+                if dm['COLUMNS'] and set(dm['COLUMNS']) <= set(link_columns)]
+    return {name for name in os.listdir(ms)
+            if any(name == p or name.startswith(p + '_') for p in prefixes)}
+
+
+def link_ms(ms: str, dest: str, link_columns: list = ('DATA',)):
+    '''Copy an MS to dest with the storage files of link_columns symlinked to the original'''
+    ms = os.path.abspath(ms)
+    linked = _linked_files(ms, link_columns)
+    shutil.rmtree(dest, ignore_errors=True)
+    os.makedirs(dest)
+    for name in os.listdir(ms):
+        src = os.path.join(ms, name)
+        if name in linked:
+            os.symlink(src, os.path.join(dest, name))
+        elif os.path.isdir(src):
+            shutil.copytree(src, os.path.join(dest, name))
+        elif name != 'table.lock':
+            shutil.copy2(src, os.path.join(dest, name))
+
+
+def convert_uvh5(path: str, dest: str):
+    '''Write a UVH5 file as a measurement set'''
+    from pyuvdata import UVData
+    uv = UVData.from_file(path)
+    shutil.rmtree(dest, ignore_errors=True)
+    uv.write_ms(dest)
+
+
+def set_scan_number(ms: str, scan: int):
+    from casatools import table
+    tb = table()
+    tb.open(ms, nomodify=False)
+    nrows = tb.nrows()
+    for start in range(0, nrows, CHUNK_ROWS):
+        n = min(CHUNK_ROWS, nrows - start)
+        tb.putcol('SCAN_NUMBER', np.full(n, scan, dtype=np.int32), startrow=start, nrow=n)
+    tb.close()
+
+
+def prepare_scan(path: str, dest: str, scan: int, link_columns: list):
+    '''Worker: link or convert one input dataset to dest and set its scan number'''
+    if path.endswith('.uvh5'):
+        convert_uvh5(path, dest)
+    else:
+        link_ms(path, dest, link_columns)
+    set_scan_number(dest, scan)
+
+
+def ingest(groups: list, vis: str, scratch: str = '', link_columns: list = ('DATA',), first_scan: int = 1,
+           nproc: int = 0) -> str:
+    '''
+    Combine the datasets of each scan (as from scan_groups) into the multi-MS
+    vis, numbering scans from first_scan in order. Inputs are prepared in
+    parallel under scratch (default <vis>.scratch) and moved into vis.
+    Returns vis.
+    '''
+    from casatasks import virtualconcat
+    scratch = scratch or f"{vis.rstrip('/')}.scratch"
+    os.makedirs(scratch, exist_ok=True)
+
+    jobs = {}
+    for scan, paths in enumerate(groups, start=first_scan):
+        for path in paths:
+            name = os.path.splitext(os.path.basename(path.rstrip('/')))[0]
+            dest = os.path.join(scratch, f'scan{scan}_{name}.ms')
+            jobs[os.path.join(scratch, f'scan{scan}_{name}')] = {
+                'path': path, 'dest': dest, 'scan': scan, 'link_columns': list(link_columns)}
+    finished = run_modules('ingest', jobs, nproc=nproc)
+    if len(finished) < len(jobs):
+        failed = [job['path'] for name, job in jobs.items() if name not in finished]
+        raise RuntimeError(f"Ingest failed for {failed}")
+
+    shutil.rmtree(vis, ignore_errors=True)
+    virtualconcat(vis=[job['dest'] for job in jobs.values()], concatvis=vis, keepcopy=False)
+    for name in jobs:
+        os.remove(f'{name}.log')
+    if not os.listdir(scratch):
+        os.rmdir(scratch)
+    return vis
+
+
+if __name__ == '__main__':
+    # Worker process started by run_module
+    job = load_job()
+    prepare_scan(**job)
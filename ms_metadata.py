@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+#############################################################################
+# Cached measurement set metadata
+#############################################################################
+
+# Summarises a measurement set in one chunked pass over the main table: the
+# maximum baseline, spectral window frequencies, and per-field scans, time
+# ranges and parallactic angle ranges. The summary is written as a JSON sidecar
+# next to the MS (<vis>.metadata.json) so later runs and other scripts read it
+# instead of loading whole columns with tb.getcol or reopening msmd.
+#
+# The sidecar is keyed on the row count, the first and last timestamps and the
+# state of the metadata subtables, so flagging or applycal (which only touch
+# data columns) do not invalidate it, but a different MS at the same path does.
+#
+# Usage inside a calibration script:
+#
+#   summary = ms_summary(obs_vis)
+#   cell = cell_size(summary)
+#   spwMeanFreq = summary['spws']['0']['mean_freq'] / 1e9
+#   cached_listobs(obs_vis)
+
+import json
+import os
+
+import numpy as np
+
+from step_cache import json_default, ms_state
+
+METADATA_VERSION = 1
+
+# Rows read per chunk; UVW, TIME, FIELD_ID and SCAN_NUMBER are ~50 bytes a row
+CHUNK_ROWS = 1_000_000
+
+# Subtables the summary is built from; HISTORY and FLAG_CMD change on every flagdata
+METADATA_SUBTABLES = ['ANTENNA', 'DATA_DESCRIPTION', 'FIELD', 'OBSERVATION', 'SPECTRAL_WINDOW']
+
+# WGS84 ellipsoid
+EARTH_A = 6378137.0
+EARTH_F = 1 / 298.257223563
+
+
+def sidecar_path(vis: str) -> str:
+    return f"{vis.rstrip('/')}.metadata.json"
+
+
+def _metadata_state(vis: str) -> dict:
+    '''Cheap fingerprint of the parts of an MS the summary depends on'''
+    from casatools import table
+    tb = table()
+    tb.open(vis)
+    nrows = tb.nrows()
+    times = [tb.getcell('TIME', 0), tb.getcell('TIME', nrows - 1)] if nrows else []
+    tb.close()
+    return {
+        'nrows': nrows,
+        'times': times,
+        'subtables': {sub: ms_state(os.path.join(vis, sub)) for sub in METADATA_SUBTABLES},
+    }
+
+
+def geodetic_location(xyz) -> tuple:
+    '''Latitude and longitude in radians of an ITRF position, using Bowring's method'''
+    x, y, z = xyz
+    e2 = EARTH_F * (2 - EARTH_F)
+    b = EARTH_A * (1 - EARTH_F)
+    ep2 = (EARTH_A**2 - b**2) / b**2
+    p = np.hypot(x, y)
+    theta = np.arctan2(z * EARTH_A, p * b)
+    lat = np.arctan2(z + ep2 * b * np.sin(theta)**3, p - e2 * EARTH_A * np.cos(theta)**3)
+    lon = np.arctan2(y, x)
+    return float(lat), float(lon)
+
+
+def local_sidereal_time(mjd_seconds, lon: float):
+    '''Local mean sidereal time in radians for MS TIME values (MJD seconds, UTC)'''
+    days = np.asarray(mjd_seconds) / 86400. - 51544.5
+    gmst = np.deg2rad(280.46061837 + 360.98564736629 * days)
+    return np.mod(gmst + lon, 2 * np.pi)
+
+
+def parallactic_angle(lst, ra: float, dec: float, lat: float):
+    '''Parallactic angle in radians of a source at (ra, dec) for the given local sidereal times'''
+    ha = lst - ra
+    return np.arctan2(np.sin(ha), np.cos(dec) * np.tan(lat) - np.sin(dec) * np.cos(ha))
+
+
+def _summarise(vis: str) -> dict:
+    from casatools import table
+    tb = table()
+
+    tb.open(os.path.join(vis, 'ANTENNA'))
+    positions = tb.getcol('POSITION')
+    tb.close()
+    lat, lon = geodetic_location(positions.mean(axis=1))
+
+    tb.open(os.path.join(vis, 'FIELD'))
+    field_names = list(tb.getcol('NAME'))
+    phase_dirs = tb.getcol('PHASE_DIR')[:, 0, :]
+    tb.close()
+
+    tb.open(os.path.join(vis, 'SPECTRAL_WINDOW'))
+    spws = {}
+    for spw in range(tb.nrows()):
+        freqs = tb.getcell('CHAN_FREQ', spw)
+        spws[str(spw)] = {
+            'ref_freq': float(tb.getcell('REF_FREQUENCY', spw)),
+            'min_freq': float(freqs.min()),
+            'max_freq': float(freqs.max()),
+            'mean_freq': float(freqs.mean()),
+            'nchan': int(len(freqs)),
+        }
+    tb.close()
+
+    # Stream the main table; only the running maximum and unique times/scans are kept
+    b_max = 0.
+    field_times = {}
+    field_scans = {}
+    tb.open(vis)
+    nrows = tb.nrows()
+    for start in range(0, nrows, CHUNK_ROWS):
+        n = min(CHUNK_ROWS, nrows - start)
+        uvw = tb.getcol('UVW', startrow=start, nrow=n)
+        b_max = max(b_max, float(np.sqrt((uvw**2).sum(axis=0)).max()))
+        time = tb.getcol('TIME', startrow=start, nrow=n)
+        field = tb.getcol('FIELD_ID', startrow=start, nrow=n)
+        scan = tb.getcol('SCAN_NUMBER', startrow=start, nrow=n)
+        for fid in np.unique(field):
+            sel = field == fid
+            field_times[fid] = np.union1d(field_times.get(fid, []), np.unique(time[sel]))
+            field_scans[fid] = np.union1d(field_scans.get(fid, []), np.unique(scan[sel]))
+    tb.close()
+
+    fields = {}
+    for fid, times in field_times.items():
+        ra, dec = phase_dirs[:, fid]
+        pa = np.rad2deg(parallactic_angle(local_sidereal_time(times, lon), ra, dec, lat))
+        fields[field_names[fid]] = {
+            'id': int(fid),
+            'ra': float(ra),
+            'dec': float(dec),
+            'scans': [int(s) for s in field_scans[fid]],
+            'time_range': [float(times.min()), float(times.max())],
+            'parang_range': [float(pa.min()), float(pa.max())],
+        }
+
+    all_times = np.concatenate(list(field_times.values())) if field_times else np.array([0.])
+    return {
+        'max_baseline': b_max,
+        'max_ref_freq': max(s['ref_freq'] for s in spws.values()),
+        'spws': spws,
+        'fields': fields,
+        'time_range': [float(all_times.min()), float(all_times.max())],
+        'latitude': lat,
+        'longitude': lon,
+    }
+
+
+def ms_summary(vis: str, refresh: bool = False) -> dict:
+    '''Metadata summary of an MS, read from its sidecar when that is still valid'''
+    path = sidecar_path(vis)
+    state = _metadata_state(vis)
+    if not refresh and os.path.exists(path):
+        with open(path) as f:
+            saved = json.load(f)
+        if saved.get('version') == METADATA_VERSION and saved.get('state') == state:
+            return saved['summary']
+
+    print(f"Summarising {vis}")
+    summary = _summarise(vis)
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'version': METADATA_VERSION, 'state': state, 'summary': summary}, f, indent=1,
+                  default=json_default)
+    os.replace(tmp, path)
+    return summary
+
+
+def cell_size(summary: dict, oversample: float = 8.) -> float:
+    '''Image cell in arcsec: the resolution at the highest reference frequency over oversample'''
+    return ((3.e8 / summary['max_ref_freq']) / summary['max_baseline']) * (180. / np.pi) * 3600. / oversample
+
+
+def cached_listobs(vis: str):
+    '''Print listobs output, running listobs only when the MS metadata has changed'''
+    listfile = f"{vis.rstrip('/')}.listobs.txt"
+    # Refreshes the sidecar if it is stale, which makes the listfile older than it
+    ms_summary(vis)
+    if not os.path.exists(listfile) or os.path.getmtime(listfile) < os.path.getmtime(sidecar_path(vis)):
+        from casatasks import listobs
+        listobs(vis=vis, listfile=listfile, overwrite=True)
+    with open(listfile) as f:
+        print(f.read())
@@ -1,141 +1,143 @@
 #!/opt/mnt/miniconda3/bin/python
 
-import pandas as pd
-from astropy.coordinates import SkyCoord
-from astropy import units
-from astropy.coordinates import EarthLocation, AltAz, ICRS, get_sun
-import numpy as np
-import astroplan
-import astroplan.plots as plots
-from astroplan import Observer
-from astroplan import FixedTarget
-from astropy.time import Time
-import ATATools.ata_sources as check
-import matplotlib.pyplot as plt
-from datetime import datetime
-from pytz import timezone
-import pytz
-
-import argparse
-import os,sys
+# Streamlit reruns this script on every widget interaction, so only light
+# modules are imported here. The catalog and ephemeris cache are built once per
+# server process (st.cache_resource); plots and calibrator schedules are
+# memoized by calibrator and time window (st.cache_data). matplotlib is only
+# imported when a figure is first drawn, and astropy/astroplan are not needed:
+# tracks come from the LST-gridded ephemeris cache. When astropy is installed
+# it only builds new grids, from the local IERS bundle (iers_bundle.py) so it
+# never tries to download tables.
+
+import io
 
+import numpy as np
 import streamlit as st
 
+from calibrator_catalog import CalibratorCatalog
+from ephemeris_cache import ATA_LAT, ATA_LON, EphemerisCache, plot_track
+from iers_bundle import use_bundle
+from pa_scheduler import best_windows, campaign_nights, iso_to_mjd, mjd_to_iso
+
+PLOT_POINTS = 200
+
 
-# H5_PATH = "/datax/scratch/cgchoza/testpipes/TIC159107668"
-# TEST_NODE_FILE = "/datag/pipeline/AGBT21A_996_49/blc03/blc03_guppi_59411_54700_UGCA127_0095.rawspec.0000.h5"
+@st.cache_resource
+def load_catalog() -> CalibratorCatalog:
+    return CalibratorCatalog.load()
 
-# @st.cache_data
-# def load_file(path: str) -> Waterfall:
-#     w = Waterfall(path)
-#     w.blank_dc(1)
-#     return stg.Frame(w)
 
-# def select_file():
-#     if st.checkbox("Use test file?"):
-#         return TEST_NODE_FILE
+@st.cache_resource
+def load_ephemeris() -> EphemerisCache:
+    try:
+        use_bundle()
+    except ImportError:
+        pass
+    return EphemerisCache(lat=ATA_LAT, lon=ATA_LON)
 
-#     st.subheader("File Selection")
-#     st.write(f"Loading files from `{H5_PATH}`...")
-#     files = os.listdir(H5_PATH)
-#     st.write(f"Found `{len(files)}` files!")
-#     files = [f for f in files if f.endswith("h5")]
-#     st.write(f"Found `{len(files)}` h5 files!")
-    
-#     file = st.selectbox("Choose a file:", files)
-#     path = Path(H5_PATH) / file
 
-#     return path
+@st.cache_data
+def track_figures(cal_name: str, ra_hours: float, dec_deg: float, start_mjd: float, end_mjd: float) -> tuple:
+    '''PNG altitude and parallactic angle plots of a calibrator for a UTC window'''
+    from matplotlib.figure import Figure
 
-# def display_metadata(f: stg.Frame):
-#     w = f.get_waterfall()
+    mjd = np.linspace(start_mjd, end_mjd, PLOT_POINTS)
+    alt, pa = load_ephemeris().track(cal_name, ra_hours, dec_deg, mjd)
+    label = cal_name if cal_name is not None else 'Calibrator'
+
+    images = []
+    for values, quantity, title in [(alt, 'altitude', f'{label} Altitude'),
+                                    (pa, 'parallactic', f'{label} Parallactic Angle')]:
+        fig = Figure(figsize=(4,4))
+        plot_track(fig.subplots(), mjd, values, quantity, title)
+        fig.tight_layout()
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format='png', dpi=150)
+        images.append(buffer.getvalue())
+    return tuple(images)
+
+
+@st.cache_data
+def schedule(start_mjd: float, end_mjd: float, duration: float, min_alt: float, nights: int) -> list:
+    return best_windows(load_catalog(), campaign_nights(start_mjd, (end_mjd - start_mjd) * 24, nights), duration,
+                        min_alt=min_alt)
 
-#     col1, col2 = st.columns(2)
-#     with col1:
-#         st.subheader("File Metadata")
-#         st.write(w.header)
-#     with col2:
-#         st.subheader("Computed Statistics")
-#         time = Time(w.header["tstart"], format="mjd").to_datetime()
-#         st.write(f"**Start time:** {time}")
 
 def get_info() -> tuple:
     '''Grab all necessary information for plotting from user inputs and set up'''
 
-    telescope_location = EarthLocation.from_geodetic(lat=40.8178*units.deg, lon=-121.4733*units.deg)
-
-    # Soon: add multiple calibrators, see if ATATools has a valid list somewhere
+    # Soon: add multiple calibrators
     # number_calibrators: int = st.number_input("Number of Calibrators", min_value=1, max_value=5)
     st.write("Input time range:")
     begin: str = st.text_input("Start time (UTC)", placeholder='2024-1-24T20:30:00')
     end: str = st.text_input("End time (UTC)", placeholder='2024-1-24T20:30:00')
 
+    # Calibrators come from the local catalog; extend it with calibrator_catalog.py
+    catalog = load_catalog()
     if st.checkbox("Input custom calibrator coordinates?"):
         cal_ra: float = st.number_input("Calibrator ra (hours)", placeholder=None)
         cal_dec: float = st.number_input("Calibrator dec (degrees)", placeholder=None)
-        cal_coords = ICRS(ra=cal_ra*units.hour,dec=cal_dec*units.deg)
 
-        target = FixedTarget(coord=cal_coords)
+        # Nearest catalog calibrators to the position
+        nearest = catalog.nearest(cal_ra, cal_dec, n=st.number_input("Nearest calibrators listed", min_value=1, value=5))
+        st.dataframe([{'name': cal['name'], 'ra (h)': cal['ra'], 'dec (deg)': cal['dec'], 'separation (deg)': sep}
+                      for cal, sep in nearest])
+        if st.checkbox("Plot nearest calibrator?"):
+            cal = nearest[0][0]
+            target = (cal['name'], cal['ra'], cal['dec'])
+        else:
+            target = (None, cal_ra, cal_dec)
 
     else:
-        cal_name: str = st.text_input("Calibrator Name", placeholder='3c286')
-        cal_dict = check.check_source(cal_name)
-        cal_ra = cal_dict['ra']
-        cal_dec = cal_dict['dec']
-        cal_coords = ICRS(ra=cal_ra*units.hour, dec=cal_dec*units.deg)
+        cal_name: str = st.selectbox("Calibrator Name", catalog.names())
+        cal = catalog.lookup(cal_name)
+        target = (cal_name, cal['ra'], cal['dec'])
 
-        target = FixedTarget(name=cal_name, coord=cal_coords)
+    if not begin or not end:
+        st.info("Enter a start and end time.")
+        st.stop()
+    try:
+        start_mjd, end_mjd = iso_to_mjd(begin), iso_to_mjd(end)
+    except ValueError:
+        st.error("Times must look like 2024-1-24T20:30:00")
+        st.stop()
 
-    ata = Observer(location=telescope_location, name="ATA", timezone="US/Pacific")
-    
-    start_time = Time(begin, scale='utc')
-    end_time = Time(end, scale='utc')
-    obs_times = start_time + (end_time - start_time) * np.linspace(0, 1, 200)
-
-    return (ata, target, obs_times)
+    return (target, start_mjd, end_mjd)
 
 
 
 def plot_data(info: tuple):
 
-    telescope_loc, targ_loc, obs_times = info
-    cal_name = targ_loc.name
+    target, start_mjd, end_mjd = info
 
+    altitude_png, parallactic_png = track_figures(*target, start_mjd, end_mjd)
     col1, col2 = st.columns(2)
     with col1:
-        fig1, ax1 = plt.subplots(nrows=1,ncols=1, figsize=(4,4))
-        style_kwargs = {'lw':1.5, 'marker':'.', 'markersize':0.5}
-        # Calculate altitudes at each obs time
-        plots.time_dependent.plot_altitude(ax=ax1, targets=targ_loc, observer=telescope_loc, time=obs_times, style_kwargs=style_kwargs)
-        ax1.grid(True, linestyle='-.')
-        if cal_name is not None:
-                ax1.set_title(f'{cal_name} Altitude')
-        else:
-                ax1.set_title('Calibrator Altitude')
-
-        # st.write(ax1.get_xticklabels())
-        # if st.checkbox("Use local time?"):  
-        #     # date_format = '%m/%d/%Y %H:%M:%S %Z'
-        #     # date_times = obs_times.to_datetime()
-        #     # pacific_times = [stamp.astimezone(timezone('US/Pacific')) for stamp in date_times]
-        #     labels = ax1.get_xticklabels()
-        #     for i in range(8):
-        #         ilabel = labels[str(i)]
-        #         hours = ilabel.split("'")[1]
-        #         hours_digit = 
-
-        st.pyplot(fig1)
-        
+        st.image(altitude_png)
+
     with col2:
-        fig2, ax2 = plt.subplots(nrows=1,ncols=1, figsize=(4,4))
-        # Calculate parallactic angle at each obs time
-        plots.time_dependent.plot_parallactic(ax=ax2, target=targ_loc, observer=telescope_loc, time=obs_times)
-        ax2.grid(True, linestyle='-.')
-        if cal_name is not None:
-                ax2.set_title(f'{cal_name} Parallactic Angle')
-        else:
-                ax2.set_title('Calibrator Parallactic Angle')
-        st.pyplot(fig2)
+        st.image(parallactic_png)
+
+def schedule_calibrators(info: tuple):
+    '''Rank catalog calibrators by parallactic angle coverage in the chosen window'''
+    _, start, end = info
+    st.subheader("Polarization calibrator windows")
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        duration: float = st.number_input("Session length (hours)", min_value=0.25, value=3.0)
+    with col2:
+        min_alt: float = st.number_input("Elevation limit (degrees)", min_value=0.0, max_value=89.0, value=20.0)
+    with col3:
+        nights: int = st.number_input("Nights", min_value=1, value=1)
+
+    if duration * 60 > (end - start) * 1440:
+        st.write("The session is longer than the time range.")
+        return
+    windows = schedule(start, end, duration, min_alt, nights)
+    st.dataframe([{'calibrator': w['calibrator'], 'night': w['night'] + 1,
+                   'start (UTC)': mjd_to_iso(w['start']), 'end (UTC)': mjd_to_iso(w['end']),
+                   'PA span (deg)': round(w['pa_span'], 1), 'min alt (deg)': round(w['min_alt'], 1)}
+                  for w in windows])
 
 def main():
     st.title("ATAPol Planner")
@@ -147,6 +149,10 @@ def main():
 
     plot_data(info)
 
+    st.divider()
+
+    schedule_calibrators(info)
+
 if __name__ == "__main__":
     st.set_page_config(layout="wide")
-    main()
\ No newline at end of file
+    main()
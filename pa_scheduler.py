@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+#############################################################################
+# Parallactic angle coverage scheduler for polarization calibrators
+#############################################################################
+
+# The leakage (Dflls) and X-Y phase (Xfparang) solves need the polarization
+# calibrator seen over a wide range of parallactic angle. For each night of
+# a campaign, this evaluates altitude and parallactic angle for every
+# catalog calibrator at once, on a (source, time) grid. It then slides a
+# window of the session length over the night. A window counts only if the
+# source stays above the elevation limit throughout; its score is the
+# parallactic angle span, from a running maximum and minimum of the angle
+# unwrapped in time. The best window of each calibrator on each night is
+# returned, ranked by span. A 12 hour night for ~1900 calibrators (the VLA
+# list) takes about 0.1 s at 5 minute steps.
+#
+# Usage:
+#
+#   python pa_scheduler.py --start 2024-01-24T20:30:00 --hours 12 --nights 3 --duration 3 --min-alt 20
+#
+# or from a planner:
+#
+#   windows = best_windows(CalibratorCatalog.load(), campaign_nights(start_mjd, 12., 3), duration_hours=3.)
+
+import argparse
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from ephemeris_cache import ATA_LAT, ATA_LON, altitude_parallactic
+from ms_metadata import local_sidereal_time
+
+MJD_EPOCH = datetime(1858, 11, 17)
+
+
+def iso_to_mjd(value: str) -> float:
+    '''MJD of an ISO UTC time such as 2024-01-24T20:30:00 (unpadded fields like 2024-1-24 are accepted)'''
+    value = value.strip().replace(' ', 'T')
+    try:
+        when = datetime.fromisoformat(value)
+    except ValueError:
+        when = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+    return (when - MJD_EPOCH).total_seconds() / 86400.
+
+
+def mjd_to_iso(mjd: float) -> str:
+    return (MJD_EPOCH + timedelta(days=float(mjd))).isoformat(timespec='minutes')
+
+
+def campaign_nights(start_mjd: float, hours: float, nights: int = 1) -> list:
+    '''[(start, end)] MJD windows of the same length on consecutive days'''
+    return [(start_mjd + n, start_mjd + n + hours / 24.) for n in range(nights)]
+
+
+def _sliding(values: np.ndarray, width: int, reduce) -> np.ndarray:
+    return reduce(np.lib.stride_tricks.sliding_window_view(values, width, axis=1), axis=-1)
+
+
+def night_windows(ra_hours, dec_deg, start_mjd: float, end_mjd: float, duration_hours: float,
+                  min_alt: float = 20., step_minutes: float = 5., lat: float = ATA_LAT, lon: float = ATA_LON) -> dict:
+    '''
+    Best window of duration_hours for every source between start_mjd and
+    end_mjd. Returns arrays over sources: 'start' and 'end' (MJD), 'pa_span'
+    and 'min_alt' (deg). A source never above min_alt for a whole window
+    has pa_span NaN.
+    '''
+    step = step_minutes / 1440.
+    mjd = np.arange(start_mjd, end_mjd + step / 2, step)
+    width = int(round(duration_hours * 60 / step_minutes)) + 1
+    n_src = len(np.atleast_1d(ra_hours))
+    if width > len(mjd):
+        raise ValueError(f"A {duration_hours} h session does not fit between {mjd_to_iso(start_mjd)} and "
+                         f"{mjd_to_iso(end_mjd)}")
+
+    lst = local_sidereal_time(mjd * 86400., np.deg2rad(lon))
+    ra = np.deg2rad(np.asarray(ra_hours, dtype=float) * 15.)[:, None]
+    dec = np.deg2rad(np.asarray(dec_deg, dtype=float))[:, None]
+    alt, pa = altitude_parallactic(lst[None, :], ra, dec, np.deg2rad(lat))
+    alt, pa = np.rad2deg(alt), np.rad2deg(np.unwrap(pa, axis=1))
+
+    # Windows with every sample above the limit, from a running count of samples below it
+    below = np.concatenate([np.zeros((n_src, 1), dtype=int), np.cumsum(alt < min_alt, axis=1)], axis=1)
+    valid = below[:, width:] == below[:, :-width]
+    span = np.where(valid, _sliding(pa, width, np.max) - _sliding(pa, width, np.min), -np.inf)
+
+    best = np.argmax(span, axis=1)
+    rows = np.arange(n_src)
+    pa_span = span[rows, best]
+    found = np.isfinite(pa_span)
+    return {
+        'start': mjd[best],
+        'end': mjd[best + width - 1],
+        'pa_span': np.where(found, pa_span, np.nan),
+        'min_alt': np.where(found, _sliding(alt, width, np.min)[rows, best], np.nan),
+    }
+
+
+def best_windows(catalog, nights: list, duration_hours: float, min_alt: float = 20., min_span: float = 0.,
+                 step_minutes: float = 5., top: int = 20, lat: float = ATA_LAT, lon: float = ATA_LON) -> list:
+    '''
+    Best window of each catalog calibrator on each night, ranked by
+    parallactic angle span, as [{'calibrator', 'night', 'start', 'end',
+    'pa_span', 'min_alt'}, ...] (top entries, MJD times, degrees).
+    '''
+    ra = [e['ra'] for e in catalog.entries]
+    dec = [e['dec'] for e in catalog.entries]
+    windows = []
+    for night, (start, end) in enumerate(nights):
+        result = night_windows(ra, dec, start, end, duration_hours, min_alt=min_alt, step_minutes=step_minutes,
+                               lat=lat, lon=lon)
+        for i in np.flatnonzero(result['pa_span'] >= min_span):
+            windows.append({'calibrator': catalog.entries[i]['name'], 'night': night,
+                            'start': float(result['start'][i]), 'end': float(result['end'][i]),
+                            'pa_span': float(result['pa_span'][i]), 'min_alt': float(result['min_alt'][i])})
+    windows.sort(key=lambda w: -w['pa_span'])
+    return windows[:top]
+
+
+def main():
+    from calibrator_catalog import DEFAULT_CATALOG, CalibratorCatalog
+
+    parser = argparse.ArgumentParser(description='Find calibrator windows with the widest parallactic angle coverage')
+    parser.add_argument('--start', required=True, help="Start of the first night (UTC, e.g. 2024-01-24T20:30:00)")
+    parser.add_argument('--hours', type=float, default=12., help="Length of each night in hours")
+    parser.add_argument('--nights', type=int, default=1, help="Number of consecutive nights")
+    parser.add_argument('--duration', type=float, default=3., help="Calibrator session length in hours")
+    parser.add_argument('--min-alt', dest='min_alt', type=float, default=20., help="Elevation limit in degrees")
+    parser.add_argument('--min-span', dest='min_span', type=float, default=0.,
+                        help="Smallest parallactic angle span listed, in degrees")
+    parser.add_argument('--catalog', default=DEFAULT_CATALOG, help="Calibrator catalog CSV")
+    parser.add_argument('-n', '--top', type=int, default=20, help="Number of windows listed")
+    args = parser.parse_args()
+
+    catalog = CalibratorCatalog.load(args.catalog)
+    nights = campaign_nights(iso_to_mjd(args.start), args.hours, args.nights)
+    windows = best_windows(catalog, nights, args.duration, min_alt=args.min_alt, min_span=args.min_span, top=args.top)
+    print(f"{'calibrator':<12} {'night':>5}  {'start (UTC)':<16}  {'end (UTC)':<16}  {'PA span':>8}  {'min alt':>7}")
+    for w in windows:
+        print(f"{w['calibrator']:<12} {w['night']:>5}  {mjd_to_iso(w['start']):<16}  {mjd_to_iso(w['end']):<16}  "
+              f"{w['pa_span']:8.1f}  {w['min_alt']:7.1f}")
+
+
+if __name__ == '__main__':
+    main()
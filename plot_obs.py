@@ -1,30 +1,30 @@
 #!/home/cchoza/.conda/envs/obs_plan/bin/python
 
-import pandas as pd
-from astropy.coordinates import SkyCoord
-from astropy import units
-from astropy.coordinates import EarthLocation, AltAz, ICRS, get_sun
 import numpy as np
-import astroplan
-import astroplan.plots as plots
-from astroplan import Observer
-from astroplan import FixedTarget
-from astropy.time import Time
-import ATATools.ata_sources as check
+from calibrator_catalog import CalibratorCatalog
+from ephemeris_cache import ATA_LAT, ATA_LON, EphemerisCache, plot_track
+from iers_bundle import use_bundle
+from pa_scheduler import iso_to_mjd
+from track_plots import TRACK_FIELDS
+from workers import run_modules
 
 import argparse
+import csv
 import os,sys
 
-import tkinter as tk
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
-import matplotlib.pyplot as plt
+# astropy, astroplan, Tk and pyplot are imported by the interactive planner only, so
+# --batch runs on nodes without a display or _tkinter
 
 class SideBySidePlotsApp:
     def __init__(self, root, cal_name, telescope_loc, obs_times, cal_loc):
+        import tkinter as tk
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+        import matplotlib.pyplot as plt
+
         self.root = root
         self.root.title("Obs Plot GUI")
 
-        # First plot: will be populated with astroplan altitude
+        # First plot: will be populated with altitude
         self.fig1, self.ax1 = plt.subplots(nrows=1,ncols=1, figsize=(5,5))
         self.create_plot(plot_type='alt', ax=self.ax1, cal_name=cal_name, telescope_loc=telescope_loc, obs_times=obs_times, targ_loc=cal_loc)
         self.canvas1 = FigureCanvasTkAgg(self.fig1, master=root)
@@ -33,7 +33,7 @@ class SideBySidePlotsApp:
         self.canvas_widget1 = self.canvas1.get_tk_widget()
         self.canvas_widget1.pack(side=tk.LEFT, fill=tk.BOTH, expand=1)
 
-        # Second plot: will be populated with astroplan parallactic angle
+        # Second plot: will be populated with parallactic angle
         self.fig2, self.ax2 = plt.subplots(nrows=1, ncols=1, figsize=(5,5))
         self.ax2 = self.create_plot(plot_type='par', ax=self.ax2, cal_name=cal_name, telescope_loc=telescope_loc, obs_times=obs_times, targ_loc=cal_loc)
         self.canvas2 = FigureCanvasTkAgg(self.fig2, master=root)
@@ -43,44 +43,119 @@ class SideBySidePlotsApp:
         self.canvas_widget2.pack(side=tk.LEFT, fill=tk.BOTH, expand=1)
 
     def create_plot(self, ax, plot_type, cal_name, obs_times, targ_loc, telescope_loc):
+        # Altitude and parallactic angle are interpolated from the source's cached LST grid
+        ephemeris = EphemerisCache(lat=telescope_loc.location.lat.deg, lon=telescope_loc.location.lon.deg)
+        alt, pa = ephemeris.track(cal_name, targ_loc.ra.hour, targ_loc.dec.deg, obs_times.mjd)
         
         if plot_type == 'alt':
-                # Calculate altitudes at each obs time
-                plots.time_dependent.plot_altitude(ax=ax, targets=targ_loc, observer=telescope_loc, time=obs_times)
-                plt.grid()
-                if cal_name is not None:
-                        plt.title(f'{cal_name} Altitude')
-                else:
-                        plt.title('Calibrator Altitude')
+                plot_track(ax, obs_times.mjd, alt, 'altitude',
+                           f'{cal_name} Altitude' if cal_name is not None else 'Calibrator Altitude')
 
         if plot_type == 'par':
-                # Calculate parallactic angle at each obs time
-                plots.time_dependent.plot_parallactic(ax=ax, target=targ_loc, observer=telescope_loc, time=obs_times)
-                plt.grid()
-                if cal_name is not None:
-                        plt.title(f'{cal_name} Parallactic Angle')
-                else:
-                        plt.title('Calibrator Parallactic Angle')
+                plot_track(ax, obs_times.mjd, pa, 'parallactic',
+                           f'{cal_name} Parallactic Angle' if cal_name is not None else 'Calibrator Parallactic Angle')
+        return ax
             
 
+def read_batch(path: str, catalog: CalibratorCatalog) -> list:
+    '''
+    Windows of a batch file: CSV rows of calibrator, begin, end (UTC) and
+    optionally ra_hours, dec_deg. Lines starting with # are skipped.
+    Calibrators without coordinates are resolved from the catalog, or
+    through ATATools when unknown.
+    '''
+    windows = []
+    with open(path, newline='') as f:
+        lines = [(number, line) for number, line in enumerate(f, 1) if line.strip() and not line.startswith('#')]
+    for (number, _), row in zip(lines[1:], csv.DictReader(line for _, line in lines)):
+        where = f"{path} line {number}"
+        name = (row.get('calibrator') or '').strip() or None
+        has_ra, has_dec = bool(row.get('ra_hours')), bool(row.get('dec_deg'))
+        if has_ra != has_dec:
+            raise ValueError(f"{where}: give both ra_hours and dec_deg, or neither")
+        if name is None and not has_ra:
+            raise ValueError(f"{where}: a window needs a calibrator name or ra_hours and dec_deg")
+        if not row.get('begin') or not row.get('end'):
+            raise ValueError(f"{where}: begin and end times are required")
+        try:
+            start_mjd, end_mjd = iso_to_mjd(row['begin']), iso_to_mjd(row['end'])
+            if has_ra:
+                ra, dec = float(row['ra_hours']), float(row['dec_deg'])
+        except ValueError as error:
+            raise ValueError(f"{where}: {error}") from None
+        if end_mjd <= start_mjd:
+            raise ValueError(f"{where}: end {row['end']} is not after begin {row['begin']}")
+
+        if not has_ra and name in catalog:
+            cal = catalog.lookup(name)
+            ra, dec = cal['ra'], cal['dec']
+        elif not has_ra:
+            import ATATools.ata_sources as check
+            cal_dict = check.check_source(name)
+            ra, dec = float(cal_dict['ra']), float(cal_dict['dec'])
+        windows.append({'index': len(windows), 'calibrator': name, 'ra': ra, 'dec': dec,
+                        'begin': row['begin'], 'end': row['end'], 'start_mjd': start_mjd, 'end_mjd': end_mjd})
+    return windows
+
+
+def run_batch(path: str, outdir: str, nproc: int = 0):
+    '''Render every window of a batch file to PNGs in outdir, with the tracks in outdir/tracks.csv'''
+    windows = read_batch(path, CalibratorCatalog.load())
+    os.makedirs(outdir, exist_ok=True)
+
+    # Build each calibrator's grid once here, so the workers only read them
+    ephemeris = EphemerisCache(lat=ATA_LAT, lon=ATA_LON)
+    for window in windows:
+        ephemeris.grid(window['calibrator'], window['ra'], window['dec'])
+
+    nproc = min(len(windows), nproc or os.cpu_count() or 1)
+    jobs = {os.path.join(outdir, f'batch{n}'): {'windows': windows[n::nproc], 'outdir': outdir,
+                                                'table': os.path.join(outdir, f'batch{n}.tracks.csv'),
+                                                'lat': ATA_LAT, 'lon': ATA_LON}
+            for n in range(nproc)}
+    done = run_modules('track_plots', jobs, nproc=nproc)
+
+    rows = []
+    for name in done:
+        with open(jobs[name]['table'], newline='') as f:
+            rows += list(csv.DictReader(f, TRACK_FIELDS))
+        os.remove(jobs[name]['table'])
+    rows.sort(key=lambda row: int(row['window']))
+    with open(os.path.join(outdir, 'tracks.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, TRACK_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"Rendered {sum(len(jobs[name]['windows']) for name in done)} of {len(windows)} windows to {outdir}")
+
+
 def main():
     parser = argparse.ArgumentParser(description=
             'Find nearest VLA calibrator to a specific sky position')
     
     parser.add_argument('-c', '--calibrator', dest='cal', type=str,
             help="The calibrator string name (VLA catalog)",
-            default='X')
+            default=None)
 
     parser.add_argument('-ra', '--rahours', dest='ra', type=float,
             help="Right Ascension in decimal hours")
     parser.add_argument('-dec', '--decdeg', dest='dec', type=float,
             help="Declination in decimal degrees")
     
+    parser.add_argument('-n', '--nearest', dest='nearest', type=int, default=0,
+            help="List this many catalog calibrators nearest to -ra/-dec and plot the nearest")
+
     parser.add_argument('-b', '--beginobs', dest='begin', type=str,
             help="Time to begin observation plot")
     parser.add_argument('-e', '--endobs', dest='end', type=str,
             help="Time to end observation plot")
 
+    parser.add_argument('--batch', dest='batch', type=str,
+            help="CSV of calibrator,begin,end[,ra_hours,dec_deg] windows to plot to files without a display")
+    parser.add_argument('-o', '--outdir', dest='outdir', type=str, default='obs_plots',
+            help="Output directory of --batch plots and tracks.csv")
+    parser.add_argument('-j', '--nproc', dest='nproc', type=int, default=0,
+            help="Worker processes for --batch (default one per core)")
+
     parser.add_argument('-hh', '--hheellpp', action='store_true',
             help='show more than this help message and exit')
 
@@ -90,6 +165,23 @@ def main():
 
     args = parser.parse_args()
 
+    # Local IERS tables, so astropy never waits on a download
+    try:
+          use_bundle()
+    except ImportError:
+          # Without astropy --batch still works; ephemeris grids fall back to spherical trigonometry
+          pass
+
+    if args.batch:
+          run_batch(args.batch, args.outdir, args.nproc)
+          return
+
+    from astropy import units
+    from astropy.coordinates import EarthLocation, ICRS
+    from astropy.time import Time
+    from astroplan import FixedTarget, Observer
+    import tkinter as tk
+
     cal_name = args.cal
     begin = args.begin
     end = args.end
@@ -101,9 +193,22 @@ def main():
           print("Must input either calibrator name or coordinates!")
           sys.exit()
 
-    if cal_ra is not None and cal_dec is not None:
-          cal_coords = ICRS(ra=cal_ra*units.deg,dec=cal_dec*units.deg)
+    # Calibrators are resolved from the local catalog; ATATools is only asked about unknown names
+    catalog = CalibratorCatalog.load()
+    if cal_ra is not None and cal_dec is not None and args.nearest:
+          nearest = catalog.nearest(cal_ra, cal_dec, n=args.nearest)
+          for cal, sep in nearest:
+                print(f"{cal['name']:<12} ra {cal['ra']:9.5f} h  dec {cal['dec']:+9.5f} deg  separation {sep:.3f} deg")
+          cal = nearest[0][0]
+          cal_name = cal['name']
+          cal_coords = ICRS(ra=cal['ra']*units.hour, dec=cal['dec']*units.deg)
+    elif cal_ra is not None and cal_dec is not None:
+          cal_coords = ICRS(ra=cal_ra*units.hour,dec=cal_dec*units.deg)
+    elif cal_name in catalog:
+          cal = catalog.lookup(cal_name)
+          cal_coords = ICRS(ra=cal['ra']*units.hour, dec=cal['dec']*units.deg)
     else:
+          import ATATools.ata_sources as check
           cal_dict = check.check_source(cal_name)
           cal_ra = cal_dict['ra']
           cal_dec = cal_dict['dec']
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+#############################################################################
+# Iterative polarization calibration until convergence
+#############################################################################
+
+# Repeats the gain, delay, bandpass, polarization-model, cross-hand delay,
+# X-Y phase and leakage solves. Each iteration pre-applies the previous
+# leakage and cross-hand solutions and uses the previous Stokes model, and
+# tables are named with the iteration number (.G0i1, _pol.D0i2, ...). After
+# every iteration the change in the D-terms, the X-Y phase and the fractional
+# Q/U of the polarization calibrator is measured against the previous one,
+# and the loop stops once all three are within tolerance.
+#
+# Usage inside a calibration script:
+#
+#   start = {'kcross': kcross, 'Xfparang': Xfparang, 'leakage': leakage, 'qu_model': qu_model}
+#   result = iterate_polarization_calibration(obs_vis, tab_name, start, bandpass_calibrator=bcal,
+#                                             polarization_calibrator=pol_cal, ref_ant=ref_ant)
+
+import numpy as np
+
+# Largest change between iterations still counted as converged
+TOLERANCES = {
+    'dterm': 1e-3,      # |D| (complex leakage amplitude)
+    'xy_phase': 0.5,    # degrees
+    'qu': 1e-3,         # fractional linear polarization, hypot(dQ/I, dU/I)
+}
+
+
+def iteration_tables(tab_name: str, n: int) -> dict:
+    suffix = f'i{n}'
+    tables = {name: f'{tab_name}.{name}{suffix}' for name in ['G0', 'G1', 'K0', 'B0', 'G2', 'G3']}
+    tables.update({'pol_G3': f'{tab_name}_pol.G3{suffix}', 'kcross': f'{tab_name}_pol.Kcross0{suffix}',
+                   'Xfparang': f'{tab_name}_pol.Xfparang{suffix}', 'leakage': f'{tab_name}_pol.D0{suffix}'})
+    return tables
+
+
+def polcal_iteration(vis: str, tab_name: str, n: int, previous: dict, bandpass_calibrator: str,
+                     polarization_calibrator: str, ref_ant: str, gain_field: str = '', spw: str = '0',
+                     pol_spw: str = '0', run=None) -> dict:
+    '''
+    One pass of the calibration chain, starting from the previous leakage,
+    cross-hand delay and Stokes model. run(task, **kwargs) runs each task
+    (e.g. StepCache.run); by default tasks are called directly.
+    Returns the new tables, Stokes model and X-Y phase model.
+    '''
+    from casatasks import bandpass, gaincal, polcal, polfromgain
+    from spw_calibration import best_crosshand_scan
+    run = run or (lambda task, **kwargs: task(**kwargs))
+    t = iteration_tables(tab_name, n)
+    leakage, kcross = previous['leakage'], previous['kcross']
+    spw_key = f"Spw{spw.split(':')[0]}"
+    pol_cal = polarization_calibrator
+
+    # Gains, delays and bandpass on the bandpass calibrator with the previous leakage removed
+    run(gaincal, vis=vis, caltable=t['G0'], field=bandpass_calibrator, spw=spw, refant=ref_ant, refantmode='strict',
+        calmode='p', solint='inf', gaintable=[leakage], parang=True)
+    run(gaincal, vis=vis, caltable=t['G1'], field=bandpass_calibrator, spw=spw, refant=ref_ant, refantmode='strict',
+        calmode='a', solint='100', preavg=1, minblperant=1, minsnr=0, gaintype='G', gaintable=[t['G0'], leakage],
+        parang=True)
+    run(gaincal, vis=vis, caltable=t['K0'], field=bandpass_calibrator, spw=spw, refant=ref_ant, solint='inf',
+        combine='scan', preavg=1, minblperant=1, gaintype='K', gaintable=[t['G0'], t['G1'], kcross], parang=True)
+    run(bandpass, vis=vis, caltable=t['B0'], field=bandpass_calibrator, spw=spw, refant=ref_ant, bandtype='B',
+        gaintable=[t['G0'], t['G1'], t['K0'], leakage], parang=True)
+    run(gaincal, vis=vis, caltable=t['G2'], field=gain_field or bandpass_calibrator, spw=spw, refant=ref_ant,
+        calmode='ap', solint='300', gaintable=[t['K0'], t['B0'], leakage, t['G0'], t['G1']], parang=True)
+
+    # Polarization calibrator gains absorbing the parallactic angle variation give the Stokes model
+    run(gaincal, vis=vis, caltable=t['G3'], field=pol_cal, spw=spw, refant=ref_ant, calmode='ap', solint='300',
+        gaintable=[t['K0'], t['B0'], t['G2'], leakage, t['G0'], t['G1']])
+    qu_model = run(polfromgain, vis=vis, tablein=t['G3'])
+    smodel = qu_model[pol_cal][spw_key]
+
+    run(gaincal, vis=vis, caltable=t['pol_G3'], refant=ref_ant, refantmode='strict', solint='300', calmode='ap',
+        spw=spw, field=pol_cal, smodel=smodel, parang=True,
+        gaintable=[t['K0'], t['B0'], t['G2'], leakage, t['G0'], t['G1']])
+
+    # Cross-hand delay on the scan with the most X-Y signal, then X-Y phase and leakage
+    best_scan = best_crosshand_scan(t['G3'])
+    run(gaincal, vis=vis, caltable=t['kcross'], spw=pol_spw, refant=ref_ant, solint='inf', field=pol_cal,
+        gaintype='KCROSS', scan=str(best_scan), smodel=[1, 0, 1, 0], calmode='ap', minblperant=1,
+        refantmode='strict', parang=True)
+    S_model = run(polcal, vis=vis, caltable=t['Xfparang'], field=pol_cal, spw=pol_spw, solint='inf', combine='scan',
+                  preavg=300, smodel=smodel, poltype='Xfparang+QU',
+                  gaintable=[t['B0'], t['G0'], t['G1'], t['G2'], t['pol_G3'], t['kcross'], leakage])
+    run(polcal, vis=vis, caltable=t['leakage'], field=pol_cal, spw=pol_spw, solint='inf', combine='scan', preavg=300,
+        smodel=smodel, poltype='Dflls', refant='',
+        gaintable=[t['B0'], t['G0'], t['G1'], t['G2'], t['pol_G3'], t['kcross'], t['Xfparang']])
+
+    return {'tables': t, 'kcross': t['kcross'], 'Xfparang': t['Xfparang'], 'leakage': t['leakage'],
+            'qu_model': qu_model, 'S_model': S_model, 'best_scan': best_scan}
+
+
+def _solutions(caltable: str):
+    '''CPARAM of a caltable as (npol, nchan, nrow) with flagged solutions as NaN'''
+    from casatools import table
+    tb = table()
+    tb.open(caltable)
+    values = tb.getcol('CPARAM')
+    flags = tb.getcol('FLAG')
+    tb.close()
+    return np.where(flags, np.nan, values)
+
+
+def _fractional_qu(qu_model: dict, field: str, spw_key: str) -> np.ndarray:
+    i, q, u = qu_model[field][spw_key][:3]
+    return np.array([q, u]) / i
+
+
+def solution_change(previous: dict, current: dict, polarization_calibrator: str, spw: str = '0') -> dict:
+    '''
+    Change between two iterations: the largest per-antenna, per-correlation
+    median (over channels) change in the D-terms and X-Y phase, and the
+    change in fractional Q and U of the polarization calibrator.
+    '''
+    spw_key = f"Spw{spw.split(':')[0]}"
+    changes = {}
+    with np.errstate(invalid='ignore'):
+        d_old, d_new = _solutions(previous['leakage']), _solutions(current['leakage'])
+        if d_old.shape == d_new.shape:
+            changes['dterm'] = float(np.nanmax(np.nanmedian(np.abs(d_new - d_old), axis=1)))
+        else:
+            changes['dterm'] = np.inf
+        xy_old, xy_new = _solutions(previous['Xfparang']), _solutions(current['Xfparang'])
+        if xy_old.shape == xy_new.shape:
+            changes['xy_phase'] = float(np.nanmax(np.nanmedian(np.abs(np.rad2deg(np.angle(xy_new / xy_old))), axis=1)))
+        else:
+            changes['xy_phase'] = np.inf
+    changes['qu'] = float(np.hypot(*(_fractional_qu(current['qu_model'], polarization_calibrator, spw_key) -
+                                     _fractional_qu(previous['qu_model'], polarization_calibrator, spw_key))))
+    return changes
+
+
+def iterate_polarization_calibration(vis: str, tab_name: str, start: dict, max_iterations: int = 5,
+                                     tolerances: dict = None, **chain) -> dict:
+    '''
+    Repeat polcal_iteration (with the keyword arguments in chain) from the
+    start solutions until the D-terms, X-Y phase and Q/U change by less than
+    the tolerances, or for max_iterations. Returns the last iteration's
+    result with 'iterations', 'converged' and the per-iteration 'history'.
+    '''
+    tolerances = {**TOLERANCES, **(tolerances or {})}
+    previous = start
+    history = []
+    converged = False
+    for n in range(1, max_iterations + 1):
+        current = polcal_iteration(vis, tab_name, n, previous, **chain)
+        change = solution_change(previous, current, chain['polarization_calibrator'], chain.get('spw', '0'))
+        history.append(change)
+        converged = all(change[key] <= tolerances[key] for key in tolerances)
+        print(f"Iteration {n}: " + ', '.join(f"{key} change {value:.4g}" for key, value in change.items()))
+        previous = current
+        if converged:
+            print(f"Polarization calibration converged after {n} iterations")
+            break
+    else:
+        print(f"Polarization calibration not converged after {max_iterations} iterations")
+    return {**previous, 'iterations': len(history), 'converged': converged, 'history': history}
@@ -19,6 +19,22 @@ import glob
 import subprocess
 import numpy as np
 
+# Helper modules live alongside these scripts; set ATA_POL_SCRIPTS when running
+# from a data directory
+script_dir = os.path.dirname(os.path.abspath(__file__)) if '__file__' in globals() else os.getcwd()
+sys.path.insert(0, os.environ.get('ATA_POL_SCRIPTS', script_dir))
+from step_cache import StepCache
+from run_manifest import RunManifest
+from ms_metadata import cached_listobs, cell_size, ms_summary
+from imaging import calibrator_job, run_imaging_jobs, target_job
+from caltable_plots import caltable_plot, render_caltable_plots
+from flagging import apply_flags, flag_commands
+from sumthreshold import sumthreshold_flag
+from callib import apply_callib, write_callib
+from field_split import split_fields
+from polcal_iteration import iterate_polarization_calibration
+from calibrator_models import set_model
+
 #############################################################################
 # Fields for user to edit per-observation
 #############################################################################
@@ -42,7 +58,18 @@ obs_vis = '3c391_obs.ms'
 use_3c286 = False
 generate_plots = True
 iterate_calibration = False
+max_iterations = 5                # Polarization calibration passes at most when iterating
+iteration_tolerances = {}         # Overrides of polcal_iteration.TOLERANCES (dterm, xy_phase, qu)
 do_image = True
+use_step_cache = True             # Reuse caltables from a previous run when nothing upstream changed
+resume_run = True                 # Skip stages already recorded as complete in the run manifest
+imaging_workers = 0               # Fields imaged at once; 0 lets memory and core count decide
+joint_stokes_imaging = True       # Grid target Stokes I, Q, U and V in one tclean instead of one per Stokes
+bad_antennas = ['1b', '1e']       # Flagged outright ('4e' has also been bad)
+autoflag_fields = [target]        # Fields flagged with tfcrop and rflag, or SumThreshold
+sumthreshold_preflag = True       # SumThreshold flagging of autoflag_fields in place of tfcrop and rflag
+write_calibrated_ms = False       # Also split the whole calibrated observation to {tab_name}_calibrated.ms
+virtual_models = True             # Calibrator models evaluated on the fly instead of written to MODEL_DATA
 
 tab_name = obs_vis.split('.')[0]
 
@@ -53,109 +80,106 @@ antennas = ['1b', '1c', '1e', '1g', '1h', '1k',
             '3d', '3l', '4e', '4j', '5e']
 antenna_list = ','.join([f'"{a}"' for a in antennas])
 
+# Solves are fingerprinted by task, arguments, input caltables and MS state
+cache = StepCache(obs_vis, cache_file=f'{tab_name}.step_cache.json', enabled=use_step_cache)
+# Completed stages are recorded so a crashed run restarts at the first incomplete one
+manifest = RunManifest(f'{tab_name}.manifest.json', resume=resume_run)
+
 
 #############################################################################
 # Define useful functions
 #############################################################################
 
-def calibrator_diagnostics(calibrator: str = '', image_base: str = '', cell_size: float = 0):
-        ia.open(f'{image_base}_clean_iter2.image.tt0')
-        maj = ia.restoringbeam()['major']['value']
-        min = ia.restoringbeam()['minor']['value']
-        pos = ia.restoringbeam()['positionangle']['value']
-        ia.close()
-
-
-        fit_name = f'./IMAGES/{calibrator}/fitting_region.crtf'
-        f = open(fit_name, 'w')
-        f.write('#CRTF\n')
-        f.write(f'circle[[1024pix, 1024pix],{cell_size * 8. * 5.}arcsec]')
-        f.close()
-
-        est_name = f'./IMAGES/{calibrator}/estimates.txt'
-        f = open(est_name, 'w')
-        f.write(f'1,1024,1024,{maj}arcsec,{min}arcsec,{pos}deg,abp')
-        f.close()
-
-        fit_results = imfit(imagename=f'{image_base}_clean_iter2.image.tt0', region=fit_name, estimates=est_name)
-        flux_density = fit_results['deconvolved']['component0']['flux']['value'][0]
-        error = fit_results['deconvolved']['component0']['flux']['error'][0]
-
-        fit_result_name = f'./IMAGES/{calibrator}/fitting_results.txt'
-        f = open(fit_result_name, 'w')
-        f.write(str(flux_density) + ',' + str(error))
-        f.close()
-
 def generate_plots(use_3c286: bool = False):
-        # Plot preliminary gain amplitudes
-        plotms(vis=f'{tab_name}.G0', xaxis='antenna1', yaxis='gainphase',
-        coloraxis='corr', antenna=antenna_list, spw='0',
-        plotfile=f'G1_{tab_name}_phase.png', overwrite=True)
-        # Plot preliminary gain phases
-        plotms(vis=f'{tab_name}.G1', xaxis='antenna1', yaxis='gainamp',
-        coloraxis='corr', antenna=antenna_list, spw='0',
-        plotfile=f'G0_{tab_name}_amp.png', overwrite=True)
-
-        # Bandpass solutions, frequency vs amplitude and phase
-        for ax in ['amp', 'phase']:
-                plotms(vis=f'{tab_name}.B0', xaxis='freq', yaxis=f'gain{ax}',
-                coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
-                yselfscale=True, antenna=antenna_list, spw='0',
-                plotfile=f'B0_{tab_name}_{ax}.png', overwrite=True)
+        # Caltables are read once and drawn with matplotlib in parallel workers
+        plots = [
+                # Plot preliminary gain amplitudes
+                caltable_plot(f'{tab_name}.G0', 'antenna1', 'gainphase', f'G1_{tab_name}_phase.png',
+                              antenna=antennas, spw='0'),
+                # Plot preliminary gain phases
+                caltable_plot(f'{tab_name}.G1', 'antenna1', 'gainamp', f'G0_{tab_name}_amp.png',
+                              antenna=antennas, spw='0'),
+        ]
 
-        
-        # For bandpass calibrator, gain amplitude and phase
-        plotms(vis=f'{tab_name}.G2', xaxis='time', yaxis=f'gainamp',
-                coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
-                yselfscale=True, antenna=antenna_list, spw='0',
-                plotfile=f'G2_{bandpass_calibrator}_{tab_name}_amp.png', overwrite=True)
-        plotms(vis=f'{tab_name}.G2', xaxis='time', yaxis=f'gainphase',
-                coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
-                yselfscale=True, antenna=antenna_list, spw='0',
-                plotfile=f'G2_{bandpass_calibrator}_{tab_name}_phase.png', overwrite=True)
+        for ax in ['amp', 'phase']:
+                # Bandpass solutions, frequency vs amplitude and phase
+                plots.append(caltable_plot(f'{tab_name}.B0', 'freq', f'gain{ax}', f'B0_{tab_name}_{ax}.png',
+                                           iteraxis='antenna', antenna=antennas, spw='0'))
+                # For bandpass calibrator, gain amplitude and phase
+                plots.append(caltable_plot(f'{tab_name}.G2', 'time', f'gain{ax}', f'G2_{bandpass_calibrator}_{tab_name}_{ax}.png',
+                                           iteraxis='antenna', antenna=antennas, spw='0'))
 
         if not use_3c286:
                 # For phase calibrator, gain amplitude and phase
-                plotms(vis=f'{tab_name}_pol.G3', xaxis='time', yaxis=f'gainamp',
-                        coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
-                        yselfscale=True, antenna=antenna_list, spw='0',
-                        plotfile=f'G3_{tab_name}_pol_amp.png', overwrite=True)
-                plotms(vis=f'{tab_name}_pol.G3', xaxis='time', yaxis=f'gainphase',
-                        coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
-                        yselfscale=True, antenna=antenna_list, spw='0',
-                        plotfile=f'G3_{phase_calibrator}_{tab_name}_pol_phase.png', overwrite=True)
-                
+                plots.append(caltable_plot(f'{tab_name}_pol.G3', 'time', 'gainamp', f'G3_{tab_name}_pol_amp.png',
+                                           iteraxis='antenna', antenna=antennas, spw='0'))
+                plots.append(caltable_plot(f'{tab_name}_pol.G3', 'time', 'gainphase',
+                                           f'G3_{phase_calibrator}_{tab_name}_pol_phase.png',
+                                           iteraxis='antenna', antenna=antennas, spw='0'))
+
                 # Plot of Kcross solutions
-                plotms(vis=f'{tab_name}_pol.Kcross0', yaxis='delay', spw='0',
-                        antenna=ref_ant, coloraxis='corr',
-                        plotfile=f'{tab_name}_Kcross0.png', overwrite=True)
-        
-                # Plots of phase-frequency and real/imaginary leakage terms by antenna
-                plotms(vis=f'{tab_name}_pol.Xfparang', xaxis='freq', yaxis='gainphase',
-                                plotfile=f'{tab_name}_freq_vs_gainphase.png', overwrite=True)
+                plots.append(caltable_plot(f'{tab_name}_pol.Kcross0', 'time', 'delay', f'{tab_name}_Kcross0.png',
+                                           antenna=[ref_ant], spw='0'))
 
+                # Plots of phase-frequency and real/imaginary leakage terms by antenna
+                plots.append(caltable_plot(f'{tab_name}_pol.Xfparang', 'freq', 'gainphase',
+                                           f'{tab_name}_freq_vs_gainphase.png'))
                 for ax in ['real', 'imag']:
-                        plotms(vis=f'{tab_name}_pol.D0', xaxis='freq', yaxis=ax,
-                                        coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
-                                        yselfscale=True, antenna=antenna_list,
-                                        plotfile=f'D0_{tab_name}_pol_{ax}.png', overwrite=True)
-                                
+                        plots.append(caltable_plot(f'{tab_name}_pol.D0', 'freq', ax, f'D0_{tab_name}_pol_{ax}.png',
+                                                   iteraxis='antenna', antenna=antennas))
+
+        render_caltable_plots(plots)
+
+        # CORRECTED_DATA of obs_vis is always current after the apply stage; the split
+        # {tab_name}_calibrated.ms only exists with write_calibrated_ms
+        if not use_3c286:
                 for ax in ['real', 'imag']:
                                 # Real and imaginary components versus parallactic angle for polarization calibrator
-                        plotms(vis=f'{tab_name}_calibrated.ms', ydatacolumn='corrected', xaxis='parang', yaxis=ax,
+                        plotms(vis=obs_vis, ydatacolumn='corrected', xaxis='parang', yaxis=ax,
                                 coloraxis='corr', field=polarization_calibrator, avgchannel='168', spw='0',
                                 plotfile=f'{tab_name}_parang_corrected_{ax}_vs_parang.png', overwrite=True)
                         # Real and imaginary components versus frequency for polarization calibrator
-                        plotms(vis=f'{tab_name}_calibrated.ms', ydatacolumn='corrected', xaxis='freq', yaxis=ax,
+                        plotms(vis=obs_vis, ydatacolumn='corrected', xaxis='freq', yaxis=ax,
                                 coloraxis='corr', field=polarization_calibrator, avgtime='100000', avgscan=True, spw='0',
                                 plotfile=f'{tab_name}_parang_corrected_{ax}_vs_freq.png', overwrite=True)
                         # Parallactic angle-corrected real vs imaginary components for polarization calibrator
-                plotms(vis=f'{tab_name}_calibrated.ms', xdatacolumn='corrected', ydatacolumn='corrected',
+                plotms(vis=obs_vis, xdatacolumn='corrected', ydatacolumn='corrected',
                         xaxis='real', yaxis='imag', coloraxis='corr', field=polarization_calibrator,
                         avgtime='100000', avgscan=True, avgchannel='168', spw='0',
                         plotfile=f'{tab_name}_parang_corrected_reim.png')
 
 
+def calibration_field_tables(tables: dict, pol_tables: list) -> dict:
+        '''
+        Cal library layout {field: [(caltable, gainfield, interp), ...]} from the
+        K0, G2, B0 and pol_G3 tables in tables and the leakage/cross-hand pol_tables.
+        Every field's tables, gainfields and interpolation go into one cal
+        library so a single applycal pass calibrates all fields. A field
+        listed twice keeps its last set of tables
+        '''
+        standard_tables = [(tables['K0'], bandpass_calibrator, 'nearest'),
+                           (tables['G2'], phase_calibrator, 'linearflag'),
+                           (tables['B0'], bandpass_calibrator, 'nearest')]
+
+        field_tables = {bandpass_calibrator: [(tables['K0'], bandpass_calibrator, 'nearest'),
+                                              (tables['G2'], bandpass_calibrator, 'linearflag'),
+                                              (tables['B0'], bandpass_calibrator, 'nearest')] + pol_tables}
+        if use_3c286:
+                for field in [phase_calibrator, polarization_calibrator, target]:
+                        if field != '':
+                                field_tables[field] = standard_tables + pol_tables
+        else:
+                if polarization_calibrator != phase_calibrator:
+                        field_tables[polarization_calibrator] = [(tables['K0'], bandpass_calibrator, 'nearest'),
+                                                                 (tables['G2'], polarization_calibrator, 'linearflag'),
+                                                                 (tables['pol_G3'], polarization_calibrator, 'nearest'),
+                                                                 (tables['B0'], bandpass_calibrator, 'nearest')] + pol_tables
+                for field in [phase_calibrator, target]:
+                        if field != '':
+                                field_tables[field] = standard_tables + pol_tables
+        return field_tables
+
+
 #############################################################################
 # Begin standard calibration
 #############################################################################
@@ -172,44 +196,51 @@ else:
         gain_calibrators = f'{bandpass_calibrator}'
 
 print(f"Gain calibrators: {gain_calibrators}")
-# FLAGGING: script assumes pre-flagging using aoflagger.
-## If manual flagging desired, uncomment the below and edit to suit
-flagdata(vis=obs_vis, mode='manual', antenna="'1b'", flagbackup=False)
-flagdata(vis=obs_vis, mode='manual', antenna="'1e'", flagbackup=False)
-# flagdata(vis=obs_vis, mode='manual', antenna="'4e'", flagbackup=False)
-flagdata(vis=obs_vis, field=target, mode='tfcrop', datacolumn='DATA')
-flagdata(vis=obs_vis, field=target, mode='rflag', datacolumn='DATA')
-
-# Set flux model for flux calibrator 
-setjy(vis=obs_vis, field=bandpass_calibrator, standard='Perley-Butler 2017', usescratch=True)
-
-# Listobs
-listobs(vis=obs_vis)
-
-print("Preliminary gaincal")
-# Preliminary gaincal
-# This will be thrown away after solving for delay and bandpass
-gaincal(vis=obs_vis, caltable=f'{tab_name}.G0', field=bandpass_calibrator, spw=spw, refant=ref_ant, refantmode='strict', calmode='p', 
-        solint='inf', parang=True)
-gaincal(vis=obs_vis, caltable=f'{tab_name}.G1', field=bandpass_calibrator, spw=spw, refant=ref_ant, refantmode='strict', calmode='a', 
-        solint='100', preavg=1, minblperant=1, minsnr=0, gaintype='G', gaintable=[f'{tab_name}.G0'], parang=True)
-
-print("Delay calibration")
-# Delay calibration
-gaincal(vis=obs_vis, caltable=f'{tab_name}.K0', field=bandpass_calibrator, spw=spw, refant=ref_ant, solint='inf', combine='scan', 
-        preavg=1, minblperant=1, gaintype='K', gaintable=[f'{tab_name}.G0', f'{tab_name}.G1'], parang=True)
-
-print("Bandpass calibration")
-# Bandpass
-# NOTE: low freq spectral windows so we'll use a small averaging window, may be appropriate to allow edit
-bandpass(vis=obs_vis, caltable=f'{tab_name}.B0', field=bandpass_calibrator, spw=spw, refant=ref_ant,
-         bandtype='B', gaintable=[f'{tab_name}.G0', f'{tab_name}.G1', f'{tab_name}.K0'], parang=True)
-
-# For fluxscale to work, we need a gain table with flux cal field and other gain calibrators both present
-# Gaintype T to preserve the relative gains of XY feeds, needs testing
-print("Second round gain calibration")
-gaincal(vis=obs_vis, caltable=f'{tab_name}.G2', field=gain_calibrators, spw=spw, refant=ref_ant, calmode='ap', solint='300', 
-        gaintype='G', minsnr=0, gaintable=[f'{tab_name}.K0', f'{tab_name}.B0'], parang=True)
+if manifest.pending('flagging_and_models'):
+        # FLAGGING: script assumes pre-flagging using aoflagger.
+        ## Manual and automatic flags are set by bad_antennas and autoflag_fields,
+        ## and run in a single flagdata pass
+        cache.run(apply_flags, modifies_vis=True, vis=obs_vis,
+                  commands=flag_commands(bad_antennas=bad_antennas,
+                                         autoflag_fields=[] if sumthreshold_preflag else autoflag_fields))
+        if sumthreshold_preflag:
+                cache.run(sumthreshold_flag, modifies_vis=True, vis=obs_vis, fields=autoflag_fields)
+
+        # Set flux model for flux calibrator 
+        cache.run(set_model, modifies_vis=True, vis=obs_vis, field=bandpass_calibrator, virtual=virtual_models,
+                  standard='Perley-Butler 2017')
+
+        # Listobs
+        cached_listobs(obs_vis)
+        manifest.complete('flagging_and_models')
+
+standard_products = [f'{tab_name}.{name}' for name in ['G0', 'G1', 'K0', 'B0', 'G2']]
+if manifest.pending('standard_calibration', products=standard_products):
+        print("Preliminary gaincal")
+        # Preliminary gaincal
+        # This will be thrown away after solving for delay and bandpass
+        cache.run(gaincal, vis=obs_vis, caltable=f'{tab_name}.G0', field=bandpass_calibrator, spw=spw, refant=ref_ant, refantmode='strict', calmode='p', 
+                solint='inf', parang=True)
+        cache.run(gaincal, vis=obs_vis, caltable=f'{tab_name}.G1', field=bandpass_calibrator, spw=spw, refant=ref_ant, refantmode='strict', calmode='a', 
+                solint='100', preavg=1, minblperant=1, minsnr=0, gaintype='G', gaintable=[f'{tab_name}.G0'], parang=True)
+
+        print("Delay calibration")
+        # Delay calibration
+        cache.run(gaincal, vis=obs_vis, caltable=f'{tab_name}.K0', field=bandpass_calibrator, spw=spw, refant=ref_ant, solint='inf', combine='scan', 
+                preavg=1, minblperant=1, gaintype='K', gaintable=[f'{tab_name}.G0', f'{tab_name}.G1'], parang=True)
+
+        print("Bandpass calibration")
+        # Bandpass
+        # NOTE: low freq spectral windows so we'll use a small averaging window, may be appropriate to allow edit
+        cache.run(bandpass, vis=obs_vis, caltable=f'{tab_name}.B0', field=bandpass_calibrator, spw=spw, refant=ref_ant,
+                 bandtype='B', gaintable=[f'{tab_name}.G0', f'{tab_name}.G1', f'{tab_name}.K0'], parang=True)
+
+        # For fluxscale to work, we need a gain table with flux cal field and other gain calibrators both present
+        # Gaintype T to preserve the relative gains of XY feeds, needs testing
+        print("Second round gain calibration")
+        cache.run(gaincal, vis=obs_vis, caltable=f'{tab_name}.G2', field=gain_calibrators, spw=spw, refant=ref_ant, calmode='ap', solint='300', 
+                gaintype='G', minsnr=0, gaintable=[f'{tab_name}.K0', f'{tab_name}.B0'], parang=True)
+        manifest.complete('standard_calibration')
 
 # # Fluxscale if bootstrapping
 # if len(gain_calibrators.split(',')) > 1:
@@ -219,224 +250,173 @@ gaincal(vis=obs_vis, caltable=f'{tab_name}.G2', field=gain_calibrators, spw=spw,
 # Polarization calibration
 #############################################################################
 
-## Use 3c286
 if use_3c286:
+        pol_products = []
+        qu_model = {}
+else:
+        pol_products = [f'{tab_name}.G3', f'{tab_name}_pol.G3', f'{tab_name}_pol.Kcross0',
+                        f'{tab_name}_pol.Xfparang', f'{tab_name}_pol.D0']
 
-       # Fetch and move the tables to this directory
-        kcross_path = glob.glob(f'{polcal_table_dir}/*.Kcross0')[0]
-        Xfparang_path = glob.glob(f'{polcal_table_dir}/*.Xfparang')[0]
-        leakage_path = glob.glob(f'{polcal_table_dir}/*.D0')[0]
+if manifest.pending('polarization_calibration', products=pol_products):
+        ## Use 3c286
+        if use_3c286:
 
-        print(kcross_path)
-        print(Xfparang_path)
-        print(leakage_path)
+               # Fetch and move the tables to this directory
+                kcross_path = glob.glob(f'{polcal_table_dir}/*.Kcross0')[0]
+                Xfparang_path = glob.glob(f'{polcal_table_dir}/*.Xfparang')[0]
+                leakage_path = glob.glob(f'{polcal_table_dir}/*.D0')[0]
 
-        test = subprocess.Popen(["cp", '-r', kcross_path, '.'])
-        test2 = subprocess.Popen(["cp", '-r', Xfparang_path, '.'])
-        test3 = subprocess.Popen(["cp", '-r', leakage_path, '.'])
+                print(kcross_path)
+                print(Xfparang_path)
+                print(leakage_path)
 
-        # Apply the tables
-        kcross = kcross_path.split('/')[-1]
-        Xfparang = Xfparang_path.split('/')[-1]
-        leakage = leakage_path.split('/')[-1]
+                test = subprocess.Popen(["cp", '-r', kcross_path, '.'])
+                test2 = subprocess.Popen(["cp", '-r', Xfparang_path, '.'])
+                test3 = subprocess.Popen(["cp", '-r', leakage_path, '.'])
 
-### Try on the fly with a strongly polarized calibrator
-else:
-        # Re-calibrate the polarization calibrator, allowing the gains to absorb the parallactic 
-        # angle variation so that we can use it to calculate the polarization calibrator Stokes model'
-        # Set flux model for flux calibrator 
-        setjy(vis=obs_vis, field=polarization_calibrator, standard='Perley-Butler 2017', usescratch=True)
-
-        print(f"polarization calibrator {polarization_calibrator}")
-        # gaincal(vis=obs_vis, caltable=f'{tab_name}.G3', field=polarization_calibrator, spw=spw, refant=ref_ant, calmode='ap', solint='300', 
-        #         gaintype='G', minsnr=0, gaintable=[f'{tab_name}.K0', f'{tab_name}.B0', f'{tab_name}.G2'])
-        gaincal(vis=obs_vis, caltable=f'{tab_name}.G3', field=polarization_calibrator, spw=spw, refant=ref_ant, solint='300', 
-                gaintype='G',gaintable=[f'{tab_name}.K0', f'{tab_name}.B0', f'{tab_name}.G2'])
-
-        # Calculate Stokes model from gains
-        qu_model = polfromgain(vis=obs_vis, tablein=f'{tab_name}.G3')
-        print(f"Stokes model calculated from gains: {qu_model}")
-
-        # Redo gaincal with Stokes model; this does not absorb polarization signal
-        gaincal(vis=obs_vis, caltable=f'{tab_name}_pol.G3', refant=ref_ant, refantmode='strict', solint='300', calmode='ap', spw=spw,
-                field=polarization_calibrator, smodel=qu_model[polarization_calibrator]['Spw0'], parang=True, gaintype='G',
-                gaintable=[f'{tab_name}.K0', f'{tab_name}.B0', f'{tab_name}.G2'])
+                # Apply the tables
+                kcross = kcross_path.split('/')[-1]
+                Xfparang = Xfparang_path.split('/')[-1]
+                leakage = leakage_path.split('/')[-1]
+
+        ### Try on the fly with a strongly polarized calibrator
+        else:
+                # Re-calibrate the polarization calibrator, allowing the gains to absorb the parallactic 
+                # angle variation so that we can use it to calculate the polarization calibrator Stokes model'
+                # Set flux model for flux calibrator 
+                cache.run(set_model, modifies_vis=True, vis=obs_vis, field=polarization_calibrator, virtual=virtual_models,
+                          standard='Perley-Butler 2017')
+
+                print(f"polarization calibrator {polarization_calibrator}")
+                # cache.run(gaincal, vis=obs_vis, caltable=f'{tab_name}.G3', field=polarization_calibrator, spw=spw, refant=ref_ant, calmode='ap', solint='300', 
+                #         gaintype='G', minsnr=0, gaintable=[f'{tab_name}.K0', f'{tab_name}.B0', f'{tab_name}.G2'])
+                cache.run(gaincal, vis=obs_vis, caltable=f'{tab_name}.G3', field=polarization_calibrator, spw=spw, refant=ref_ant, solint='300', 
+                        gaintype='G',gaintable=[f'{tab_name}.K0', f'{tab_name}.B0', f'{tab_name}.G2'])
+
+                # Calculate Stokes model from gains
+                qu_model = cache.run(polfromgain, vis=obs_vis, tablein=f'{tab_name}.G3')
+                print(f"Stokes model calculated from gains: {qu_model}")
+
+                # Redo gaincal with Stokes model; this does not absorb polarization signal
+                cache.run(gaincal, vis=obs_vis, caltable=f'{tab_name}_pol.G3', refant=ref_ant, refantmode='strict', solint='300', calmode='ap', spw=spw,
+                        field=polarization_calibrator, smodel=qu_model[polarization_calibrator]['Spw0'], parang=True, gaintype='G',
+                        gaintable=[f'{tab_name}.K0', f'{tab_name}.B0', f'{tab_name}.G2'])
         
-        # Redo Stokes model to check for residual gains; should be close to zero
-        qu_model_calibrated = polfromgain(vis=obs_vis, tablein=f'{tab_name}_pol.G3')
-        print(f"Stokes model calculated from gains corrected for Stokes model: {qu_model_calibrated}")
-
-        # Best scan to calibrate cross-hands will be where the polarization signal is 
-        # minimum in XX and YY (i.e., maximum in XY and YX); find the scan using the
-        # gain calibration for the phase/polarization calibrator
-        # This code taken from ALMA pipeline
-        tb.open(f'{tab_name}.G3')
-        scans = tb.getcol('SCAN_NUMBER')
-        gains = np.squeeze(tb.getcol('CPARAM'))
-        tb.close()
-        scan_list = np.array(list(set(scans)))
-        ratios = np.zeros(len(scan_list))
-        for si, s in enumerate(scan_list):
-                filt = scans == s
-                ratio = np.sqrt(np.average(np.power(np.abs(gains[0,filt])/np.abs(gains[1,filt])-1.0,2.)))
-                ratios[si] = ratio
-
-        best_scan_index = np.argmin(ratios)
-        best_scan = scan_list[best_scan_index]
-        print(f"Scan with highest expected X-Y signal: {best_scan}")
+                # Redo Stokes model to check for residual gains; should be close to zero
+                qu_model_calibrated = cache.run(polfromgain, vis=obs_vis, tablein=f'{tab_name}_pol.G3')
+                print(f"Stokes model calculated from gains corrected for Stokes model: {qu_model_calibrated}")
+
+                # Best scan to calibrate cross-hands will be where the polarization signal is 
+                # minimum in XX and YY (i.e., maximum in XY and YX); find the scan using the
+                # gain calibration for the phase/polarization calibrator
+                # This code taken from ALMA pipeline
+                tb.open(f'{tab_name}.G3')
+                scans = tb.getcol('SCAN_NUMBER')
+                gains = np.squeeze(tb.getcol('CPARAM'))
+                tb.close()
+                scan_list = np.array(list(set(scans)))
+                ratios = np.zeros(len(scan_list))
+                for si, s in enumerate(scan_list):
+                        filt = scans == s
+                        ratio = np.sqrt(np.average(np.power(np.abs(gains[0,filt])/np.abs(gains[1,filt])-1.0,2.)))
+                        ratios[si] = ratio
+
+                best_scan_index = np.argmin(ratios)
+                best_scan = scan_list[best_scan_index]
+                print(f"Scan with highest expected X-Y signal: {best_scan}")
         
-        # Kcross calibration
-        gaincal(vis=obs_vis, caltable=f'{tab_name}_pol.Kcross0', spw=pol_spw, refant=ref_ant, solint='inf', 
-               field=polarization_calibrator, gaintype='KCROSS', scan=str(best_scan), smodel=[1, 0, 1, 0], calmode='ap', 
-               minblperant=1, refantmode='strict', parang=True)
+                # Kcross calibration
+                cache.run(gaincal, vis=obs_vis, caltable=f'{tab_name}_pol.Kcross0', spw=pol_spw, refant=ref_ant, solint='inf', 
+                       field=polarization_calibrator, gaintype='KCROSS', scan=str(best_scan), smodel=[1, 0, 1, 0], calmode='ap', 
+                       minblperant=1, refantmode='strict', parang=True)
                
-        # Solve for the apparent cross-hand phase spectrum (channelized) fractional linear polarization, Q, U
-        # Note that CASA calculates a Stokes model for the source in this step as well, but it will be incorrect!
-        # The X-Y phase offset table generated here seems to be accurate
-        S_model = polcal(vis=obs_vis, caltable=f'{tab_name}_pol.Xfparang',
-                  field=polarization_calibrator, spw=pol_spw,
-                  solint='inf', combine='scan', preavg=300,
-                  smodel=qu_model[polarization_calibrator]['Spw0'], poltype='Xfparang+QU',
-                  gaintable=[f'{tab_name}.B0', f'{tab_name}.G2', f'{tab_name}_pol.G3',
-                             f'{tab_name}_pol.Kcross0'])
+                # Solve for the apparent cross-hand phase spectrum (channelized) fractional linear polarization, Q, U
+                # Note that CASA calculates a Stokes model for the source in this step as well, but it will be incorrect!
+                # The X-Y phase offset table generated here seems to be accurate
+                S_model = cache.run(polcal, vis=obs_vis, caltable=f'{tab_name}_pol.Xfparang',
+                          field=polarization_calibrator, spw=pol_spw,
+                          solint='inf', combine='scan', preavg=300,
+                          smodel=qu_model[polarization_calibrator]['Spw0'], poltype='Xfparang+QU',
+                          gaintable=[f'{tab_name}.B0', f'{tab_name}.G2', f'{tab_name}_pol.G3',
+                                     f'{tab_name}_pol.Kcross0'])
                              
-        # Solve for leakage terms
-        polcal(vis=obs_vis, caltable=f'{tab_name}_pol.D0', field='0', spw=pol_spw, solint='inf', combine='scan', preavg=300,
-              smodel=qu_model[polarization_calibrator]['Spw0'], poltype='Dflls', refant='', 
-              gaintable=[f'{tab_name}.B0', f'{tab_name}.G2', f'{tab_name}_pol.G3', f'{tab_name}_pol.Kcross0', 
-                         f'{tab_name}_pol.Xfparang'])
+                # Solve for leakage terms
+                cache.run(polcal, vis=obs_vis, caltable=f'{tab_name}_pol.D0', field='0', spw=pol_spw, solint='inf', combine='scan', preavg=300,
+                      smodel=qu_model[polarization_calibrator]['Spw0'], poltype='Dflls', refant='', 
+                      gaintable=[f'{tab_name}.B0', f'{tab_name}.G2', f'{tab_name}_pol.G3', f'{tab_name}_pol.Kcross0', 
+                                 f'{tab_name}_pol.Xfparang'])
         
-        # Apply the tables
-        kcross = f'{tab_name}_pol.Kcross0'
-        Xfparang = f'{tab_name}_pol.Xfparang'
-        leakage = f'{tab_name}_pol.D0'
+                # Apply the tables
+                kcross = f'{tab_name}_pol.Kcross0'
+                Xfparang = f'{tab_name}_pol.Xfparang'
+                leakage = f'{tab_name}_pol.D0'
+
+        manifest.complete('polarization_calibration',
+                          values={'kcross': kcross, 'Xfparang': Xfparang, 'leakage': leakage, 'qu_model': qu_model})
+else:
+        pol_values = manifest.values('polarization_calibration')
+        kcross, Xfparang, leakage = pol_values['kcross'], pol_values['Xfparang'], pol_values['leakage']
+        qu_model = pol_values['qu_model']
 
 
 #############################################################################
 # Apply calibration
 #############################################################################
 
-# What do we need to do here? 
-if use_3c286:
-        # applycal(vis=obs_vis, gaintable=[f'{tab_name}.K0', f'{tab_name}.B0', f'{tab_name}.G2', kcross, Xfparang, leakage], parang=True)
+calibrated_products = [f'{tab_name}_calibrated.ms'] if write_calibrated_ms else []
+if manifest.pending('apply_calibration', products=calibrated_products):
+        pol_gainfield = '' if use_3c286 else polarization_calibrator
+        pol_tables = [(table, pol_gainfield, 'nearest') for table in [kcross, Xfparang, leakage]]
+        tables = {'K0': f'{tab_name}.K0', 'G2': f'{tab_name}.G2', 'B0': f'{tab_name}.B0', 'pol_G3': f'{tab_name}_pol.G3'}
+        field_tables = calibration_field_tables(tables, pol_tables)
 
-        print("Applying calibration: primary calibrator")
-        applycal(vis=obs_vis, field=bandpass_calibrator,
-                selectdata=False, calwt=False, gaintable=[f'{tab_name}.K0', f'{tab_name}.G2', f'{tab_name}.B0', kcross, Xfparang, leakage],
-                gainfield=[bandpass_calibrator, bandpass_calibrator, bandpass_calibrator, '', '', ''],
-                parang=True, interp='nearest,linearflag,nearest,nearest,nearest,nearest')
-        
-        print("Applying calibration: phase calibrator and target")
-        fields = ','.join(set(i for i in [phase_calibrator, polarization_calibrator, target] if i != ''))
-        applycal(vis=obs_vis, field=fields,
-                selectdata=False, calwt=False, gaintable=[f'{tab_name}.K0', f'{tab_name}.G2', f'{tab_name}.B0', kcross, Xfparang, leakage],
-                gainfield=[bandpass_calibrator, phase_calibrator, bandpass_calibrator, '', '', ''],
-                parang=True, interp='nearest,linearflag,nearest,nearest,nearest,nearest')
+        # Save out a calibrated measurement set if wanted; imaging reads CORRECTED_DATA otherwise
+        print(f"Applying calibration: {', '.join(field_tables)}")
+        write_callib(f'{tab_name}.callib.txt', field_tables)
+        apply_callib(obs_vis, f'{tab_name}.callib.txt', calibrated_products[0] if write_calibrated_ms else '',
+                     field=','.join(field_tables), parang=True)
 
-        split(obs_vis, outputvis=f'{tab_name}_calibrated.ms', datacolumn='corrected')
+        manifest.complete('apply_calibration')
 
 
-else:
-        # applycal(vis=obs_vis, gaintable=[f'{tab_name}.K0', f'{tab_name}.B0', f'{tab_name}.G2', kcross, Xfparang, leakage], parang=True)
-
-        print("Applying calibration: primary calibrator")
-        applycal(vis=obs_vis, field=bandpass_calibrator,
-                selectdata=False, calwt=False, gaintable=[f'{tab_name}.K0', f'{tab_name}.G2', f'{tab_name}.B0', kcross, Xfparang, leakage],
-                gainfield=[bandpass_calibrator, bandpass_calibrator, bandpass_calibrator, polarization_calibrator, polarization_calibrator, polarization_calibrator],
-                parang=True, interp='nearest,linearflag,nearest,nearest,nearest,nearest')
-        
-        if polarization_calibrator != phase_calibrator:
-                print("Applying calibration: polarization calibrator")
-                applycal(vis=obs_vis, field=polarization_calibrator,
-                        selectdata=False, calwt=False, gaintable=[f'{tab_name}.K0', f'{tab_name}.G2', f'{tab_name}_pol.G3', f'{tab_name}.B0', kcross, Xfparang, leakage],
-                        gainfield=[bandpass_calibrator, polarization_calibrator, polarization_calibrator, bandpass_calibrator, polarization_calibrator, polarization_calibrator, polarization_calibrator],
-                        parang=True, interp='nearest,linearflag,nearest,nearest,nearest,nearest,nearest')
-                
-        print("Applying calibration: phase calibrator and target")
-        fields = ','.join(set(i for i in [phase_calibrator, target] if i != ''))
-        applycal(vis=obs_vis, field=fields,
-                selectdata=False, calwt=False, gaintable=[f'{tab_name}.K0', f'{tab_name}.G2', f'{tab_name}.B0', kcross, Xfparang, leakage],
-                gainfield=[bandpass_calibrator, phase_calibrator, bandpass_calibrator, polarization_calibrator, polarization_calibrator, polarization_calibrator],
-                parang=True, interp='nearest,linearflag,nearest,nearest,nearest,nearest')
-
-        # Save out a calibrated measurement set
-        split(vis=obs_vis, outputvis=f'{tab_name}_calibrated.ms', datacolumn='corrected')
-
-
-generate_plots(use_3c286=use_3c286)
+if manifest.pending('diagnostic_plots'):
+        generate_plots(use_3c286=use_3c286)
+        manifest.complete('diagnostic_plots')
 
 #############################################################################
 # Iterate calibration
 #############################################################################
 
-if iterate_calibration:
-        # Could allow repeating multiple times
+iterate_products = [f'{tab_name}_calibrated_i.ms'] if write_calibrated_ms and not use_3c286 else []
+if iterate_calibration and manifest.pending('iterate_calibration', products=iterate_products):
         if use_3c286:
                 # If using 3c286, this could be done from the start; pass for now
-                pass
+                iteration = {}
         else:
-                # Begin gain calibration again on the uncorrected bandpass calibrator, using previous info
-                # Include best previous gain tables here?
-                gaincal(vis=obs_vis, caltable=f'{tab_name}.G0i', field=bandpass_calibrator, spw='0', refant=ref_ant, refantmode='strict', calmode='p', 
-                        solint='inf', gaintable=[leakage], parang=True)
-                gaincal(vis=obs_vis, caltable=f'{tab_name}.G1i', field=bandpass_calibrator, spw='0', refant=ref_ant, refantmode='strict', calmode='a', 
-                        solint='100', preavg=1, minblperant=1, minsnr=0, gaintype='G', gaintable=[f'{tab_name}.G0i', leakage], parang=True)
-
-                # Redo delays
-                gaincal(vis=obs_vis, caltable=f'{tab_name}.K0i', field=bandpass_calibrator, spw='0', refant=ref_ant, solint='inf', combine='scan', 
-                        preavg=1, minblperant=1, gaintype='K', gaintable=[f'{tab_name}.G0i', f'{tab_name}.G1i', kcross], parang=True)
-
-                # Redo bandpass with the new gain, delays, and leakage
-                bandpass(vis=obs_vis, caltable=f'{tab_name}.B0i', field=bandpass_calibrator, spw='0', refant=ref_ant,
-                        bandtype='B', gaintable=[f'{tab_name}.G0i', f'{tab_name}.G1i', f'{tab_name}.K0i', leakage], parang=True)
-
-                # Redo gain with new preliminary gain, bandpass, delays, leakage
-                gaincal(vis=obs_vis, caltable=f'{tab_name}.G2i', field=bandpass_calibrator, spw='0', refant=ref_ant, calmode='ap', solint='300', 
-                        gaintable=[f'{tab_name}.K0i', f'{tab_name}.B0i', leakage, f'{tab_name}.G0i', f'{tab_name}.G1i', ], parang=True)
-                
-                # Redo phase calibrator gain absorbing parallactic angle contribution
-                gaincal(vis=obs_vis, caltable=f'{tab_name}.G3i', field=phase_calibrator, spw='0', refant=ref_ant, calmode='ap', solint='300', 
-                        gaintable=[f'{tab_name}.K0i', f'{tab_name}.B0i', f'{tab_name}.G2i', leakage, f'{tab_name}.G0i', f'{tab_name}.G1i'])
-
-                # Redo Stokes model from gains
-                qu_model_i = polfromgain(vis=obs_vis, tablein=f'{tab_name}.G3i')
-
-                # Redo phase calibrator gain with new model and all previous tables
-                gaincal(vis=obs_vis, caltable=f'{tab_name}_pol.G3i', refant=ref_ant, refantmode='strict', solint='300', calmode='ap', 
-                        field=phase_calibrator, smodel=qu_model_i[phase_calibrator]['Spw0'], parang=True, gaintable=[f'{tab_name}.K0i', f'{tab_name}.B0i', f'{tab_name}.G2i', 
-                        leakage, f'{tab_name}.G0i', f'{tab_name}.G1i'])
-
-                # Redo X-Y phase offsets now that the full calibration has been repeated with an estimate of instrumental polarization
-        
-                # Kcross
-                gaincal(vis=obs_vis, caltable=f'{tab_name}_pol.Kcross0i', spw='0', refant=ref_ant, solint='inf', 
-                        field=phase_calibrator, gaintype='KCROSS', combine='scan', smodel=[1, 0, 1, 0], calmode='ap', 
-                        minblperant=1, refantmode='strict', parang=True)
-
-                # X-Y phase offsets
-                S_model = polcal(vis=obs_vis, caltable=f'{tab_name}_pol.Xfparangi',
-                        field=phase_calibrator, spw='0',
-                        solint='inf', combine='scan', preavg=300,
-                        smodel=qu_model[phase_calibrator]['Spw0'], poltype='Xfparang+QU',
-                        gaintable=[f'{tab_name}.B0i', f'{tab_name}.G0i', f'{tab_name}.G1i', f'{tab_name}.G2i', f'{tab_name}_pol.G3i',
-                                f'{tab_name}_pol.Kcross0i', leakage])
-
-                # Redo leakage calibration with self-calibrated tables
-                polcal(vis=obs_vis, caltable=f'{tab_name}_pol.D0i', field='0', spw='0', solint='inf', combine='scan', preavg=300,
-                        smodel=qu_model[phase_calibrator]['Spw0'], poltype='Dflls', refant='', 
-                        gaintable=[f'{tab_name}.B0i', f'{tab_name}.G0i', f'{tab_name}.G1i' f'{tab_name}.G2i', f'{tab_name}_pol.G3i',f'{tab_name}_pol.Kcross0i', 
-                                f'{tab_name}_pol.Xfparangi'])
+                # Repeat the gain, delay, bandpass and polarization chain on the uncorrected data, starting
+                # each pass from the previous leakage, cross-hand delay and Stokes model, until the D-terms,
+                # X-Y phase and Q/U stop changing
+                start = {'kcross': kcross, 'Xfparang': Xfparang, 'leakage': leakage, 'qu_model': qu_model}
+                iteration = iterate_polarization_calibration(obs_vis, tab_name, start, max_iterations=max_iterations,
+                                                             tolerances=iteration_tolerances,
+                                                             bandpass_calibrator=bandpass_calibrator,
+                                                             polarization_calibrator=polarization_calibrator,
+                                                             ref_ant=ref_ant, gain_field=gain_calibrators,
+                                                             spw=spw, pol_spw=pol_spw, run=cache.run)
 
                 # Apply new calculations
-                kcross = f'{tab_name}_pol.Kcross0i'
-                Xfparang = f'{tab_name}_pol.Xfparangi'
-                leakage = f'{tab_name}_pol.D0i'
-
-                applycal(vis=obs_vis, gaintable=[f'{tab_name}.K0', f'{tab_name}.B0', f'{tab_name}.G2', f'{tab_name}_pol.G3', 
-                        kcross, Xfparang, leakage], parang=True)
+                kcross, Xfparang, leakage = iteration['kcross'], iteration['Xfparang'], iteration['leakage']
+                qu_model = iteration['qu_model']
+                pol_tables = [(table, polarization_calibrator, 'nearest') for table in [kcross, Xfparang, leakage]]
+                field_tables = calibration_field_tables(iteration['tables'], pol_tables)
+                write_callib(f'{tab_name}_i.callib.txt', field_tables)
+                apply_callib(obs_vis, f'{tab_name}_i.callib.txt', iterate_products[0] if write_calibrated_ms else '',
+                             field=','.join(field_tables), parang=True)
 
-                # Save out a calibrated measurement set
-                split(vis=obs_vis, outputvis=f'{tab_name}_pol_cal_i.ms', datacolumn='corrected')
+        manifest.complete('iterate_calibration',
+                          values={key: iteration[key] for key in ['kcross', 'Xfparang', 'leakage', 'qu_model',
+                                                                  'iterations', 'converged', 'history']
+                                  if key in iteration})
 
 
 #############################################################################
@@ -444,89 +424,44 @@ if iterate_calibration:
 #############################################################################
 
 if do_image:
-        # Pick calibrated ms to use
-        if iterate_calibration:
-                calibrated_vis = f'{tab_name}_calibrated_i.ms'
+        # Pick calibrated ms to use; CORRECTED_DATA of obs_vis holds the latest calibration
+        if write_calibrated_ms:
+                calibrated_vis = f'{tab_name}_calibrated_i.ms' if iterate_calibration and not use_3c286 else f'{tab_name}_calibrated.ms'
+                calibrated_column = 'data'
         else:
-                calibrated_vis = f'{tab_name}_calibrated.ms'
+                calibrated_vis, calibrated_column = obs_vis, 'corrected'
         
-        # Split out bandpass_calibrator, phase_calibrator, target
-        mstransform(vis=calibrated_vis, outputvis=f"{bandpass_calibrator}_calibrated.ms", antenna='!*&&&', field=bandpass_calibrator, datacolumn='DATA')
-        mstransform(vis=calibrated_vis, outputvis=f"{phase_calibrator}_calibrated.ms", antenna='!*&&&', field=phase_calibrator, datacolumn='DATA')
-        mstransform(vis=calibrated_vis, outputvis=f"{target}_calibrated.ms", antenna='!*&&&', field=target, datacolumn='DATA')
-
-        # Get maximum baseline
-        tb.open(obs_vis)
-        B_max = np.max(np.sqrt(tb.getcol('UVW')[0]**2 + tb.getcol('UVW')[1]**2 + tb.getcol('UVW')[2]**2))
-        tb.close()
-
-        # Get maximum frequency
-        tb.open(f"{obs_vis}/SPECTRAL_WINDOW/")
-        nu_max = np.max(tb.getcol('REF_FREQUENCY'))
-        tb.close()
-
-        # Calculate cell size
-        cell = ((3.e8 / nu_max) / B_max) * (180. / np.pi) * 3600. / 8.
-
-        # Image bandpass calibrator
-        obs_vis = f"{bandpass_calibrator}_calibrated.ms"
-        os.makedirs(f"./IMAGES/{bandpass_calibrator}/")
-
-        image_base = f'IMAGES/{bandpass_calibrator}/{bandpass_calibrator}_briggs0_{round(cell, 2)}arcsec'
-
-        tclean(vis=obs_vis, weighting='briggs', robust=0, imagename=f"{image_base}_dirty", 
-        cell=f"{cell}arcsec", imsize=[2048,2048], pblimit=-1, deconvolver='mtmfs')
-        dirty_rms = imstat(f"{image_base}_dirty.image.tt0")['rms'][0]
-        tclean(vis=obs_vis, weighting='briggs', robust=0, imagename=f"{image_base}_clean_iter1", cell=f"{cell}arcsec", 
-        imsize=[2048,2048], niter=1000, threshold = f"{dirty_rms*5.}Jy", pblimit=-1, deconvolver='mtmfs')
-        clean_rms = imstat(f"{image_base}_clean_iter1.residual.tt0")['rms'][0]
-        tclean(vis=obs_vis, weighting='briggs', robust=0, imagename=f"{image_base}_clean_iter2", 
-        cell=f"{cell}arcsec", imsize=[2048,2048], niter=1000, threshold = f"{clean_rms*5.}Jy", pblimit=-1,deconvolver='mtmfs')
-
-        calibrator_diagnostics(image_base=image_base, cell_size=cell, calibrator=bandpass_calibrator)
+        # Split out bandpass_calibrator, phase_calibrator, target without autocorrelations, in one pass
+        split_products = [f"{field}_calibrated.ms" for field in [bandpass_calibrator, phase_calibrator, target]]
+        if manifest.pending('split_fields', products=split_products):
+                split_fields(calibrated_vis, [bandpass_calibrator, phase_calibrator, target], datacolumn=calibrated_column)
+
+                # Cell size from the maximum baseline and frequency in the cached MS summary
+                cell = cell_size(ms_summary(obs_vis))
+                manifest.complete('split_fields', values={'cell': cell})
+        else:
+                cell = manifest.values('split_fields')['cell']
 
+        # The bandpass calibrator, phase calibrator and target are imaged concurrently
+        imaging_fields = {'image_bandpass_calibrator': bandpass_calibrator}
         if len(gain_calibrators.split(',')) > 1:
-                # Image phase calibrator
-                obs_vis = f"{phase_calibrator}_calibrated.ms"
-                os.makedirs(f"./IMAGES/{phase_calibrator}/")
-                image_base = f'IMAGES/{phase_calibrator}/{phase_calibrator}_briggs0_{round(cell, 2)}arcsec'
-
-                tclean(vis=obs_vis, weighting='briggs', robust=0, imagename=f"{image_base}_dirty", 
-                cell=f"{cell}arcsec", imsize=[2048,2048], pblimit=-1, deconvolver='mtmfs')
-                dirty_rms = imstat(f"{image_base}_dirty.image.tt0")['rms'][0]
-                tclean(vis=obs_vis, weighting='briggs', robust=0, imagename=f"{image_base}_clean_iter1", cell=f"{cell}arcsec", 
-                imsize=[2048,2048], niter=1000, threshold = f"{dirty_rms*5.}Jy", pblimit=-1, deconvolver='mtmfs')
-                clean_rms = imstat(f"{image_base}_clean_iter1.residual.tt0")['rms'][0]
-                tclean(vis=obs_vis, weighting='briggs', robust=0, imagename=f"{image_base}_clean_iter2", 
-                cell=f"{cell}arcsec", imsize=[2048,2048], niter=1000, threshold = f"{clean_rms*5.}Jy", pblimit=-1,deconvolver='mtmfs')
-
-                calibrator_diagnostics(image_base=image_base, cell_size=cell, calibrator=phase_calibrator)
-
-        # Image target
-        obs_vis = f"{target}_calibrated.ms"
-        os.makedirs(f"./IMAGES/{target}/")
-        image_base = f'IMAGES/{target}/{target}_briggs0_{round(cell, 2)}arcsec'
-
-        print("Stokes I Image")
-        tclean(vis=f'{target}_calibrated.ms', imagename=f"{image_base}_dirty", spw='0', specmode='mfs', deconvolver='mtmfs', 
-                gridder='standard', imsize=[2048,2048], cell=f"{cell}arcsec", weighting='briggs', niter=100)
-        tclean(vis=f'{target}_calibrated.ms', imagename=f'{image_base}_clean_iter_1000', spw='0', specmode='mfs', deconvolver='mtmfs', 
-        gridder='standard', imsize=[2048,2048], cell=f"{cell}arcsec", weighting='briggs', niter=1000)
-
-        print("Stokes Q Image")
-        tclean(vis=f'{target}_calibrated.ms', imagename=f"{image_base}_Q_dirty", spw='0', specmode='mfs', deconvolver='mtmfs', 
-                gridder='standard', imsize=[2048,2048], cell=f"{cell}arcsec", weighting='briggs', niter=100, stokes='Q')
-        tclean(vis=f'{target}_calibrated.ms', imagename=f'{image_base}_Q_clean_iter_1000', spw='0', specmode='mfs', deconvolver='mtmfs', 
-        gridder='standard', imsize=[2048,2048], cell=f"{cell}arcsec", weighting='briggs', niter=1000, stokes='Q')
-
-        print("Stokes U Image")
-        tclean(vis=f'{target}_calibrated.ms', imagename=f"{image_base}_U_dirty", spw='0', specmode='mfs', deconvolver='mtmfs', 
-                gridder='standard', imsize=[2048,2048], cell=f"{cell}arcsec", weighting='briggs', niter=100, stokes='U')
-        tclean(vis=f'{target}_calibrated.ms', imagename=f'{image_base}_U_clean_iter_1000', spw='0', specmode='mfs', deconvolver='mtmfs', 
-        gridder='standard', imsize=[2048,2048], cell=f"{cell}arcsec", weighting='briggs', niter=1000, stokes='U')
-
-        print("Stokes V Image")
-        tclean(vis=f'{target}_calibrated.ms', imagename=f"{image_base}_V_dirty", spw='0', specmode='mfs', deconvolver='mtmfs', 
-                gridder='standard', imsize=[2048,2048], cell=f"{cell}arcsec", weighting='briggs', niter=100, stokes='V')
-        tclean(vis=f'{target}_calibrated.ms', imagename=f'{image_base}_V_clean_iter_1000', spw='0', specmode='mfs', deconvolver='mtmfs', 
-        gridder='standard', imsize=[2048,2048], cell=f"{cell}arcsec", weighting='briggs', niter=1000, stokes='V')
\ No newline at end of file
+                imaging_fields['image_phase_calibrator'] = phase_calibrator
+        imaging_fields['image_target'] = target
+        imaging_jobs = {}
+        for stage, field in imaging_fields.items():
+                os.makedirs(f"./IMAGES/{field}/", exist_ok=True)
+                image_base = f'IMAGES/{field}/{field}_briggs0_{round(cell, 2)}arcsec'
+                if field == target:
+                        product = f'{image_base}_V_clean_iter_1000.image.tt0'
+                        job = target_job(f"{field}_calibrated.ms", image_base, cell, joint_stokes=joint_stokes_imaging)
+                else:
+                        product = f'{image_base}_clean_iter2.image.tt0'
+                        job = calibrator_job(f"{field}_calibrated.ms", image_base, cell, field)
+                if manifest.pending(stage, products=[product]):
+                        imaging_jobs[stage] = job
+
+        finished = run_imaging_jobs(imaging_jobs, nproc=imaging_workers)
+        for stage in finished:
+                manifest.complete(stage)
+        if len(finished) < len(imaging_jobs):
+                raise RuntimeError(f"Imaging failed for {sorted(set(imaging_jobs) - set(finished))}")
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+#############################################################################
+# Calibrated previews for checking each calibration stage
+#############################################################################
+
+# Checking a calibration stage used to mean splitting a full copy of the MS
+# and running applycal on it. A preview instead applies the current caltables
+# on the fly (through a cal library) in one mstransform that also averages in
+# time and channel, so the checkpoint writes megabytes instead of a copy of
+# the data. The calibrated visibilities are the DATA column of the preview,
+# and amplitude and phase plots of it are written alongside.
+#
+# Usage inside a calibration script:
+#
+#   calibrated_preview(vis, [f'3c286_{lo}.G0', f'3c286_{lo}.G1', f'3c286_{lo}.K0'], f'3C286_{lo}2_preview.ms')
+
+import os
+import shutil
+
+from callib import callib_line
+
+
+def calibrated_preview(vis: str, gaintable: list, outputvis: str, field: str = '', timebin: str = '60s',
+                       chanbin: int = 8, plots: bool = True) -> str:
+    '''
+    Write outputvis: vis with gaintable applied on the fly, averaged over
+    timebin and chanbin channels. With plots, amplitude and phase against
+    frequency and time are saved as <outputvis>_<axis>_vs_<xaxis>.png.
+    Returns outputvis.
+    '''
+    from casatasks import mstransform
+    root = os.path.splitext(outputvis.rstrip('/'))[0]
+    callib = f'{root}.callib.txt'
+    with open(callib, 'w') as f:
+        f.write('\n'.join(callib_line(table) for table in gaintable) + '\n')
+
+    shutil.rmtree(outputvis, ignore_errors=True)
+    mstransform(vis=vis, outputvis=outputvis, field=field, docallib=True, callib=callib, datacolumn='corrected',
+                timeaverage=True, timebin=timebin, chanaverage=True, chanbin=chanbin)
+
+    if plots:
+        from casaplotms import plotms
+        for yaxis in ['amp', 'phase']:
+            for xaxis in ['freq', 'time']:
+                plotms(vis=outputvis, xaxis=xaxis, yaxis=yaxis, coloraxis='corr',
+                       plotfile=f'{root}_{yaxis}_vs_{xaxis}.png', overwrite=True, showgui=False)
+    return outputvis
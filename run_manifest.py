@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+#############################################################################
+# Run manifest for resumable calibration scripts
+#############################################################################
+
+# The calibration scripts are flat top-level scripts, so a crash in a late
+# stage (tclean, os.makedirs, ...) used to mean starting again from flagdata.
+# The manifest records each completed stage together with the caltables and
+# measurement sets it produced and any values later stages need (Stokes
+# models, table names, cell size). On a resumed run, stages are skipped up to
+# the first one that is incomplete or whose products no longer validate; that
+# stage and everything after it are run again.
+#
+# Usage inside a calibration script:
+#
+#   manifest = RunManifest(f'{tab_name}.manifest.json', resume=resume_run)
+#   if manifest.pending('standard_calibration', products=[f'{tab_name}.G0', ...]):
+#           gaincal(...)
+#           manifest.complete('standard_calibration')
+#
+#   if manifest.pending('polarization_calibration', products=[...]):
+#           ...
+#           manifest.complete('polarization_calibration', values={'qu_model': qu_model})
+#   else:
+#           qu_model = manifest.values('polarization_calibration')['qu_model']
+
+import json
+import os
+from datetime import datetime
+
+from step_cache import json_default, ms_state
+
+MANIFEST_VERSION = 1
+
+
+def table_is_valid(path: str) -> bool:
+    '''Check that a caltable or MS exists, is a complete CASA table and is not empty'''
+    if not os.path.isfile(os.path.join(path, 'table.dat')):
+        return False
+
+    from casatools import table
+    tb = table()
+    try:
+        tb.open(path)
+        nrows = tb.nrows()
+    except RuntimeError:
+        return False
+    finally:
+        tb.close()
+    return nrows > 0
+
+
+class RunManifest:
+    '''Records completed script stages so an interrupted run can resume'''
+
+    def __init__(self, manifest_file: str, resume: bool = True):
+        self.manifest_file = manifest_file
+        self.resume = resume
+        self.stages = {}
+        # Once one stage has to run, every stage after it runs too
+        self.rerun = not resume
+        self._products = {}
+        self._confirmed = []
+
+        if resume and os.path.exists(manifest_file):
+            with open(manifest_file) as f:
+                saved = json.load(f)
+            if saved.get('version') == MANIFEST_VERSION:
+                self.stages = saved.get('stages', {})
+
+    def _save(self):
+        tmp = f'{self.manifest_file}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'stages': self.stages}, f, indent=1, default=json_default)
+        os.replace(tmp, self.manifest_file)
+
+    def _products_valid(self, stage: str) -> bool:
+        for path, state in self.stages[stage]['products'].items():
+            if not table_is_valid(path):
+                print(f"Run manifest: {path} from stage '{stage}' is missing or invalid")
+                return False
+            if ms_state(path) != state:
+                print(f"Run manifest: {path} from stage '{stage}' was modified after the stage completed")
+                return False
+        return True
+
+    def pending(self, stage: str, products: list = None) -> bool:
+        '''
+        Return True if the stage has to run. The products listed here are
+        checked now and recorded when the stage completes.
+        '''
+        self._products[stage] = list(products or [])
+
+        if self.rerun:
+            return True
+
+        if stage not in self.stages or not self._products_valid(stage):
+            print(f"Run manifest: resuming at stage '{stage}'")
+            self.rerun = True
+            # Later stages were built on the products being redone; forget them
+            self.stages = {name: self.stages[name] for name in self._confirmed}
+            self._save()
+            return True
+
+        print(f"Run manifest: stage '{stage}' already complete, skipping")
+        self._confirmed.append(stage)
+        return False
+
+    def complete(self, stage: str, values: dict = None):
+        '''Mark a stage as finished, recording the state of its products'''
+        products = {path: ms_state(path) for path in self._products.get(stage, [])}
+        self.stages[stage] = {
+            'completed': datetime.now().isoformat(timespec='seconds'),
+            'products': products,
+            'values': dict(values or {}),
+        }
+        self._save()
+
+    def values(self, stage: str) -> dict:
+        '''Values recorded by a stage that was skipped on this run'''
+        return self.stages[stage]['values']
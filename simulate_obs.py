@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+
+#############################################################################
+# Simulated ATA polarization observations with known instrumental terms
+#############################################################################
+
+# Writes a measurement set that the calibration scripts can run on without
+# real data, with the corruptions it was built from kept as ground truth.
+# casatools' simulator lays out the MS: the antennas of the ATA list, linear
+# X/Y feeds, one spectral window and a repeating cycle of scans over the
+# calibrator and target fields. The DATA column is then filled in chunks of
+# rows. Every field is a point source at its phase centre, so each
+# visibility is the source coherency rotated by the parallactic angle, which
+# is taken from casatools measures as CASA's solvers compute it. It is
+# corrupted as
+#
+#   V_ij = G_i B_i X D_i C(chi) D_j^H X^H B_j^H G_j^H + noise
+#
+# with G: gains, one slowly varying phase for both feeds and separate
+# amplitudes. B: bandpasses, with a per-antenna delay and ripple in phase
+# common to both feeds, and separate amplitude ripples. X = diag(1, exp(i psi)),
+# where psi(f) = xy_phase + 2 pi kcross (f - f_ref), the same for every
+# antenna. D = [[1, d_x], [d_y, 1]], per-antenna leakages. Because the
+# gains and bandpasses carry no X-Y phase difference, the cross-hand phase
+# and delay that gaincal/polcal should recover against any reference antenna
+# are exactly xy_phase and kcross.
+#
+# The injected terms are written next to the MS: <vis>.truth.json holds the
+# D-terms, XY phase, Kcross delay and source models. <vis>.truth.npz holds
+# the gain, bandpass and parallactic angle arrays.
+#
+# Polarization calibrator parallactic angle coverage is set by the hour
+# angle at which the observation starts (--start-ha) and its length. Sizes
+# run from a few MB (--size tiny) to a full-length observation
+# (--size production). The layout is a synthetic one within the ATA's
+# ~300 m footprint unless --layout-ms copies the antenna positions from a
+# real ATA MS.
+#
+#   python simulate_obs.py -o sim_tiny.ms --size tiny
+#   python simulate_obs.py -o 3c391_sim.ms --size production --start-ha -4 --layout-ms 3c391_obs.ms
+
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+
+from calibrator_catalog import CalibratorCatalog
+from calibrator_models import canonical_name, stokes_model
+from ephemeris_cache import ATA_LAT, ATA_LON, SIDEREAL_DAY
+from ms_metadata import geodetic_location, local_sidereal_time
+from pa_scheduler import iso_to_mjd
+
+# As in polcal_iterative.py
+ANTENNAS = ['1b', '1c', '1e', '1g', '1h', '1k',
+            '2b', '2d', '2e', '2f', '2h', '2j', '2k', '2l', '2m',
+            '3d', '3l', '4e', '4j', '5e']
+ATA_HEIGHT = 1000.      # m, approximate
+DISH_DIAMETER = 6.1     # m
+LAYOUT_RADIUS = 150.    # m
+
+SIZES = {
+    'tiny': {'antennas': 6, 'nchan': 16, 'integration': 60., 'hours': 1.},
+    'small': {'antennas': 20, 'nchan': 64, 'integration': 30., 'hours': 3.},
+    'production': {'antennas': 20, 'nchan': 192, 'integration': 10., 'hours': 8.},
+}
+
+# Minutes on each field, repeated until the end of the observation
+DEFAULT_CYCLE = [('3c286', 6.), ('1804+010', 2.), ('3c391', 12.)]
+
+# Sources without a calibrator model: flux (Jy at f_ref), spectral index, fractional polarization,
+# polarization angle (deg), and a position when the catalog does not have one
+SOURCE_MODELS = {
+    '1804+010': {'flux': 1.5, 'spix': -0.5, 'pol_frac': 0., 'pol_angle': 0.},
+    '3c391': {'ra': 18.82361, 'dec': -0.91861, 'flux': 20., 'spix': -0.55, 'pol_frac': 0.03, 'pol_angle': 45.},
+}
+
+# Corruption defaults
+DTERM_RMS = 0.05            # per receptor, real and imaginary parts
+XY_PHASE = 40.              # deg at f_ref
+KCROSS = 1.5                # ns
+GAIN_PHASE_RMS = 30.        # deg
+GAIN_AMP_RMS = 0.05
+BANDPASS_DELAY_RMS = 3.     # ns
+BANDPASS_RIPPLE = 0.1
+NOISE = 0.05                # Jy per real and imaginary part of a visibility
+
+# Visibilities (rows x channels) corrupted and written at once
+CHUNK_VISIBILITIES = 2_000_000
+
+
+def synthetic_layout(n: int, seed: int = 0) -> np.ndarray:
+    '''East, north, up offsets (m) of n antennas scattered over the ATA footprint, at least 10 m apart'''
+    rng = np.random.default_rng(seed)
+    positions = []
+    while len(positions) < n:
+        east, north = rng.uniform(-LAYOUT_RADIUS, LAYOUT_RADIUS, 2)
+        if np.hypot(east, north) <= LAYOUT_RADIUS and all(np.hypot(east - e, north - m) >= 10. for e, m, _ in positions):
+            positions.append((east, north, 0.))
+    return np.array(positions)
+
+
+def ms_layout(vis: str, names: list) -> np.ndarray:
+    '''ITRF positions (m) of the named antennas in an existing MS, in the order of names'''
+    from casatools import table
+    tb = table()
+    tb.open(os.path.join(vis, 'ANTENNA'))
+    ms_names = list(tb.getcol('NAME'))
+    positions = tb.getcol('POSITION').T
+    tb.close()
+    missing = [name for name in names if name not in ms_names]
+    if missing:
+        raise ValueError(f"Antennas {missing} are not in {vis}")
+    return np.array([positions[ms_names.index(name)] for name in names])
+
+
+def source_position(name: str, catalog: CalibratorCatalog) -> tuple:
+    '''J2000 position (hours, deg) from SOURCE_MODELS or the calibrator catalog'''
+    spec = SOURCE_MODELS.get(name, {})
+    if 'ra' in spec:
+        return spec['ra'], spec['dec']
+    cal = catalog.lookup(name)
+    return cal['ra'], cal['dec']
+
+
+def source_stokes(name: str, freq: np.ndarray) -> np.ndarray:
+    '''Stokes I, Q, U, V (Jy) at freq (GHz), shape (4, nchan)'''
+    try:
+        return np.array(stokes_model(canonical_name(name), freq))
+    except ValueError:
+        pass
+    spec = SOURCE_MODELS[name]
+    i = spec['flux'] * (freq / freq.mean())**spec['spix']
+    chi = 2*np.deg2rad(spec['pol_angle'])
+    p = spec['pol_frac'] * i
+    return np.stack([i, p*np.cos(chi), p*np.sin(chi), np.zeros_like(freq)])
+
+
+def start_for_hour_angle(date: str, ra_hours: float, hour_angle: float) -> float:
+    '''First UTC MJD on or after date (YYYY-MM-DD) at which a source is at hour_angle (hours)'''
+    mjd0 = iso_to_mjd(f'{date}T00:00:00')
+    lst0 = local_sidereal_time(mjd0 * 86400., np.deg2rad(ATA_LON))
+    offset = np.mod(np.deg2rad((ra_hours + hour_angle) * 15.) - lst0, 2*np.pi) / (2*np.pi)
+    return mjd0 + offset * SIDEREAL_DAY
+
+
+def instrument(antennas: list, freq: np.ndarray, times: np.ndarray, seed: int = 0, dterm_rms: float = DTERM_RMS,
+               xy_phase: float = XY_PHASE, kcross: float = KCROSS, gain_phase_rms: float = GAIN_PHASE_RMS,
+               gain_amp_rms: float = GAIN_AMP_RMS) -> dict:
+    '''
+    Random instrumental terms: 'dterms' (nant, 2), 'gains' (nant, ntime, 2)
+    at the unique times (s), 'bandpass' (nant, nchan, 2) and 'cross' (nchan,
+    2) = [1, exp(i psi)], for freq in GHz.
+    '''
+    rng = np.random.default_rng(seed)
+    nant = len(antennas)
+    f0 = freq.mean()
+
+    dterms = dterm_rms * (rng.standard_normal((nant, 2)) + 1j*rng.standard_normal((nant, 2)))
+
+    # Slow phase drifts shared by both feeds: a few sinusoids with periods of 20 min to 2 h
+    t = (times - times[0])[None, :, None]
+    periods = rng.uniform(1200., 7200., (nant, 1, 3))
+    phase = np.deg2rad(gain_phase_rms) / np.sqrt(1.5) * np.sin(2*np.pi*t/periods + rng.uniform(0, 2*np.pi, (nant, 1, 3)))
+    phase = phase.sum(axis=-1, keepdims=True) + rng.uniform(-np.pi, np.pi, (nant, 1, 1))
+    amp = rng.uniform(0.8, 1.2, (nant, 1, 2)) * (1 + gain_amp_rms * np.sin(2*np.pi*t/rng.uniform(1800., 7200., (nant, 1, 2))))
+    gains = amp * np.exp(1j*phase)
+
+    # Bandpasses: common delay and phase ripple, separate amplitude ripple per feed
+    x = (freq - f0)[None, :]
+    delay = BANDPASS_DELAY_RMS * rng.standard_normal((nant, 1))
+    ripple = BANDPASS_RIPPLE * np.sin(2*np.pi*x/np.ptp(freq)*rng.uniform(1., 3., (nant, 1)))
+    bp_phase = 2*np.pi*delay*x + ripple
+    bp_amp = 1 + BANDPASS_RIPPLE * np.cos(2*np.pi*x[..., None]/np.ptp(freq)*rng.uniform(1., 3., (nant, 1, 2)))
+    bandpass = bp_amp * np.exp(1j*bp_phase)[..., None]
+
+    psi = np.deg2rad(xy_phase) + 2*np.pi*kcross*(freq - f0)
+    cross = np.stack([np.ones_like(psi), np.exp(1j*psi)], axis=-1)
+    return {'dterms': dterms, 'gains': gains, 'bandpass': bandpass, 'cross': cross}
+
+
+def corrupted_visibilities(stokes: np.ndarray, parang: np.ndarray, d1: np.ndarray, d2: np.ndarray,
+                           e1: np.ndarray, e2: np.ndarray) -> np.ndarray:
+    '''
+    XX, XY, YX, YY visibilities, shape (rows, nchan, 4), of point sources
+    with stokes (rows, 4, nchan) at parallactic angles parang (rows,
+    radians), between antennas with leakages d1, d2 (rows, 2) and diagonal
+    Jones terms e1, e2 (rows, nchan, 2).
+    '''
+    i, q, u, v = (stokes[:, k] for k in range(4))
+    c2, s2 = np.cos(2*parang)[:, None], np.sin(2*parang)[:, None]
+    qp = q*c2 + u*s2
+    up = -q*s2 + u*c2
+    coherency = np.stack([np.stack([i + qp, up + 1j*v], axis=-1),
+                          np.stack([up - 1j*v, i - qp], axis=-1)], axis=-2)
+
+    ones = np.ones(len(parang))
+    D1 = np.stack([np.stack([ones, d1[:, 0]], axis=-1), np.stack([d1[:, 1], ones], axis=-1)], axis=-2)
+    D2 = np.stack([np.stack([ones, d2[:, 0]], axis=-1), np.stack([d2[:, 1], ones], axis=-1)], axis=-2)
+    leaked = np.einsum('rij,rcjk,rlk->rcil', D1, coherency, D2.conj())
+    return (e1[..., :, None] * leaked * e2.conj()[..., None, :]).reshape(len(parang), -1, 4)
+
+
+def parallactic_angles(times: np.ndarray, fields: np.ndarray, directions: dict, position: np.ndarray) -> np.ndarray:
+    '''Parallactic angle (radians) at each time of the field observed then, from apparent hour angle and declination'''
+    from casatools import measures
+    me = measures()
+    lat, _ = geodetic_location(position)
+    me.doframe(me.position('ITRF', *[f'{c}m' for c in position]))
+    parang = np.empty(len(times))
+    for k, (t, fid) in enumerate(zip(times, fields)):
+        me.doframe(me.epoch('UTC', f'{t}s'))
+        hadec = me.measure(directions[fid], 'HADEC')
+        h, dec = hadec['m0']['value'], hadec['m1']['value']
+        parang[k] = np.arctan2(np.sin(h), np.cos(dec)*np.tan(lat) - np.sin(dec)*np.cos(h))
+    return parang
+
+
+def create_ms(vis: str, antennas: list, layout: np.ndarray, local: bool, fields: dict, cycle: list, start_mjd: float,
+              hours: float, nchan: int, integration: float, freq_ghz: float = 1.35, chan_mhz: float = 0.5,
+              min_alt: float = 10.):
+    '''Empty MS with the given layout, fields ({name: (ra_hours, dec_deg)}) and scan cycle'''
+    from casatools import measures, simulator
+    me = measures()
+    sm = simulator()
+    sm.open(vis)
+    if local:
+        reference = me.position('WGS84', f'{ATA_LON}deg', f'{ATA_LAT}deg', f'{ATA_HEIGHT}m')
+        coordsystem = 'local'
+    else:
+        reference = me.position('ITRF', *[f'{c}m' for c in layout.mean(axis=0)])
+        coordsystem = 'global'
+    sm.setconfig(telescopename='ATA', x=layout[:, 0], y=layout[:, 1], z=layout[:, 2],
+                 dishdiameter=[DISH_DIAMETER]*len(antennas), mount=['alt-az']*len(antennas),
+                 antname=antennas, padname=antennas, coordsystem=coordsystem, referencelocation=reference)
+    sm.setspwindow(spwname='spw0', freq=f'{freq_ghz}GHz', deltafreq=f'{chan_mhz}MHz', freqresolution=f'{chan_mhz}MHz',
+                   nchannels=nchan, stokes='XX XY YX YY')
+    sm.setfeed(mode='perfect X Y', pol=[''])
+    for name, (ra, dec) in fields.items():
+        sm.setfield(sourcename=name, sourcedirection=me.direction('J2000', f'{ra*15.}deg', f'{dec}deg'))
+    sm.setlimits(shadowlimit=0.001, elevationlimit=f'{min_alt}deg')
+    sm.setauto(autocorrwt=0.0)
+    sm.settimes(integrationtime=f'{integration}s', usehourangle=False, referencetime=me.epoch('UTC', f'{start_mjd}d'))
+
+    t = 0.
+    while t < hours * 3600.:
+        for name, minutes in cycle:
+            stop = min(t + minutes * 60., hours * 3600.)
+            if stop - t >= integration:
+                sm.observe(sourcename=name, spwname='spw0', starttime=f'{t}s', stoptime=f'{stop}s')
+            t = stop
+    sm.close()
+
+
+def fill_data(vis: str, terms: dict, noise: float, seed: int = 0) -> dict:
+    '''Write corrupted visibilities to DATA in row chunks; returns the unique times and their parallactic angles'''
+    from casatools import measures, table
+    me = measures()
+    tb = table()
+
+    tb.open(os.path.join(vis, 'SPECTRAL_WINDOW'))
+    freq = tb.getcell('CHAN_FREQ', 0) / 1e9
+    tb.close()
+    tb.open(os.path.join(vis, 'ANTENNA'))
+    position = tb.getcol('POSITION').mean(axis=1)
+    tb.close()
+    tb.open(os.path.join(vis, 'FIELD'))
+    names = list(tb.getcol('NAME'))
+    phase_dirs = tb.getcol('PHASE_DIR')[:, 0, :]
+    tb.close()
+    directions = {fid: me.direction('J2000', f'{phase_dirs[0, fid]}rad', f'{phase_dirs[1, fid]}rad')
+                  for fid in range(len(names))}
+    stokes = np.array([source_stokes(name, freq) for name in names])
+
+    tb.open(vis, nomodify=False)
+    time = tb.getcol('TIME')
+    field = tb.getcol('FIELD_ID')
+    times, first = np.unique(time, return_index=True)
+    parang = parallactic_angles(times, field[first], directions, position)
+
+    rng = np.random.default_rng(seed + 1)
+    rows = max(1, CHUNK_VISIBILITIES // len(freq))
+    for start in range(0, len(time), rows):
+        n = min(rows, len(time) - start)
+        a1 = tb.getcol('ANTENNA1', startrow=start, nrow=n)
+        a2 = tb.getcol('ANTENNA2', startrow=start, nrow=n)
+        t = np.searchsorted(times, time[start:start + n])
+        e1 = terms['gains'][a1, t][:, None, :] * terms['bandpass'][a1] * terms['cross'][None]
+        e2 = terms['gains'][a2, t][:, None, :] * terms['bandpass'][a2] * terms['cross'][None]
+        data = corrupted_visibilities(stokes[field[start:start + n]], parang[t], terms['dterms'][a1],
+                                      terms['dterms'][a2], e1, e2)
+        if noise > 0:
+            data = data + noise * (rng.standard_normal(data.shape) + 1j*rng.standard_normal(data.shape))
+        tb.putcol('DATA', data.transpose(2, 1, 0), startrow=start, nrow=n)
+    if noise > 0:
+        tb.putcol('SIGMA', np.full((4, len(time)), noise))
+        tb.putcol('WEIGHT', np.full((4, len(time)), 1 / noise**2))
+    tb.close()
+    return {'freq': freq, 'times': times, 'parang': parang, 'stokes': dict(zip(names, stokes))}
+
+
+def simulate(vis: str, size: str = 'tiny', cycle: list = DEFAULT_CYCLE, date: str = '2024-01-24',
+             start_ha: float = -3., start: str = None, layout_ms: str = None, noise: float = NOISE, seed: int = 0,
+             overwrite: bool = False, **overrides) -> dict:
+    '''
+    Write a simulated observation to vis and its ground truth next to it.
+    overrides replace entries of SIZES[size] (antennas, nchan, integration,
+    hours) or the corruption defaults of instrument(). Returns the truth.
+    '''
+    config = dict(SIZES[size])
+    config.update({key: overrides.pop(key) for key in list(overrides) if key in config})
+    antennas = ANTENNAS[:config['antennas']]
+
+    if os.path.exists(vis):
+        if not overwrite:
+            raise FileExistsError(f"{vis} exists; pass overwrite to replace it")
+        shutil.rmtree(vis)
+
+    catalog = CalibratorCatalog.load()
+    fields = {name: source_position(name, catalog) for name, _ in cycle}
+    # Parallactic angle coverage follows from where the polarization calibrator (the first field) starts
+    start_mjd = iso_to_mjd(start) if start else start_for_hour_angle(date, fields[cycle[0][0]][0], start_ha)
+
+    if layout_ms:
+        layout, local = ms_layout(layout_ms, antennas), False
+    else:
+        layout, local = synthetic_layout(len(antennas), seed), True
+    create_ms(vis, antennas, layout, local, fields, cycle, start_mjd, config['hours'], config['nchan'],
+              config['integration'])
+
+    from casatools import table
+    tb = table()
+    tb.open(vis)
+    times = np.unique(tb.getcol('TIME'))
+    tb.close()
+    tb.open(os.path.join(vis, 'SPECTRAL_WINDOW'))
+    freq = tb.getcell('CHAN_FREQ', 0) / 1e9
+    tb.close()
+
+    terms = instrument(antennas, freq, times, seed=seed, **overrides)
+    filled = fill_data(vis, terms, noise, seed=seed)
+
+    truth = {
+        'vis': vis,
+        'antennas': antennas,
+        'ref_freq_ghz': float(freq.mean()),
+        'xy_phase_deg': overrides.get('xy_phase', XY_PHASE),
+        'kcross_ns': overrides.get('kcross', KCROSS),
+        'dterms': {ant: {'x': [d[0].real, d[0].imag], 'y': [d[1].real, d[1].imag]}
+                   for ant, d in zip(antennas, terms['dterms'].tolist())},
+        'sources': {name: [float(s) for s in stokes.mean(axis=1)] for name, stokes in filled['stokes'].items()},
+        'parang_range_deg': [float(np.rad2deg(filled['parang']).min()), float(np.rad2deg(filled['parang']).max())],
+        'noise_jy': noise,
+        'size': size,
+        'config': config,
+        'seed': seed,
+    }
+    with open(f"{vis.rstrip('/')}.truth.json", 'w') as f:
+        json.dump(truth, f, indent=1)
+    np.savez(f"{vis.rstrip('/')}.truth.npz", freq=filled['freq'], times=filled['times'], parang=filled['parang'],
+             gains=terms['gains'], bandpass=terms['bandpass'], cross=terms['cross'], dterms=terms['dterms'])
+    return truth
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate an ATA polarization observation with known corruptions')
+    parser.add_argument('-o', '--vis', required=True, help="Output measurement set")
+    parser.add_argument('--size', choices=list(SIZES), default='tiny', help="Antennas, channels, integration and length")
+    parser.add_argument('--cycle', nargs='+', default=[f'{name}:{minutes:g}' for name, minutes in DEFAULT_CYCLE],
+                        help="Scan cycle as field:minutes; the first field is the polarization calibrator")
+    parser.add_argument('--date', default='2024-01-24', help="UTC date of the observation")
+    parser.add_argument('--start-ha', dest='start_ha', type=float, default=-3.,
+                        help="Hour angle of the first field at the start, in hours")
+    parser.add_argument('--start', help="Start time (UTC), in place of --date and --start-ha")
+    parser.add_argument('--hours', type=float, help="Observation length, overriding --size")
+    parser.add_argument('--nchan', type=int, help="Channels, overriding --size")
+    parser.add_argument('--antennas', type=int, help="Number of antennas from the ATA list, overriding --size")
+    parser.add_argument('--integration', type=float, help="Integration time in seconds, overriding --size")
+    parser.add_argument('--layout-ms', dest='layout_ms', help="Copy antenna positions from this MS")
+    parser.add_argument('--xy-phase', dest='xy_phase', type=float, default=XY_PHASE, help="Cross-hand phase (deg)")
+    parser.add_argument('--kcross', type=float, default=KCROSS, help="Cross-hand delay (ns)")
+    parser.add_argument('--dterm-rms', dest='dterm_rms', type=float, default=DTERM_RMS, help="Leakage scatter")
+    parser.add_argument('--noise', type=float, default=NOISE, help="Noise per visibility component (Jy)")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed of the layout and corruptions")
+    parser.add_argument('--overwrite', action='store_true', help="Replace an existing MS")
+    args = parser.parse_args()
+
+    cycle = [(entry.rsplit(':', 1)[0], float(entry.rsplit(':', 1)[1])) for entry in args.cycle]
+    overrides = {key: getattr(args, key) for key in ['hours', 'nchan', 'antennas', 'integration']
+                 if getattr(args, key) is not None}
+    truth = simulate(args.vis, size=args.size, cycle=cycle, date=args.date, start_ha=args.start_ha, start=args.start,
+                     layout_ms=args.layout_ms, noise=args.noise, seed=args.seed, overwrite=args.overwrite,
+                     xy_phase=args.xy_phase, kcross=args.kcross, dterm_rms=args.dterm_rms, **overrides)
+    print(f"Wrote {args.vis}: {len(truth['antennas'])} antennas, parallactic angle "
+          f"{truth['parang_range_deg'][0]:.1f} to {truth['parang_range_deg'][1]:.1f} deg")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+#############################################################################
+# Per-spectral-window parallel calibration
+#############################################################################
+
+# Runs a whole calibration chain (delay, bandpass, gains, Kcross, Xfparang,
+# D-terms) once per spectral window, each in its own worker process, then
+# merges the per-SPW caltables into the table names the serial scripts use.
+# Each worker is a fresh interpreter running this module (workers.run_module),
+# so the calling script is never re-executed. Workers select their SPW on the
+# original measurement set, so nothing is copied; the MS is only read while
+# the chains run. Anything that writes to the MS (flagdata, setjy) must happen
+# before calibrate_by_spw is called.
+#
+# Usage inside a calibration script:
+#
+#   results = calibrate_by_spw(obs_vis, 'standard_pol', tab_name, STANDARD_POL_TABLES,
+#                              primary_calibrator=primary_calibrator,
+#                              phase_calibrator=phase_calibrator, ref_ant=ref_ant)
+#   qu_model = merge_stokes_models([r['qu_model'] for r in results.values()])
+#
+# A chain is a function chain(vis, spw, tab, **options) registered in CHAINS
+# below. It writes its caltables as f'{tab}{suffix}' and returns a
+# JSON-serialisable dict.
+
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from workers import load_job, run_module
+
+# Caltables written by standard_pol_chain, as suffixes of the table name
+STANDARD_POL_TABLES = ['.G0', '.G1', '.K0', '.B0', '.G2', '.G3',
+                       '_pol.G3', '_pol.Kcross0', '_pol.Xfparang', '_pol.D0']
+
+
+def list_spws(vis: str) -> list:
+    '''Spectral window ids present in a measurement set'''
+    from casatools import msmetadata
+    msmd = msmetadata()
+    msmd.open(vis)
+    try:
+        return list(range(msmd.nspw()))
+    finally:
+        msmd.done()
+
+
+def _run_worker(chain: str, vis: str, spw: int, tab: str, options: dict):
+    '''Run one SPW chain in a separate interpreter; returns its result or None if it failed'''
+    result_file = f'{tab}.result.json'
+    if os.path.exists(result_file):
+        os.remove(result_file)
+    job = {'chain': chain, 'vis': vis, 'spw': spw, 'tab': tab, 'options': options}
+    if not run_module('spw_calibration', job, tab):
+        return None
+    with open(result_file) as f:
+        return json.load(f)
+
+
+def _copy_spw_rows(table_in: str, table_out: str):
+    '''Copy the SPECTRAL_WINDOW rows solved in table_in (channel averaging changes them) to table_out'''
+    from casatools import table
+    tb = table()
+    tb.open(table_in)
+    spws = np.unique(tb.getcol('SPECTRAL_WINDOW_ID'))
+    tb.close()
+
+    tb_in, tb_out = table(), table()
+    tb_in.open(os.path.join(table_in, 'SPECTRAL_WINDOW'))
+    tb_out.open(os.path.join(table_out, 'SPECTRAL_WINDOW'), nomodify=False)
+    for col in tb_in.colnames():
+        for spw in spws:
+            if tb_in.iscelldefined(col, int(spw)):
+                tb_out.putcell(col, int(spw), tb_in.getcell(col, int(spw)))
+    tb_in.close()
+    tb_out.close()
+
+
+def merge_caltables(tables: list, output: str):
+    '''
+    Merge caltables solved for different spectral windows of the same MS into
+    one table. Tables that do not exist are skipped.
+    '''
+    from casatools import table
+    tables = [t for t in tables if os.path.isdir(t)]
+    if not tables:
+        print(f"No per-SPW tables to merge into {output}")
+        return
+
+    shutil.rmtree(output, ignore_errors=True)
+    tb = table()
+    tb.open(tables[0])
+    tb.copy(output, deep=True, valuecopy=True)
+    tb.close()
+
+    for t in tables[1:]:
+        tb.open(t)
+        tb.copyrows(output, startrowin=0, startrowout=-1, nrow=-1)
+        tb.close()
+        _copy_spw_rows(t, output)
+
+
+def merge_stokes_models(models: list) -> dict:
+    '''Combine polfromgain results from several SPWs into one {field: {'SpwN': ...}} dict'''
+    merged = {}
+    for model in models:
+        for field, spws in model.items():
+            merged.setdefault(field, {}).update(spws)
+    return merged
+
+
+def calibrate_by_spw(vis: str, chain: str, tab_name: str, tables: list, spws: list = None,
+                     nproc: int = 0, **options) -> dict:
+    '''
+    Run the named chain for every SPW in parallel and merge the caltables
+    listed in tables (suffixes) into f'{tab_name}{suffix}'. Returns {spw: chain result} for the
+    SPWs whose chain completed; a failing SPW is reported and left out.
+    '''
+    if spws is None:
+        spws = list_spws(vis)
+    spws = [int(s) for s in spws]
+    workers = min(len(spws), nproc or os.cpu_count() or 1)
+    print(f"Calibrating spectral windows {spws} with {workers} worker processes")
+
+    # Tables left by an earlier run must not be mistaken for this run's solutions
+    for spw in spws:
+        for suffix in tables:
+            shutil.rmtree(f'{tab_name}_spw{spw}{suffix}', ignore_errors=True)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {spw: pool.submit(_run_worker, chain, vis, spw, f'{tab_name}_spw{spw}', options)
+                   for spw in spws}
+        results = {spw: future.result() for spw, future in futures.items()}
+    results = {spw: result for spw, result in results.items() if result is not None}
+
+    if not results:
+        raise RuntimeError(f"Calibration failed for every spectral window of {vis}")
+
+    # Only completed chains are merged; a failed chain may have written some of its tables
+    for suffix in tables:
+        merge_caltables([f'{tab_name}_spw{spw}{suffix}' for spw in sorted(results)], f'{tab_name}{suffix}')
+    return results
+
+
+#############################################################################
+# Calibration chains
+#############################################################################
+
+def best_crosshand_scan(caltable: str) -> int:
+    '''
+    Scan where the polarization signal is minimum in XX and YY (maximum in XY
+    and YX), judged from the gain ratio of a G table. Taken from the ALMA pipeline.
+    '''
+    from casatools import table
+    tb = table()
+    tb.open(caltable)
+    scans = tb.getcol('SCAN_NUMBER')
+    gains = np.squeeze(tb.getcol('CPARAM'))
+    tb.close()
+    scan_list = np.unique(scans)
+    ratios = np.zeros(len(scan_list))
+    for si, s in enumerate(scan_list):
+        filt = scans == s
+        ratios[si] = np.sqrt(np.average(np.power(np.abs(gains[0, filt])/np.abs(gains[1, filt])-1.0, 2.)))
+    return int(scan_list[np.argmin(ratios)])
+
+
+def standard_pol_chain(vis: str, spw: int, tab: str, primary_calibrator: str, phase_calibrator: str,
+                       ref_ant: str) -> dict:
+    '''Calibration chain of calibrate_pol_standard_observations.py for a single SPW'''
+    from casatasks import bandpass, gaincal, polcal, polfromgain
+    spw_sel = str(spw)
+    spw_key = f'Spw{spw}'
+
+    gaincal(vis=vis, caltable=f'{tab}.G0', field=primary_calibrator, spw=spw_sel, refant=ref_ant, refantmode='strict',
+            calmode='p', solint='inf', preavg=1, minsnr=0, minblperant=1, parang=True)
+    gaincal(vis=vis, caltable=f'{tab}.G1', field=primary_calibrator, spw=spw_sel, refant=ref_ant, refantmode='strict',
+            calmode='a', solint='100', preavg=1, minsnr=0, minblperant=1, gaintype='G', gaintable=[f'{tab}.G0'], parang=True)
+    gaincal(vis=vis, caltable=f'{tab}.K0', field=primary_calibrator, spw=spw_sel, refant=ref_ant, solint='inf',
+            combine='scan', preavg=1, gaintype='K', gaintable=[f'{tab}.G0', f'{tab}.G1'], parang=True)
+    bandpass(vis=vis, caltable=f'{tab}.B0', field=primary_calibrator, spw=spw_sel, refant=ref_ant,
+             bandtype='B', gaintable=[f'{tab}.G0', f'{tab}.G1', f'{tab}.K0'], parang=True)
+    gaincal(vis=vis, caltable=f'{tab}.G2', field=f'{primary_calibrator},{phase_calibrator}', spw=spw_sel,
+            refant=ref_ant, calmode='ap', solint='300', gaintype='G', minsnr=0,
+            gaintable=[f'{tab}.K0', f'{tab}.B0', f'{tab}.G0', f'{tab}.G1'], parang=True, minblperant=1)
+
+    # Gains absorb the parallactic angle variation, giving a Stokes model for the calibrator
+    gaincal(vis=vis, caltable=f'{tab}.G3', field=primary_calibrator, spw=spw_sel, refant=ref_ant, solint='120',
+            gaintype='G', gaintable=[f'{tab}.K0', f'{tab}.B0'])
+    qu_model = polfromgain(vis=vis, tablein=f'{tab}.G3')
+    smodel = qu_model[primary_calibrator][spw_key]
+
+    gaincal(vis=vis, caltable=f'{tab}_pol.G3', refant=ref_ant, refantmode='strict', solint='120', calmode='ap',
+            spw=spw_sel, field=primary_calibrator, smodel=smodel, parang=True, gaintype='G',
+            gaintable=[f'{tab}.K0', f'{tab}.B0', f'{tab}.G2'])
+
+    best_scan = best_crosshand_scan(f'{tab}.G3')
+    gaincal(vis=vis, caltable=f'{tab}_pol.Kcross0', spw=spw_sel, refant=ref_ant, solint='inf',
+            field=primary_calibrator, gaintype='KCROSS', scan=str(best_scan), smodel=[1, 0, 1, 0], calmode='ap',
+            minblperant=1, refantmode='strict', parang=True)
+    S_model = polcal(vis=vis, caltable=f'{tab}_pol.Xfparang', field=primary_calibrator, spw=spw_sel, smodel=smodel,
+                     solint='inf', combine='scan', preavg=120, poltype='Xfparang+QU',
+                     gaintable=[f'{tab}.B0', f'{tab}.G2', f'{tab}_pol.G3', f'{tab}_pol.Kcross0'],
+                     gainfield=[primary_calibrator]*4)
+    polcal(vis=vis, caltable=f'{tab}_pol.D0', field=primary_calibrator, spw=spw_sel, solint='inf', combine='scan',
+           preavg=120, poltype='Dflls', refant='', smodel=smodel,
+           gaintable=[f'{tab}.B0', f'{tab}.G2', f'{tab}_pol.G3', f'{tab}_pol.Kcross0', f'{tab}_pol.Xfparang'])
+
+    return {'qu_model': qu_model, 'S_model': S_model, 'best_scan': best_scan}
+
+
+def field_pol_chain(vis: str, spw: int, tab: str, source: str, source_tag: str, field: str, refant: str,
+                    bandpass_scan: str, gain_scan: str, kcross_scan: str, pol_channels: str = '') -> dict:
+    '''
+    Calibration chain of calibrate_1256_057.py for a single SPW: amplitude gains
+    and bandpass from a bright calibrator scan, polarization from a source with
+    polfromgain Stokes estimates. pol_channels restricts the polarization solves
+    to a channel range of the SPW.
+    '''
+    from casatasks import bandpass, gaincal, polcal, polfromgain
+    spw_sel = str(spw)
+    pol_sel = f'{spw}:{pol_channels}' if pol_channels else spw_sel
+    src = f'{tab}_{source_tag}'
+
+    gaincal(vis=vis, caltable=f'{tab}.G0', spw=spw_sel, refant=refant, refantmode='strict',
+            scan=bandpass_scan, solint='inf', calmode='a')
+    gaincal(vis=vis, caltable=f'{src}.G0', spw=spw_sel, refant=refant, refantmode='strict',
+            scan=gain_scan, solint='inf', calmode='a')
+    bandpass(vis=vis, caltable=f'{tab}.B0', spw=spw_sel, refant=refant, scan=bandpass_scan, solint='inf',
+             bandtype='B', gaintable=[f'{tab}.G0'])
+
+    gaincal(vis=vis, caltable=f'{src}.field{field}.G1', spw=spw_sel, refant=refant, refantmode='strict',
+            solint='300', calmode='ap', field=field, gaintable=[f'{tab}.B0', f'{src}.G0'])
+    qu_model = polfromgain(vis=vis, tablein=f'{src}.field{field}.G1')
+    smodel = qu_model[source][f'Spw{spw}']
+
+    gaincal(vis=vis, caltable=f'{src}.field{field}.G2', spw=spw_sel, refant=refant, refantmode='strict',
+            solint='300', calmode='ap', field=field, smodel=smodel, parang=True,
+            gaintable=[f'{tab}.B0', f'{src}.G0'])
+
+    gaintables = [f'{tab}.B0', f'{src}.G0', f'{src}.field{field}.G2']
+    gaincal(vis=vis, caltable=f'{src}.Kcross0', scan=kcross_scan, spw=pol_sel, gaintype='KCROSS', solint='inf',
+            refant=refant, refantmode='strict', smodel=[1, 0, 1, 0], gaintable=gaintables,
+            interp=['nearest', 'nearest', 'nearest'])
+    polcal(vis=vis, caltable=f'{src}.Xfparang', field=field, spw=pol_sel, solint='inf', combine='scan', preavg=300,
+           smodel=smodel, poltype='Xfparang+QU', gaintable=gaintables + [f'{src}.Kcross0'])
+    polcal(vis=vis, caltable=f'{src}.D0', field=field, spw=pol_sel, solint='inf', combine='scan', preavg=300,
+           smodel=smodel, poltype='Dflls', refant='',
+           gaintable=gaintables + [f'{src}.Kcross0', f'{src}.Xfparang'])
+    S_model = polcal(vis=vis, caltable=f'{src}.Xfparang1', field=field, spw=pol_sel, solint='inf', combine='scan',
+                     preavg=300, smodel=smodel, poltype='Xfparang+QU',
+                     gaintable=gaintables + [f'{src}.Kcross0', f'{src}.D0'])
+
+    return {'qu_model': qu_model, 'S_model': S_model}
+
+
+CHAINS = {
+    'standard_pol': standard_pol_chain,
+    'field_pol': field_pol_chain,
+}
+
+
+if __name__ == '__main__':
+    # Worker process started by run_module
+    job = load_job()
+
+    from casatasks import casalog
+    casalog.setlogfile(f"{job['tab']}.casa.log")
+    result = CHAINS[job['chain']](job['vis'], job['spw'], job['tab'], **job['options'])
+
+    from step_cache import json_default
+    with open(f"{job['tab']}.result.json", 'w') as f:
+        json.dump(result, f, default=json_default)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+#############################################################################
+# Content-hashed step cache for CASA calibration solves
+#############################################################################
+
+# Each solve (gaincal, bandpass, polcal, polfromgain, ...) is fingerprinted by
+# the task name, its arguments, the contents of every input caltable and the
+# state of the measurement set. On a re-run, a step whose fingerprint is
+# unchanged and whose output caltable is still intact is skipped and its
+# recorded return value is handed back instead.
+#
+# The MS state is not its file mtimes, which every flagdata, setjy or applycal
+# changes. It is a chain: it starts from the MS identity (its metadata
+# subtables, which data-column writes leave alone). Each step that modifies the
+# MS extends it with that step's fingerprint. The chain fingerprints applied
+# to the MS are recorded, so on a re-run the same modifying steps in the same
+# order are recognised as already applied and skipped. The solves after them
+# then see the same chain and are reused too. A new or changed modifying step
+# starts a new branch of the chain, and every later step runs again.
+#
+# Usage inside a calibration script:
+#
+#   cache = StepCache(obs_vis, cache_file=f'{tab_name}.step_cache.json')
+#   cache.run(gaincal, vis=obs_vis, caltable=f'{tab_name}.G0', field=..., ...)
+#   qu_model = cache.run(polfromgain, vis=obs_vis, tablein=f'{tab_name}.G3')
+#   cache.run(flagdata, modifies_vis=True, vis=obs_vis, mode='manual', ...)
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+CACHE_VERSION = 2
+
+# Task arguments that name caltables or files read by the task
+INPUT_TABLE_ARGS = ['gaintable', 'tablein', 'callib', 'inpfile']
+
+# Lock files are rewritten whenever a table is opened, even read-only
+IGNORED_FILES = ['table.lock']
+
+
+def task_name(task) -> str:
+    '''Name of a CASA task, whether it is a plain function or a task object'''
+    name = getattr(task, '__name__', None) or type(task).__name__
+    return name.lstrip('_')
+
+
+def _walk_table(path: str):
+    '''Yield (relative path, absolute path) of every file in a CASA table, in a stable order'''
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if name in IGNORED_FILES:
+                continue
+            full = os.path.join(root, name)
+            yield os.path.relpath(full, path), full
+
+
+def table_digest(path: str) -> str:
+    '''
+    Content hash of a caltable (or any small table/file). Caltables are a few
+    MB at most, so hashing the bytes is cheap and catches in-place edits.
+    '''
+    if not os.path.exists(path):
+        return ''
+    h = hashlib.sha256()
+    if os.path.isfile(path):
+        entries = [(os.path.basename(path), path)]
+    else:
+        entries = _walk_table(path)
+    for rel, full in entries:
+        h.update(rel.encode())
+        with open(full, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    return h.hexdigest()
+
+
+def ms_state(vis: str) -> str:
+    '''
+    Modification state of a measurement set. Hashing the visibilities themselves
+    would cost a full read, so use the size and mtime of every storage file.
+    '''
+    if not os.path.exists(vis):
+        return ''
+    h = hashlib.sha256()
+    for rel, full in _walk_table(vis):
+        st = os.stat(full)
+        h.update(f'{rel}:{st.st_size}:{st.st_mtime_ns}'.encode())
+    return h.hexdigest()
+
+
+def ms_identity(vis: str) -> str:
+    '''
+    Identity of a measurement set that flagging, models and applycal leave
+    alone: the state of its metadata subtables. A new MS at the same path
+    has a different identity.
+    '''
+    from ms_metadata import METADATA_SUBTABLES
+    h = hashlib.sha256()
+    for sub in METADATA_SUBTABLES:
+        h.update(f'{sub}:{ms_state(os.path.join(vis, sub))}'.encode())
+    return h.hexdigest()
+
+
+def _chain(*parts) -> str:
+    return hashlib.sha256(':'.join(parts).encode()).hexdigest()
+
+
+def json_default(obj):
+    '''Allow numpy values returned by polcal/polfromgain to be stored as JSON'''
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f'Cannot serialise {type(obj).__name__} in step cache')
+
+
+def _as_list(value) -> list:
+    if value is None or value == '':
+        return []
+    if isinstance(value, (list, tuple)):
+        return [v for v in value if v]
+    return [value]
+
+
+class StepCache:
+    '''Skips CASA solves whose inputs have not changed since the last run'''
+
+    def __init__(self, vis: str, cache_file: str = '', enabled: bool = True):
+        self.vis = vis
+        self.cache_file = cache_file or f"{vis.rstrip('/').split('.')[0]}.step_cache.json"
+        self.enabled = enabled
+        self.entries = {}
+        # Per MS: identity, chain seed and the modifying steps applied to it
+        self.ms_records = {}
+        self._chains = {}
+
+        if enabled and os.path.exists(self.cache_file):
+            with open(self.cache_file) as f:
+                saved = json.load(f)
+            if saved.get('version') == CACHE_VERSION:
+                self.entries = saved.get('steps', {})
+                self.ms_records = saved.get('ms', {})
+
+    def _save(self):
+        tmp = f'{self.cache_file}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'steps': self.entries, 'ms': self.ms_records}, f, indent=1,
+                      default=json_default)
+        os.replace(tmp, self.cache_file)
+
+    def _state(self, vis: str) -> dict:
+        '''
+        Chain state of an MS in this run: the current chain fingerprint, the
+        steps already applied to the MS on disk and those applied so far in
+        this run. Set up on first use, before this run modifies the MS.
+        '''
+        if vis not in self._chains:
+            identity = ms_identity(vis)
+            record = self.ms_records.get(vis)
+            if record is not None and record['identity'] == identity:
+                seed, applied = record['seed'], record['history']
+            else:
+                seed, applied = _chain(identity), []
+            self._chains[vis] = {'seed': seed, 'chain': seed, 'applied': set(applied), 'history': []}
+        return self._chains[vis]
+
+    def _argument_hash(self, name: str, kwargs: dict) -> str:
+        '''Hash of the task name, its arguments and the contents of its input tables'''
+        inputs = {}
+        for arg in INPUT_TABLE_ARGS:
+            for table in _as_list(kwargs.get(arg)):
+                inputs[table] = table_digest(table)
+
+        payload = json.dumps({'task': name, 'args': kwargs, 'inputs': inputs},
+                             sort_keys=True, default=json_default)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def run(self, task, modifies_vis: bool = False, **kwargs):
+        '''
+        Run a CASA task through the cache. Tasks that write to the measurement
+        set (flagdata, setjy, applycal) must pass modifies_vis=True: they are
+        skipped only if the MS already holds them, after the same earlier steps.
+        '''
+        if not self.enabled:
+            return task(**kwargs)
+
+        name = task_name(task)
+        vis = kwargs.get('vis', self.vis)
+        caltable = kwargs.get('caltable', '')
+        args_hash = self._argument_hash(name, kwargs)
+        state = self._state(vis)
+
+        fingerprint = _chain(state['chain'], args_hash)
+        if modifies_vis:
+            key = f'{name}:{fingerprint}'
+            entry = self.entries.get(key)
+            up_to_date = entry is not None and fingerprint in state['applied']
+        else:
+            key = caltable if caltable else f'{name}:{args_hash}'
+            entry = self.entries.get(key)
+            up_to_date = entry is not None and entry['fingerprint'] == fingerprint \
+                         and entry['output'] == table_digest(caltable)
+
+        if up_to_date:
+            print(f"Step cache: reusing {name} {caltable}".rstrip())
+            result = entry['result']
+        else:
+            print(f"Step cache: running {name} {caltable}".rstrip())
+            result = task(**kwargs)
+            self.entries[key] = {
+                'task': name,
+                'fingerprint': fingerprint,
+                'output': table_digest(caltable) if caltable else '',
+                'result': result,
+            }
+
+        if modifies_vis:
+            state['chain'] = fingerprint
+            state['history'].append(fingerprint)
+            if not up_to_date:
+                # Steps of earlier runs after this one no longer follow the chain
+                state['applied'] = set(state['history'])
+                self.ms_records[vis] = {'identity': ms_identity(vis), 'seed': state['seed'],
+                                        'history': list(state['history'])}
+        if not up_to_date:
+            self._save()
+        return result
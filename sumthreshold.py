@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+#############################################################################
+# SumThreshold RFI pre-flagging
+#############################################################################
+
+# A NumPy implementation of the SumThreshold method (Offringa et al. 2010)
+# used by aoflagger, so pre-flagging no longer needs aoflagger or the
+# tfcrop/rflag fallback. The MS is split into chunks of whole integrations;
+# worker processes read their chunks, build a (baseline, time, correlation,
+# channel) cube per field and SPW, and flag every baseline at once. Amplitudes
+# have a smooth background subtracted and are scaled by the MAD of each
+# baseline, then windows of 1, 2, 4, ... samples along time and frequency are
+# flagged when their mean exceeds threshold / rho**log2(window). The workers
+# only read the MS; the parent writes FLAG back one chunk at a time with putcol.
+#
+# FLAG and the data column must have the same shape in every row (one SPW, or
+# SPWs with equal channel counts), as for tb.getcol.
+#
+# Usage inside a calibration script:
+#
+#   sumthreshold_flag(obs_vis, fields=[target])
+
+import json
+import os
+import warnings
+
+import numpy as np
+
+from workers import load_job, run_modules
+
+# Integrations per chunk; time windows cannot extend across chunks
+CHUNK_TIMES = 128
+
+WINDOWS = (1, 2, 4, 8, 16, 32, 64)
+
+
+def _take(values, axis: int, start: int = None, stop: int = None):
+    '''values[..., start:stop, ...] with the slice on the given axis'''
+    index = [slice(None)] * values.ndim
+    index[axis] = slice(start, stop)
+    return values[tuple(index)]
+
+
+def _sumthreshold_axis(values, flags, threshold: float, window: int, axis: int):
+    '''Flag every run of window samples along axis whose mean exceeds threshold'''
+    n = values.shape[axis]
+    if window > n:
+        return flags
+    # Samples flagged already count as exactly the threshold, as in aoflagger.
+    # Sums run along the axis in place: moving it last would make them strided
+    c = np.cumsum(np.where(flags, np.float32(threshold), values), axis=axis, dtype=np.float32)
+    sums = np.concatenate([_take(c, axis, window - 1, window),
+                           _take(c, axis, window) - _take(c, axis, None, -window)], axis=axis)
+    hits = sums > threshold * window
+
+    # A sample is flagged if any window starting in [i - window + 1, i] was;
+    # spread each hit forward by doubling shifts
+    pad = [(0, 0)] * hits.ndim
+    pad[axis] = (0, window - 1)
+    covered = np.pad(hits, pad)
+    span = 1
+    while span < window:
+        step = min(span, window - span)
+        shifted = np.zeros_like(covered)
+        _take(shifted, axis, step)[...] = _take(covered, axis, None, -step)
+        covered |= shifted
+        span += step
+    return flags | covered
+
+
+def _running_median(values, width: int, axis: int):
+    '''Median of each sample and its neighbours in a window of width samples along axis, ignoring NaN'''
+    pad = [(0, 0)] * values.ndim
+    pad[axis] = (width // 2, width - 1 - width // 2)
+    windows = np.lib.stride_tricks.sliding_window_view(np.pad(values, pad, mode='edge'), width, axis=axis)
+    return np.nanmedian(windows, axis=-1)
+
+
+def sumthreshold(amp, flags, threshold: float = 6., rho: float = 1.5, windows: tuple = WINDOWS,
+                 smooth_channels: int = 15, smooth_times: int = 31):
+    '''
+    SumThreshold flags for amplitudes of shape (nbaseline, ntime, npol, nchan),
+    in time then frequency for each window size. The background is the median
+    spectrum over time, smoothed over smooth_channels so persistent narrowband
+    RFI stands out, plus the median over channels smoothed over smooth_times
+    integrations, which follows gain drifts but not broadband bursts. Returns
+    the combined flags.
+    '''
+    masked = np.where(flags, np.nan, amp)
+    # All-NaN slices (fully flagged channels or baselines) give NaN and a warning
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        spectrum = _running_median(np.nanmedian(masked, axis=1, keepdims=True), smooth_channels, axis=3)
+        residual = masked - spectrum
+        residual -= _running_median(np.nanmedian(residual, axis=3, keepdims=True), smooth_times, axis=1)
+        sigma = 1.4826 * np.nanmedian(np.abs(residual), axis=(1, 3), keepdims=True)
+        residual = np.nan_to_num(residual / sigma, nan=0., posinf=0., neginf=0.).astype(np.float32)
+
+    out = flags.copy()
+    for window in windows:
+        chi = threshold / rho**np.log2(window)
+        out = _sumthreshold_axis(residual, out, chi, window, axis=1)
+        out = _sumthreshold_axis(residual, out, chi, window, axis=3)
+    return out
+
+
+def flag_chunk(data, flags, field, ddid, a1, a2, time, selected: list, **options):
+    '''New FLAG values for one chunk of rows; rows of fields not in selected keep their flags'''
+    new_flags = flags.copy()
+    for f in np.unique(field):
+        if selected and f not in selected:
+            continue
+        for d in np.unique(ddid[field == f]):
+            rows = np.flatnonzero((field == f) & (ddid == d))
+            baselines, bl = np.unique(a1[rows] * 1000 + a2[rows], return_inverse=True)
+            times, ti = np.unique(time[rows], return_inverse=True)
+
+            # Rows missing from the cube stay flagged and are never written back
+            shape = (len(baselines), len(times)) + data.shape[:2]
+            cube = np.zeros(shape, dtype=np.float32)
+            cube_flags = np.ones(shape, dtype=bool)
+            cube[bl, ti] = np.abs(data[:, :, rows]).transpose(2, 0, 1)
+            cube_flags[bl, ti] = flags[:, :, rows].transpose(2, 0, 1)
+
+            result = sumthreshold(cube, cube_flags, **options)
+            new_flags[:, :, rows] = result[bl, ti].transpose(1, 2, 0)
+    return new_flags
+
+
+def chunk_ranges(vis: str, chunk_times: int = CHUNK_TIMES) -> list:
+    '''[start, stop) row ranges of whole integrations'''
+    from casatools import table
+    tb = table()
+    tb.open(vis)
+    time = tb.getcol('TIME')
+    tb.close()
+    starts = np.flatnonzero(np.diff(time) != 0) + 1
+    edges = [0] + [int(s) for s in starts[chunk_times - 1::chunk_times]] + [len(time)]
+    return [[a, b] for a, b in zip(edges[:-1], edges[1:]) if b > a]
+
+
+def flag_ranges(vis: str, ranges: list, name: str, datacolumn: str, selected: list, options: dict):
+    '''Worker: compute new flags for each row range and save them as <name>.<start>.npy'''
+    from casatools import table
+    column = 'CORRECTED_DATA' if datacolumn.lower() == 'corrected' else datacolumn.upper()
+    tb = table()
+    tb.open(vis)
+    counts = {'total': 0, 'before': 0, 'after': 0}
+    for start, stop in ranges:
+        n = stop - start
+        flags = tb.getcol('FLAG', startrow=start, nrow=n)
+        new_flags = flag_chunk(tb.getcol(column, startrow=start, nrow=n), flags,
+                               tb.getcol('FIELD_ID', startrow=start, nrow=n),
+                               tb.getcol('DATA_DESC_ID', startrow=start, nrow=n),
+                               tb.getcol('ANTENNA1', startrow=start, nrow=n),
+                               tb.getcol('ANTENNA2', startrow=start, nrow=n),
+                               tb.getcol('TIME', startrow=start, nrow=n), selected, **options)
+        np.save(f'{name}.{start}.npy', new_flags)
+        counts['total'] += flags.size
+        counts['before'] += int(flags.sum())
+        counts['after'] += int(new_flags.sum())
+        print(f"Rows {start}-{stop}: {int(new_flags.sum() - flags.sum())} new flags")
+    tb.close()
+    with open(f'{name}.result.json', 'w') as f:
+        json.dump(counts, f)
+
+
+def sumthreshold_flag(vis: str, fields: list = (), datacolumn: str = 'data', threshold: float = 6.,
+                      rho: float = 1.5, chunk_times: int = CHUNK_TIMES, nproc: int = 0) -> float:
+    '''
+    SumThreshold-flag the given fields (names or ids; all if empty) of an MS in
+    parallel and write the flags back. Returns the fraction of all the data in
+    the MS that was newly flagged.
+    '''
+    from casatools import table
+    tb = table()
+    tb.open(os.path.join(vis, 'FIELD'))
+    field_names = list(tb.getcol('NAME'))
+    tb.close()
+    selected = [field_names.index(f) if f in field_names else int(f) for f in map(str, fields)]
+
+    ranges = chunk_ranges(vis, chunk_times)
+    nproc = min(len(ranges), nproc or os.cpu_count() or 1)
+    work = f"{vis.rstrip('/')}.sumthreshold"
+    jobs = {f'{work}.{n}': {'vis': vis, 'ranges': ranges[n::nproc], 'name': f'{work}.{n}',
+                            'datacolumn': datacolumn, 'selected': selected,
+                            'options': {'threshold': threshold, 'rho': rho}}
+            for n in range(nproc)}
+    finished = run_modules('sumthreshold', jobs, nproc=nproc)
+
+    counts = {'total': 0, 'before': 0, 'after': 0}
+    tb.open(vis, nomodify=False)
+    for name, job in jobs.items():
+        for start, stop in job['ranges']:
+            chunk_file = f'{name}.{start}.npy'
+            if name in finished:
+                tb.putcol('FLAG', np.load(chunk_file), startrow=start, nrow=stop - start)
+            if os.path.exists(chunk_file):
+                os.remove(chunk_file)
+        if name in finished:
+            with open(f'{name}.result.json') as f:
+                for key, value in json.load(f).items():
+                    counts[key] += value
+            os.remove(f'{name}.result.json')
+    tb.close()
+
+    if len(finished) < len(jobs):
+        raise RuntimeError(f"SumThreshold flagging failed for {len(jobs) - len(finished)} of {len(jobs)} workers")
+    fraction = (counts['after'] - counts['before']) / max(counts['total'], 1)
+    print(f"SumThreshold: {100 * fraction:.2f}% newly flagged, {100 * counts['after'] / max(counts['total'], 1):.2f}% "
+          f"flagged in total")
+    return fraction
+
+
+if __name__ == '__main__':
+    # Worker process started by run_module
+    job = load_job()
+    flag_ranges(**job)
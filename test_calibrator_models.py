@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+# setjy_manual_model checked by evaluating its spix, polindex and polangle
+# terms the way setjy does for standard='manual' and comparing the result with
+# stokes_model. Run with python -m pytest test_calibrator_models.py
+
+import numpy as np
+
+from calibrator_models import setjy_manual_model, stokes_model
+
+
+def manual_stokes(model: dict, freq: np.ndarray) -> np.ndarray:
+    '''Stokes I, Q, U, V at freq (GHz) from setjy manual-model arguments'''
+    f0 = float(model['reffreq'].rstrip('GHz'))
+    r = np.log(freq / f0)
+    t = (freq - f0) / f0
+    i = model['fluxdensity'][0] * np.exp(r * np.polynomial.polynomial.polyval(r, model['spix']))
+    p = np.polynomial.polynomial.polyval(t, model['polindex']) * i
+    chi = 2*np.polynomial.polynomial.polyval(t, model['polangle'])
+    return np.stack([i, p*np.cos(chi), p*np.sin(chi), np.zeros_like(freq)])
+
+
+def test_manual_model_reproduces_stokes_model():
+    freq = np.linspace(1.0, 3.0, 9)
+    for source in ['3c286', '3c138', '3c48', 'J1130-1449']:
+        for reffreq in [1.4, 2.0, 2.8]:
+            model = setjy_manual_model(source, reffreq)
+            assert model['reffreq'] == f'{reffreq}GHz'
+            np.testing.assert_allclose(manual_stokes(model, freq), stokes_model(source, freq), rtol=1e-9, atol=1e-12)
+
+
+def test_aliases_give_the_same_model():
+    assert setjy_manual_model('1331+305', 1.5) == setjy_manual_model('3c286', 1.5)
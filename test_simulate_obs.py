@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+# The measurement equation and instrument terms of simulate_obs.py, checked
+# against the coherencies written out by hand. Run with
+# python -m pytest test_simulate_obs.py
+
+import numpy as np
+
+from ephemeris_cache import ATA_LON
+from ms_metadata import local_sidereal_time
+from simulate_obs import corrupted_visibilities, instrument, start_for_hour_angle
+
+NCHAN = 8
+
+
+def point_source(i, q, u, v, rows):
+    '''Stokes (rows, 4, NCHAN) of a flat-spectrum point source'''
+    return np.tile(np.array([i, q, u, v], dtype=float)[None, :, None], (rows, 1, NCHAN))
+
+
+def identity(rows):
+    return np.ones((rows, NCHAN, 2), dtype=complex)
+
+
+def test_identity_terms_give_rotated_coherency():
+    parang = np.deg2rad(np.array([-60., -10., 0., 25., 80.]))
+    rows = len(parang)
+    i, q, u, v = 2., 0.2, -0.1, 0.05
+    no_leakage = np.zeros((rows, 2), dtype=complex)
+    vis = corrupted_visibilities(point_source(i, q, u, v, rows), parang, no_leakage, no_leakage,
+                                 identity(rows), identity(rows))
+    assert vis.shape == (rows, NCHAN, 4)
+
+    c2, s2 = np.cos(2*parang)[:, None], np.sin(2*parang)[:, None]
+    flat = np.ones(NCHAN)
+    np.testing.assert_allclose(vis[..., 0], (i + q*c2 + u*s2) * flat)
+    np.testing.assert_allclose(vis[..., 1], (-q*s2 + u*c2 + 1j*v) * flat)
+    np.testing.assert_allclose(vis[..., 2], (-q*s2 + u*c2 - 1j*v) * flat)
+    np.testing.assert_allclose(vis[..., 3], (i - q*c2 - u*s2) * flat)
+
+
+def test_planted_leakage_appears_in_cross_hands():
+    rows = 3
+    d1 = np.tile([0.04 + 0.01j, -0.02 + 0.03j], (rows, 1))
+    d2 = np.tile([-0.01 - 0.05j, 0.03 + 0.02j], (rows, 1))
+    vis = corrupted_visibilities(point_source(5., 0., 0., 0., rows), np.zeros(rows), d1, d2,
+                                 identity(rows), identity(rows))
+
+    # Unpolarized source: XY = I (d1x + conj(d2y)), YX = I (d1y + conj(d2x))
+    np.testing.assert_allclose(vis[..., 1], 5. * (d1[:, :1] + d2[:, 1:].conj()) * np.ones(NCHAN))
+    np.testing.assert_allclose(vis[..., 2], 5. * (d1[:, 1:] + d2[:, :1].conj()) * np.ones(NCHAN))
+    np.testing.assert_allclose(vis[..., 0], 5. * (1 + d1[:, :1] * d2[:, :1].conj()) * np.ones(NCHAN))
+
+
+def test_diagonal_terms_scale_each_correlation():
+    rows = 2
+    rng = np.random.default_rng(1)
+    e1 = rng.standard_normal((rows, NCHAN, 2)) + 1j*rng.standard_normal((rows, NCHAN, 2))
+    e2 = rng.standard_normal((rows, NCHAN, 2)) + 1j*rng.standard_normal((rows, NCHAN, 2))
+    stokes = point_source(1., 0.1, 0.2, 0., rows)
+    no_leakage = np.zeros((rows, 2), dtype=complex)
+    ideal = corrupted_visibilities(stokes, np.zeros(rows), no_leakage, no_leakage, identity(rows), identity(rows))
+    vis = corrupted_visibilities(stokes, np.zeros(rows), no_leakage, no_leakage, e1, e2)
+    for k, (p, q) in enumerate([(0, 0), (0, 1), (1, 0), (1, 1)]):
+        np.testing.assert_allclose(vis[..., k], e1[..., p] * e2[..., q].conj() * ideal[..., k])
+
+
+def test_instrument_shapes_and_cross_hand_phase():
+    antennas = ['1a', '1b', '1c', '1d']
+    freq = np.linspace(1.0, 2.0, 17)
+    times = np.arange(0., 3600., 60.)
+    terms = instrument(antennas, freq, times, seed=3, xy_phase=40., kcross=1.5)
+
+    assert terms['dterms'].shape == (4, 2)
+    assert terms['gains'].shape == (4, len(times), 2)
+    assert terms['bandpass'].shape == (4, len(freq), 2)
+    assert terms['cross'].shape == (len(freq), 2)
+    np.testing.assert_allclose(terms['cross'][:, 0], 1.)
+    np.testing.assert_allclose(np.abs(terms['cross'][:, 1]), 1.)
+    # freq is symmetric about its mean, so the middle channel is at f_ref
+    np.testing.assert_allclose(np.angle(terms['cross'][len(freq) // 2, 1]), np.deg2rad(40.))
+
+    again = instrument(antennas, freq, times, seed=3, xy_phase=40., kcross=1.5)
+    for key, value in terms.items():
+        np.testing.assert_array_equal(again[key], value)
+
+
+def test_start_for_hour_angle():
+    date_mjd = 60333.    # 2024-01-24
+    for ra_hours, hour_angle in [(13.52, -3.), (18.82, 0.), (5.35, 2.5)]:
+        mjd = start_for_hour_angle('2024-01-24', ra_hours, hour_angle)
+        assert date_mjd <= mjd < date_mjd + 1
+        lst_hours = np.rad2deg(local_sidereal_time(mjd * 86400., np.deg2rad(ATA_LON))) / 15.
+        offset = np.mod(lst_hours - ra_hours - hour_angle + 12., 24.) - 12.
+        assert abs(offset) < 1e-4
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# StepCache with mock CASA tasks standing in for flagdata, setjy, gaincal and
+# applycal on a fake MS directory. Run with python -m pytest test_step_cache.py
+
+import os
+
+from step_cache import StepCache
+
+SUBTABLES = ['ANTENNA', 'DATA_DESCRIPTION', 'FIELD', 'OBSERVATION', 'SPECTRAL_WINDOW']
+
+
+def make_ms(path):
+    for sub in SUBTABLES:
+        os.makedirs(os.path.join(path, sub))
+        with open(os.path.join(path, sub, 'table.dat'), 'w') as f:
+            f.write(sub)
+    with open(os.path.join(path, 'table.f0'), 'w') as f:
+        f.write('data')
+
+
+def touch(vis, name, text):
+    with open(os.path.join(vis, name), 'a') as f:
+        f.write(text)
+
+
+class Tasks:
+    '''Mock tasks that write to the MS or a caltable and count their calls'''
+
+    def __init__(self):
+        self.calls = []
+
+    def flagdata(self, vis, mode):
+        self.calls.append('flagdata')
+        touch(vis, 'table.f1', mode)
+
+    def setjy(self, vis, field):
+        self.calls.append('setjy')
+        touch(vis, 'table.dat', field)
+
+    def gaincal(self, vis, caltable, gaintable=None):
+        self.calls.append('gaincal')
+        os.makedirs(caltable, exist_ok=True)
+        with open(os.path.join(caltable, 'table.f0'), 'w') as f:
+            f.write(f'{caltable}:{gaintable}')
+
+    def polfromgain(self, vis, tablein):
+        self.calls.append('polfromgain')
+        return {'3c286': [1., 0.1, 0.05, 0.]}
+
+    def applycal(self, vis):
+        # Outside the cache, as apply_callib is in polcal_iterative.py
+        touch(vis, 'table.f2', 'corrected')
+
+
+def pipeline(cache, tasks, vis, flag_mode='manual'):
+    cache.run(tasks.flagdata, modifies_vis=True, vis=vis, mode=flag_mode)
+    cache.run(tasks.setjy, modifies_vis=True, vis=vis, field='3c286')
+    cache.run(tasks.gaincal, vis=vis, caltable=f'{vis}.G0')
+    cache.run(tasks.gaincal, vis=vis, caltable=f'{vis}.G1', gaintable=[f'{vis}.G0'])
+    result = cache.run(tasks.polfromgain, vis=vis, tablein=f'{vis}.G1')
+    tasks.applycal(vis)
+    return result
+
+
+def test_identical_rerun_reuses_every_step(tmp_path):
+    vis = str(tmp_path / 'obs.ms')
+    make_ms(vis)
+    cache_file = str(tmp_path / 'obs.step_cache.json')
+
+    first = Tasks()
+    expected = pipeline(StepCache(vis, cache_file=cache_file), first, vis)
+    assert first.calls == ['flagdata', 'setjy', 'gaincal', 'gaincal', 'polfromgain']
+
+    for _ in range(2):
+        again = Tasks()
+        assert pipeline(StepCache(vis, cache_file=cache_file), again, vis) == expected
+        assert again.calls == []
+
+
+def test_changed_step_reruns_it_and_everything_after(tmp_path):
+    vis = str(tmp_path / 'obs.ms')
+    make_ms(vis)
+    cache_file = str(tmp_path / 'obs.step_cache.json')
+    pipeline(StepCache(vis, cache_file=cache_file), Tasks(), vis)
+
+    changed = Tasks()
+    pipeline(StepCache(vis, cache_file=cache_file), changed, vis, flag_mode='tfcrop')
+    assert changed.calls == ['flagdata', 'setjy', 'gaincal', 'gaincal', 'polfromgain']
+
+    again = Tasks()
+    pipeline(StepCache(vis, cache_file=cache_file), again, vis, flag_mode='tfcrop')
+    assert again.calls == []
+
+
+def test_new_ms_at_same_path_reruns(tmp_path):
+    vis = str(tmp_path / 'obs.ms')
+    make_ms(vis)
+    cache_file = str(tmp_path / 'obs.step_cache.json')
+    pipeline(StepCache(vis, cache_file=cache_file), Tasks(), vis)
+
+    with open(os.path.join(vis, 'ANTENNA', 'table.dat'), 'w') as f:
+        f.write('re-ingested')
+    fresh = Tasks()
+    pipeline(StepCache(vis, cache_file=cache_file), fresh, vis)
+    assert fresh.calls == ['flagdata', 'setjy', 'gaincal', 'gaincal', 'polfromgain']
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+# SumThreshold on synthetic amplitude cubes (baseline, time, correlation,
+# channel) with RFI injected at known places. Run with
+# python -m pytest test_sumthreshold.py
+
+import numpy as np
+
+from sumthreshold import flag_chunk, sumthreshold
+
+SHAPE = (3, 128, 2, 64)
+
+
+def noise(seed=0):
+    '''Amplitudes of a 10 Jy source with unit complex noise, so the residual sigma is ~1'''
+    rng = np.random.default_rng(seed)
+    return np.abs(10 + rng.standard_normal(SHAPE) + 1j*rng.standard_normal(SHAPE)).astype(np.float32)
+
+
+def test_noise_is_barely_flagged():
+    for seed in range(3):
+        flags = sumthreshold(noise(seed), np.zeros(SHAPE, dtype=bool))
+        assert flags.mean() < 1e-3
+
+
+def test_burst_line_and_patch_are_flagged():
+    amp = noise()
+    amp[:, 40] += 3.                    # broadband burst in one integration
+    amp[:, :, :, 20] += 3.              # narrowband line in every integration
+    amp[:, 80:90, :, 40:50] += 3.       # weak patch, found by the longer windows
+    flags = sumthreshold(amp, np.zeros(SHAPE, dtype=bool))
+
+    assert flags[:, 40].mean() > 0.95
+    assert flags[:, :, :, 20].mean() > 0.95
+    assert flags[:, 80:90, :, 40:50].mean() > 0.9
+
+    clean = np.ones(SHAPE, dtype=bool)
+    clean[:, 40] = clean[:, :, :, 20] = clean[:, 80:90, :, 40:50] = False
+    assert flags[clean].mean() < 5e-3
+
+
+def test_existing_flags_are_kept():
+    flags = np.zeros(SHAPE, dtype=bool)
+    flags[1, 10:20] = True
+    assert sumthreshold(noise(), flags)[1, 10:20].all()
+
+
+def test_flag_chunk_leaves_other_fields_alone():
+    # Two fields of 3 baselines x 16 integrations in MS layout: (corr, chan, row)
+    nbl, ntime = 3, 16
+    a1, a2 = np.tile([0, 0, 1], ntime * 2), np.tile([1, 2, 2], ntime * 2)
+    time = np.repeat(np.arange(ntime * 2, dtype=float), nbl)
+    field = np.repeat([0, 1], nbl * ntime)
+    rng = np.random.default_rng(0)
+    data = 10 + rng.standard_normal((2, 64, len(time))) + 1j*rng.standard_normal((2, 64, len(time)))
+    data[:, 20] += 10.
+    flags = np.zeros(data.shape, dtype=bool)
+
+    new_flags = flag_chunk(data, flags, field, np.zeros_like(field), a1, a2, time, selected=[0])
+    assert new_flags[:, 20, field == 0].all()
+    assert not new_flags[..., field == 1].any()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+#############################################################################
+# Headless altitude and parallactic angle plots for plot_obs.py --batch
+#############################################################################
+
+# Each worker renders a share of the batch windows. For every window it
+# interpolates the calibrator's track from the ephemeris cache, draws it on
+# matplotlib Figure objects (no pyplot, so no display is needed), and writes
+# <outdir>/<NNN>_<calibrator>_altitude.png and _parallactic.png. It also
+# writes the sampled tracks to its own CSV, which plot_obs.py merges into
+# <outdir>/tracks.csv. The parent builds the ephemeris grids before starting
+# the workers, so they only read them from disk.
+#
+# Started by workers.run_modules from plot_obs.py:
+#
+#   python -m track_plots <job.json>
+
+import csv
+import os
+import re
+
+import numpy as np
+
+from ephemeris_cache import EphemerisCache, mjd_to_datetime64, plot_track
+from workers import load_job
+
+PLOT_POINTS = 500
+TRACK_FIELDS = ['window', 'calibrator', 'time_utc', 'mjd', 'alt_deg', 'pa_deg']
+
+
+def window_stem(window: dict) -> str:
+    slug = re.sub(r'[^\w+-]', '_', window['calibrator'] or 'position')
+    return f"{window['index']:03d}_{slug}"
+
+
+def render_window(ephemeris: EphemerisCache, window: dict, outdir: str) -> list:
+    '''Write the altitude and parallactic angle PNGs of one window; returns its track rows'''
+    from matplotlib.figure import Figure
+
+    mjd = np.linspace(window['start_mjd'], window['end_mjd'], PLOT_POINTS)
+    alt, pa = ephemeris.track(window['calibrator'], window['ra'], window['dec'], mjd)
+    label = window['calibrator'] or 'Calibrator'
+    stem = os.path.join(outdir, window_stem(window))
+
+    for values, quantity, title in [(alt, 'altitude', f'{label} Altitude'),
+                                    (pa, 'parallactic', f'{label} Parallactic Angle')]:
+        fig = Figure(figsize=(5,5))
+        plot_track(fig.subplots(), mjd, values, quantity, title)
+        fig.tight_layout()
+        fig.savefig(f'{stem}_{quantity}.png', dpi=150)
+
+    times = np.datetime_as_string(mjd_to_datetime64(mjd), unit='s')
+    return [{'window': window['index'], 'calibrator': label, 'time_utc': t, 'mjd': f'{m:.8f}',
+             'alt_deg': f'{a:.4f}', 'pa_deg': f'{p:.4f}'} for t, m, a, p in zip(times, mjd, alt, pa)]
+
+
+def render(job: dict):
+    ephemeris = EphemerisCache(lat=job['lat'], lon=job['lon'])
+    with open(job['table'], 'w', newline='') as f:
+        writer = csv.DictWriter(f, TRACK_FIELDS)
+        for window in job['windows']:
+            writer.writerows(render_window(ephemeris, window, job['outdir']))
+            print(f"Rendered {window_stem(window)}")
+
+
+if __name__ == '__main__':
+    render(load_job())
@@ -1,3 +1,11 @@
+import os, sys
+
+# Helper modules live alongside these scripts; set ATA_POL_SCRIPTS when running
+# from a data directory
+script_dir = os.path.dirname(os.path.abspath(__file__)) if '__file__' in globals() else os.getcwd()
+sys.path.insert(0, os.environ.get('ATA_POL_SCRIPTS', script_dir))
+from caltable_plots import caltable_plot, render_caltable_plots
+
 # Evalution plots
 
 vis = 'CasA_polcal.ms'
@@ -28,37 +36,28 @@ plotms(vis=vis, xdatacolumn='corrected', ydatacolumn='corrected',
        avgtime='100000', avgscan=True, avgchannel='168', spw=polcal_spw,
        plotfile=f'{vis}_parang_corrected_reim.png')
 
-# Calibration table plots
+# Calibration table plots, read once per table and drawn with matplotlib in parallel
 
+plots = []
 if plot_calibration_tables:
     for ax in ['amp', 'phase']:
-        plotms(vis=f'{vis}.B0', xaxis='freq', yaxis=f'gain{ax}',
-            coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
-            yselfscale=True, antenna=antenna_list, spw='0',
-            plotfile=f'B0_{ax}.png', overwrite=True)
+        plots.append(caltable_plot(f'{vis}.B0', 'freq', f'gain{ax}', f'B0_{ax}.png',
+                                   iteraxis='antenna', antenna=antennas, spw='0'))
 
-    plotms(vis=f'{vis}.G0', xaxis='antenna1', yaxis='gainamp',
-        coloraxis='corr', antenna=antenna_list, spw='0',
-        plotfile='G0_amp.png', overwrite=True)
+    plots.append(caltable_plot(f'{vis}.G0', 'antenna1', 'gainamp', 'G0_amp.png', antenna=antennas, spw='0'))
 
     for j in [1, 2]:
         for ax in ['amp', 'phase']:
-            plotms(vis=f'{vis}.field0.G{j}', xaxis='time', yaxis=f'gain{ax}',
-                coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
-                yselfscale=True, antenna=antenna_list, spw='0',
-                plotfile=f'G{j}_field0_{ax}.png', overwrite=True)
+            plots.append(caltable_plot(f'{vis}.field0.G{j}', 'time', f'gain{ax}', f'G{j}_field0_{ax}.png',
+                                       iteraxis='antenna', antenna=antennas, spw='0'))
 
-    plotms(vis=f'uvh5_60247.Kcross0', yaxis='delay', spw='0',
-        antenna=REFANT, coloraxis='corr',
-        plotfile=f'Kcross0.png', overwrite=True)
+    plots.append(caltable_plot(f'uvh5_60247.Kcross0', 'time', 'delay', f'Kcross0.png', antenna=[REFANT], spw='0'))
 
 if plot_pol_cal_tables:
     for xf in ['Xfparang']:
-        plotms(vis=f'uvh5_60247.{xf}', xaxis='freq', yaxis='gainphase',
-            plotfile=f'{xf}.png', overwrite=True)
+        plots.append(caltable_plot(f'uvh5_60247.{xf}', 'freq', 'gainphase', f'{xf}.png'))
 
     for ax in ['real', 'imag']:
-        plotms(vis='uvh5_60247.D0', xaxis='freq', yaxis=ax,
-            coloraxis='corr', iteraxis='antenna', gridrows=4, gridcols=5,
-            yselfscale=True, antenna=antenna_list,
-            plotfile=f'D0_{ax}.png', overwrite=True)
\ No newline at end of file
+        plots.append(caltable_plot('uvh5_60247.D0', 'freq', ax, f'D0_{ax}.png', iteraxis='antenna', antenna=antennas))
+
+render_caltable_plots(plots)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+#############################################################################
+# Worker processes for the helper modules
+#############################################################################
+
+# The calibration scripts are flat scripts with no __main__ guard and usually
+# run inside CASA, so multiprocessing's spawn/forkserver (which re-import the
+# main script) and fork (which copies the CASA tool state) are both unsafe.
+# Workers are instead fresh interpreters running a helper module as
+# python -m <module> <job.json>; the parent only waits on them from threads.
+
+import json
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+
+def run_module(module: str, job: dict, name: str, env: dict = None) -> bool:
+    '''
+    Run python -m module on a job description in a new interpreter, with its
+    output in <name>.log. Returns whether the job succeeded.
+    '''
+    job_file = f'{name}.job.json'
+    with open(job_file, 'w') as f:
+        json.dump(job, f)
+
+    worker_env = dict(os.environ)
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    worker_env['PYTHONPATH'] = os.pathsep.join([module_dir, worker_env.get('PYTHONPATH', '')]).rstrip(os.pathsep)
+    worker_env.update(env or {})
+    with open(f'{name}.log', 'w') as log:
+        proc = subprocess.run([sys.executable, '-m', module, job_file],
+                              stdout=log, stderr=subprocess.STDOUT, env=worker_env)
+    os.remove(job_file)
+    if proc.returncode != 0:
+        print(f"{module} job {name} failed, see {name}.log")
+        return False
+    return True
+
+
+def run_modules(module: str, jobs: dict, nproc: int = 0, env: dict = None) -> list:
+    '''Run {name: job} through run_module, nproc (default one per core) at a time; returns the names that succeeded'''
+    if not jobs:
+        return []
+    workers = min(len(jobs), nproc or os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {name: pool.submit(run_module, module, job, name, env) for name, job in jobs.items()}
+        return [name for name, future in futures.items() if future.result()]
+
+
+def load_job() -> dict:
+    '''Job description of a worker started by run_module'''
+    with open(sys.argv[1]) as f:
+        return json.load(f)